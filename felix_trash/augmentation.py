@@ -0,0 +1,137 @@
+"""
+DogFaceNet
+Vectorized data augmentation.
+Same random rotation, zoom and channel shift as the ImageDataGenerator of
+offline_training, but the per-sample affine matrices are applied to a
+whole NHWC batch at once (bilinear interpolation, nearest fill) instead of
+one picture at a time through scipy.
+
+Usage:
+    augmenter = BatchAugmenter(rotation_range=8, zoom_range=0.1, channel_shift_range=0.1, seed=0)
+    images = augmenter(images)
+
+A BatchAugmenter can be passed wherever a datagen is expected
+(apply_transform, the generators of online_training, ...).
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+
+
+class BatchAugmenter(object):
+    """
+    Batched random affine augmentation.
+
+    Args:
+     - rotation_range: float. Range in degrees of the random rotations.
+     - zoom_range: float or [lower, upper]. Range of the random zoom, a float z
+     means [1-z, 1+z].
+     - channel_shift_range: float. Range of the random channel shifts.
+     - fill_mode: string. Only 'nearest' is supported.
+     - seed: integer. Seed of the random transformations.
+     - chunk_size: integer. Number of pictures interpolated at once, bounds
+     the size of the temporary arrays.
+    """
+
+    def __init__(self, rotation_range=0., zoom_range=0., channel_shift_range=0., fill_mode='nearest', seed=None,
+                 chunk_size=64):
+        assert fill_mode == 'nearest', '[Error] BatchAugmenter only supports the nearest fill mode.'
+        if np.isscalar(zoom_range):
+            zoom_range = [1. - zoom_range, 1. + zoom_range]
+        self.rotation_range = rotation_range
+        self.zoom_range = zoom_range
+        self.channel_shift_range = channel_shift_range
+        self.fill_mode = fill_mode
+        self.chunk_size = chunk_size
+        self.rng = np.random.RandomState(seed)
+
+    @classmethod
+    def from_datagen(cls, datagen, seed=None):
+        """
+        Builds a BatchAugmenter with the settings of an ImageDataGenerator.
+        """
+        return cls(rotation_range=datagen.rotation_range,
+                   zoom_range=datagen.zoom_range,
+                   channel_shift_range=datagen.channel_shift_range,
+                   fill_mode=datagen.fill_mode,
+                   seed=seed)
+
+    def random_params(self, n):
+        """
+        Draws n random transformations.
+
+        Returns:
+         - matrices: array of shape (n, 2, 2), maps centered output (x, y)
+         coordinates to centered input coordinates.
+         - shifts: array of shape (n,), channel shift intensities.
+        """
+        theta = np.deg2rad(self.rng.uniform(-self.rotation_range, self.rotation_range, n))
+        zx = self.rng.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        zy = self.rng.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        shifts = self.rng.uniform(-self.channel_shift_range, self.channel_shift_range, n)
+
+        # Rotation then zoom, as in ImageDataGenerator
+        cos, sin = np.cos(theta), np.sin(theta)
+        matrices = np.empty((n, 2, 2), dtype=np.float32)
+        matrices[:, 0, 0] = cos * zx
+        matrices[:, 0, 1] = -sin * zy
+        matrices[:, 1, 0] = sin * zx
+        matrices[:, 1, 1] = cos * zy
+        return matrices, shifts.astype(np.float32)
+
+    def transform(self, images, matrices, shifts):
+        """
+        Applies the given transformations to a batch of pictures.
+
+        Args:
+         - images: array of shape (n, h, w, c).
+         - matrices, shifts: see random_params.
+        Returns:
+         - float32 array of shape (n, h, w, c).
+        """
+        n, h, w, c = images.shape
+        out = np.empty((n, h, w, c), dtype=np.float32)
+
+        o_x, o_y = (w - 1) / 2., (h - 1) / 2.
+        ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+        xs = (xs - o_x).ravel()
+        ys = (ys - o_y).ravel()
+
+        for start in range(0, n, self.chunk_size):
+            m = matrices[start:start + self.chunk_size]
+            batch = np.asarray(images[start:start + self.chunk_size], dtype=np.float32)
+            k = len(batch)
+
+            # Source coordinates, clipped to the borders for the nearest fill
+            sx = np.clip(m[:, 0, 0, None] * xs + m[:, 0, 1, None] * ys + o_x, 0, w - 1)
+            sy = np.clip(m[:, 1, 0, None] * xs + m[:, 1, 1, None] * ys + o_y, 0, h - 1)
+            x0 = np.floor(sx).astype(np.int64)
+            y0 = np.floor(sy).astype(np.int64)
+            x1 = np.minimum(x0 + 1, w - 1)
+            y1 = np.minimum(y0 + 1, h - 1)
+            fx = (sx - x0)[..., None]
+            fy = (sy - y0)[..., None]
+
+            # Bilinear interpolation with a single gather per corner
+            flat = batch.reshape(k * h * w, c)
+            base = (np.arange(k) * (h * w))[:, None]
+            top = flat[base + y0 * w + x0] * (1 - fx) + flat[base + y0 * w + x1] * fx
+            bottom = flat[base + y1 * w + x0] * (1 - fx) + flat[base + y1 * w + x1] * fx
+            transformed = (top * (1 - fy) + bottom * fy).reshape(k, h, w, c)
+
+            # Channel shift, clipped to the range of the transformed picture
+            if self.channel_shift_range:
+                min_x = transformed.min(axis=(1, 2, 3), keepdims=True)
+                max_x = transformed.max(axis=(1, 2, 3), keepdims=True)
+                transformed = np.clip(transformed + shifts[start:start + k, None, None, None], min_x, max_x)
+
+            out[start:start + k] = transformed
+        return out
+
+    def __call__(self, images):
+        """
+        Applies random transformations to a batch of pictures of shape (n, h, w, c).
+        """
+        matrices, shifts = self.random_params(len(images))
+        return self.transform(images, matrices, shifts)
@@ -0,0 +1,178 @@
+"""
+DogFaceNet
+Benchmarks of the data and mining hot paths.
+Measures the per-call latency, the throughput in images/sec and the peak
+memory (numpy and python allocations, traced with tracemalloc in a separate
+untimed call) of:
+ - load_images (files and image cache) and the data augmentation
+ - define_triplets_batch and define_adaptive_hard_triplets_batch
+ - the triplet selection of global_define_hard_triplets
+ (global_hard_triplet_indices, without the gathering of the pictures)
+ - a full online_adaptive_hard_image_generator step
+on DFN_dataset and on synthetic labels/embeddings of configurable sizes.
+Runs on CPU only with a fixed seed and saves the results as JSON, to be
+compared across commits.
+
+Usage:
+    python benchmark.py --path ../DFN_dataset/ --sizes 10000 100000 1000000 --out bench.json
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import tensorflow as tf
+
+from online_training import *
+from dogfacenet import build_dogfacenet
+from losses import triplet, triplet_acc
+from records import list_dataset
+
+
+def measure(fn, nbof_images, repeat=10, warmup=1):
+    """
+    Calls fn repeat times (after warmup calls), then once more with
+    tracemalloc for the peak memory: tracing slows down the allocations, so
+    it is kept out of the timed calls.
+
+    Returns:
+     - dictionary with the mean, p50 and p95 latency in milliseconds, the
+     throughput in images/sec and the peak traced memory in MB.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies += [time.perf_counter() - start]
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = np.array(latencies)
+    return {
+        'mean_ms': float(np.mean(latencies) * 1000.),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000.),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000.),
+        'images_per_sec': float(nbof_images / np.mean(latencies)),
+        'peak_mb': peak / 2 ** 20,
+        'repeat': repeat}
+
+
+def synthetic_dataset(nbof_images, emb_size=32, mean_class_size=6):
+    """
+    Random labels (classes of 2 to 2*mean_class_size-2 pictures) and
+    L2-normalized embeddings.
+    """
+    sizes = np.random.randint(2, 2 * mean_class_size - 1, size=nbof_images // 2)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), nbof_images) + 1]
+    labels = np.repeat(np.arange(len(sizes)), sizes)[:nbof_images].astype(np.float64)
+    embeddings = np.random.randn(len(labels), emb_size).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    filenames = np.array(['{:d}.jpg'.format(i) for i in range(len(labels))])
+    return filenames, labels, embeddings
+
+
+def bench_synthetic(sizes, batch_size, nbof_subclasses, max_global, repeat):
+    results = {}
+    for n in sizes:
+        filenames, labels, embeddings = synthetic_dataset(n)
+        class_index = ClassIndex(labels)
+        res = {}
+        res['ClassIndex'] = measure(lambda: ClassIndex(labels), n, repeat=1, warmup=0)
+        res['define_triplets_batch'] = measure(
+            lambda: define_triplets_batch(filenames, labels, batch_size, class_index), batch_size, repeat)
+
+        # Mining on the pictures of nbof_subclasses classes, as in the online generators
+        def mining_step():
+            keep, subclass_index = class_index.subset(class_index.random_classes(nbof_subclasses))
+            define_adaptive_hard_triplets_batch(filenames[keep], labels[keep], embeddings[keep], batch_size,
+                                                class_index=subclass_index)
+        res['define_adaptive_hard_triplets_batch'] = measure(mining_step, batch_size, repeat)
+
+        # Index selection only: the synthetic datasets have no pictures to gather
+        if n <= max_global:
+            res['global_hard_triplet_indices'] = measure(
+                lambda: global_hard_triplet_indices(labels, embeddings), n, repeat=1)
+        results[str(n)] = res
+        print('Synthetic {:d}: {:s}'.format(n, json.dumps({k: round(v['mean_ms'], 3) for k, v in res.items()})))
+    return results
+
+
+def bench_dataset(path, cache_path, batch_size, nbof_subclasses, repeat):
+    filenames, labels = list_dataset(path)
+    class_index = ClassIndex(labels)
+    res = {'nbof_images': len(filenames), 'nbof_classes': len(class_index)}
+
+    batch = filenames[np.random.choice(len(filenames), size=batch_size, replace=False)]
+    res['load_images'] = measure(lambda: load_images(batch), batch_size, repeat)
+    if cache_path is not None:
+        cache = open_image_cache(cache_path) if os.path.isfile(cache_path + '.images.npy') else \
+            pack_images(filenames, cache_path, verbose=False)
+        res['load_images_cache'] = measure(lambda: load_images(batch, cache), batch_size, repeat)
+
+    images = load_images(batch).astype(np.float32)
+    res['apply_transform_datagen'] = measure(lambda: apply_transform(images, datagen), batch_size, repeat)
+    res['apply_transform_batch'] = measure(lambda: apply_transform(images, batch_datagen), batch_size, repeat)
+
+    # Full online step with an untrained dogfacenet
+    model = build_dogfacenet(SIZE)
+    model.compile(loss=triplet, optimizer='adam', metrics=[triplet_acc])
+    generator = online_adaptive_hard_image_generator(filenames, labels, model, 0.6, batch_size,
+                                                     nbof_subclasses=nbof_subclasses, class_index=class_index)
+    res['online_adaptive_hard_image_generator_step'] = measure(lambda: next(generator), batch_size, repeat)
+    print('DFN_dataset: {:s}'.format(json.dumps({k: round(v['mean_ms'], 3) for k, v in res.items()
+                                                 if isinstance(v, dict)})))
+    return res
+
+
+def commit_hash():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DogFaceNet data and mining benchmarks.')
+    parser.add_argument('--path', default=None, help='dataset directory (e.g. ../DFN_dataset/), skipped if not given')
+    parser.add_argument('--cache', default=None, help='prefix of an image cache, packed if it does not exist')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000, 1000000],
+                        help='number of images of the synthetic datasets')
+    parser.add_argument('--max-global', type=int, default=20000,
+                        help='largest synthetic size for the all-pairs global mining')
+    parser.add_argument('--batch-size', type=int, default=30)
+    parser.add_argument('--nbof-subclasses', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark.json')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    tf.random.set_seed(args.seed)
+
+    results = {
+        'commit': commit_hash(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'synthetic': bench_synthetic(args.sizes, args.batch_size, args.nbof_subclasses, args.max_global, args.repeat)}
+    if args.path is not None:
+        results['dataset'] = bench_dataset(args.path, args.cache, args.batch_size, args.nbof_subclasses, args.repeat)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved in {:s}'.format(args.out))
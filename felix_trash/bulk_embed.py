@@ -0,0 +1,239 @@
+"""
+DogFaceNet
+Resumable bulk embedding extraction.
+Embeds a whole dataset with a dogfacenet model and writes the float32
+embeddings and the image ids (indices in the list of file names) into
+chunks of chunk_size pictures: chunk-00000.emb.npy, chunk-00000.ids.npy,
+... which can be memory-mapped. The pictures are decoded by an executor
+and prefetched while the model runs. progress.json records the written
+chunks after each one, so a killed job starts again at the first missing
+chunk, and the throughput in images/sec. Once all the chunks are written,
+they are consolidated into embeddings.npy and ids.npy, copied chunk by
+chunk, so that load_embeddings memory-maps a single array.
+
+Usage:
+    python bulk_embed.py --model ../../output/model/2023.11.20.dogfacenet.49.h5 --path ../DFN_dataset/ --out ../../output/embeddings/dfn/
+    embeddings, ids = load_embeddings('../../output/embeddings/dfn/')
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from online_training import parallel_load_images, input_dtype
+from prefetch import make_executor, prefetch_generator
+from records import RecordReader, list_dataset
+from inference_server import load_model
+
+PROGRESS = 'progress.json'
+
+
+def _chunk_paths(path, chunk):
+    name = os.path.join(path, 'chunk-{:05d}'.format(chunk))
+    return name + '.emb.npy', name + '.ids.npy'
+
+
+def _consolidated_paths(path):
+    return os.path.join(path, 'embeddings.npy'), os.path.join(path, 'ids.npy')
+
+
+def _save(filename, array):
+    # Atomic write: a killed job never leaves a truncated chunk behind
+    with open(filename + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(filename + '.tmp', filename)
+
+
+def _write_progress(path, progress):
+    filename = os.path.join(path, PROGRESS)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_progress(path):
+    """
+    Content of progress.json, None if the extraction has not started.
+    """
+    filename = os.path.join(path, PROGRESS)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _batches(filenames, batch_size, cache, executor, dtype):
+    for i in range(0, len(filenames), batch_size):
+        yield parallel_load_images(filenames[i:i + batch_size], executor, cache, dtype)
+
+
+def bulk_embed(model, filenames, path, labels=None, chunk_size=16384, batch_size=64, cache=None, executor=None,
+               prefetch_depth=4, verbose=True):
+    """
+    Embeds the pictures of filenames into chunks in the directory path,
+    resuming after the chunks already written.
+
+    Args:
+     - model: dogfacenet model.
+     - filenames: array of strings. The image id of a picture is its index.
+     - path: string. Output directory, filenames.npy and labels.npy are
+     also written in it.
+     - labels: optional array of the class of each picture.
+     - chunk_size: integer. Number of pictures per chunk (and between two
+     progress checkpoints).
+     - batch_size: integer. Number of pictures per forward pass.
+     - cache: optional ImageCache or RecordReader used instead of the files.
+     - executor: optional executor decoding the pictures (see prefetch.make_executor).
+     - prefetch_depth: integer. Number of batches decoded in advance.
+    Returns:
+     - the progress dictionary, see consolidate.
+    """
+    filenames = np.asarray(filenames)
+    nbof_chunks = -(-len(filenames) // chunk_size)
+    emb_size = model.output_shape[-1]
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    progress = read_progress(path)
+    if progress is None:
+        np.save(os.path.join(path, 'filenames.npy'), filenames.astype(str))
+        if labels is not None:
+            np.save(os.path.join(path, 'labels.npy'), np.asarray(labels))
+        progress = {'nbof_images': len(filenames), 'emb_size': emb_size, 'chunk_size': chunk_size,
+                    'nbof_chunks': nbof_chunks, 'chunks_done': 0, 'images_per_sec': None}
+        _write_progress(path, progress)
+    else:
+        assert (progress['nbof_images'], progress['emb_size'], progress['chunk_size']) == \
+            (len(filenames), emb_size, chunk_size), \
+            '[Error] {:s} holds another extraction, delete it or use the same dataset, model and chunk size.'.format(path)
+        if verbose and progress['chunks_done'] > 0:
+            print('Resuming after {:d}/{:d} chunks.'.format(progress['chunks_done'], nbof_chunks))
+
+    dtype = input_dtype(model)
+    start = time.perf_counter()
+    nbof_embedded = 0
+    for chunk in range(progress['chunks_done'], nbof_chunks):
+        ids = np.arange(chunk * chunk_size, min((chunk + 1) * chunk_size, len(filenames)), dtype=np.int64)
+        embeddings = np.empty((len(ids), emb_size), dtype=np.float32)
+        batches = _batches(filenames[ids], batch_size, cache, executor, dtype)
+        if prefetch_depth > 0:
+            batches = prefetch_generator(batches, prefetch_depth)
+        i = 0
+        for images in batches:
+            embeddings[i:i + len(images)] = model.predict_on_batch(images)
+            i += len(images)
+
+        path_emb, path_ids = _chunk_paths(path, chunk)
+        _save(path_emb, embeddings)
+        _save(path_ids, ids)
+        nbof_embedded += len(ids)
+        progress['chunks_done'] = chunk + 1
+        progress['images_per_sec'] = nbof_embedded / (time.perf_counter() - start)
+        _write_progress(path, progress)
+        if verbose:
+            print('Chunk {:d}/{:d}: {:d} pictures, {:.1f} images/sec'.format(
+                chunk + 1, nbof_chunks, len(ids), progress['images_per_sec']))
+    return consolidate(path)
+
+
+def consolidate(path):
+    """
+    Copies the chunks of a finished extraction, one at a time, into the
+    memory-mapped embeddings.npy and ids.npy, then removes them. Does
+    nothing if the extraction is not finished or already consolidated.
+
+    Returns:
+     - the progress dictionary, progress['consolidated'] is True once done.
+    """
+    progress = read_progress(path)
+    assert progress is not None, '[Error] No embeddings in {:s}.'.format(path)
+    if progress.get('consolidated') or progress['chunks_done'] < progress['nbof_chunks']:
+        return progress
+    chunks = [_chunk_paths(path, chunk) for chunk in range(progress['nbof_chunks'])]
+    shapes = ((progress['nbof_images'], progress['emb_size']), (progress['nbof_images'],))
+    for column, (filename, shape, dtype) in enumerate(zip(_consolidated_paths(path), shapes, (np.float32, np.int64))):
+        array = np.lib.format.open_memmap(filename + '.tmp', mode='w+', dtype=dtype, shape=shape)
+        start = 0
+        for chunk in chunks:
+            rows = np.load(chunk[column], mmap_mode='r')
+            array[start:start + len(rows)] = rows
+            start += len(rows)
+        array.flush()
+        del array
+        os.replace(filename + '.tmp', filename)
+    progress['consolidated'] = True
+    _write_progress(path, progress)
+    for chunk in chunks:
+        for filename in chunk:
+            os.remove(filename)
+    return progress
+
+
+def load_chunks(path, mmap_mode='r'):
+    """
+    Memory-mapped embeddings and image ids of the chunks written so far,
+    also while the extraction runs or after it was killed. A single chunk
+    once the extraction is consolidated.
+
+    Returns:
+     - embeddings: list of float32 arrays of shape (chunk_size, emb_size).
+     - ids: list of int64 arrays of the image ids of the rows.
+    """
+    progress = read_progress(path)
+    assert progress is not None, '[Error] No embeddings in {:s}.'.format(path)
+    chunks = [_consolidated_paths(path)] if progress.get('consolidated') else \
+        [_chunk_paths(path, chunk) for chunk in range(progress['chunks_done'])]
+    return ([np.load(emb, mmap_mode=mmap_mode) for emb, _ in chunks],
+            [np.load(ids, mmap_mode=mmap_mode) for _, ids in chunks])
+
+
+def load_embeddings(path, mmap_mode='r'):
+    """
+    Embeddings and image ids of a finished extraction, memory-mapped from
+    the consolidated arrays (consolidated first if needed). See load_chunks
+    for an unfinished one.
+
+    Returns:
+     - embeddings: float32 array of shape (nbof_images, emb_size).
+     - ids: int64 array of the image ids of the rows.
+    """
+    progress = consolidate(path)
+    assert progress.get('consolidated'), '[Error] The extraction in {:s} is not finished ({:d}/{:d} chunks).'.format(
+        path, progress['chunks_done'], progress['nbof_chunks'])
+    path_emb, path_ids = _consolidated_paths(path)
+    return np.load(path_emb, mmap_mode=mmap_mode), np.load(path_ids, mmap_mode=mmap_mode)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DogFaceNet bulk embedding extraction.')
+    parser.add_argument('--model', required=True, help='path to a saved dogfacenet .h5 model')
+    parser.add_argument('--path', default=None, help='dataset directory, one directory per class')
+    parser.add_argument('--records', default=None, help='prefix of record shards (see records.py), used instead of --path')
+    parser.add_argument('--out', default='../../output/embeddings/dfn/', help='output directory')
+    parser.add_argument('--chunk-size', type=int, default=16384)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4, help='number of threads decoding the pictures')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of batches decoded in advance')
+    args = parser.parse_args()
+
+    cache = None
+    if args.records is not None:
+        cache = RecordReader(args.records)
+        filenames, labels = cache.filenames, cache.labels
+    else:
+        assert args.path is not None and os.path.isdir(args.path), '[Error] Provide a dataset --path or --records.'
+        filenames, labels = list_dataset(args.path)
+
+    print('Loading model from {:s} ...'.format(args.model))
+    model = load_model(args.model)
+    print('Embedding {:d} pictures into {:s} ...'.format(len(filenames), args.out))
+    progress = bulk_embed(model, filenames, args.out, labels, args.chunk_size, args.batch_size, cache,
+                          make_executor(args.workers), args.prefetch)
+    print('Done: {:d}/{:d} chunks, {:.1f} images/sec, consolidated into {:s}'.format(
+        progress['chunks_done'], progress['nbof_chunks'], progress['images_per_sec'] or 0.,
+        _consolidated_paths(args.out)[0]))
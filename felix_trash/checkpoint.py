@@ -0,0 +1,277 @@
+"""
+DogFaceNet
+Resumable training checkpoints written in the background.
+At the end of an epoch the model weights, the optimizer variables, the
+training state (e.g. crt_loss and crt_acc of the adaptive mining), the
+history and the random generator states (numpy, python, tensorflow and
+the given RandomState objects such as the BatchAugmenter one) are copied
+in memory, then written by a background thread to
+path/net_name.epoch.ckpt.npz. Only the last max_to_keep checkpoints are
+kept. The history is appended epoch by epoch and also written in the
+usual path_history/net_name.epoch.npy format.
+With several data-parallel workers, the chief (worker 0) writes the model
+and every other worker writes its own random generator states and worker
+state (e.g. its PK sampler cursor) to path/net_name.epoch.worker<i>.npz,
+so that each worker resumes its own sampling.
+A resumed training is identical to an uninterrupted one as long as the
+generators do not run ahead of the training (no prefetching thread).
+
+Usage:
+    manager = CheckpointManager('../../output/checkpoint/', NET_NAME, rngs={'augmenter': augmenter.rng})
+    state = manager.restore(model)  # after the optimizer variables are created
+    manager.append_history(loss=..., val_loss=..., acc=..., val_acc=...)
+    manager.save(epoch, model, {'crt_loss': crt_loss, 'crt_acc': crt_acc}, {'pk_sampler': [epoch, position]})
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import re
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+HISTORY_KEYS = ('loss', 'val_loss', 'acc', 'val_acc')
+
+
+def _optimizer_variables(optimizer):
+    # A method for the legacy keras optimizers, a property for the new ones
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+def _numpy_state(rng):
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return keys, [name, int(pos), int(has_gauss), float(cached_gaussian)]
+
+
+def _set_numpy_state(rng, keys, meta):
+    name, pos, has_gauss, cached_gaussian = meta
+    rng.set_state((name, keys, pos, has_gauss, cached_gaussian))
+
+
+class CheckpointManager(object):
+    """
+    Saves and restores training checkpoints.
+
+    Args:
+     - path: directory of the checkpoints.
+     - net_name: network saved name.
+     - path_history: directory of the history .npy files, None to not write them.
+     - max_to_keep: integer. Number of checkpoints kept on disk, at least 1.
+     - path_model: directory of the .h5 exports.
+     - h5_every: integer. Exports the model to path_model/net_name.epoch.h5
+     every h5_every epochs (0: never). The export is done in the calling
+     thread, as it needs the model.
+     - rngs: dictionary of np.random.RandomState saved with the checkpoints.
+     - worker_index: integer. Index of the data-parallel worker, 0 for the
+     chief which saves the model.
+    """
+
+    def __init__(self, path, net_name, path_history=None, max_to_keep=3, path_model=None, h5_every=0, rngs=None,
+                 worker_index=0):
+        assert max_to_keep >= 1, '[Error] At least the last checkpoint has to be kept (max_to_keep >= 1).'
+        self.path = path
+        self.net_name = net_name
+        self.path_history = path_history
+        self.max_to_keep = max_to_keep
+        self.path_model = path_model
+        self.h5_every = h5_every
+        self.rngs = {} if rngs is None else rngs
+        self.worker_index = worker_index
+        self.history = {key: [] for key in HISTORY_KEYS}
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        for directory in (path, path_history, path_model):
+            if directory is not None and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    @property
+    def is_chief(self):
+        return self.worker_index == 0
+
+    def _filename(self, epoch, worker_index=0):
+        if worker_index == 0:
+            return os.path.join(self.path, '{:s}.{:d}.ckpt.npz'.format(self.net_name, epoch))
+        return os.path.join(self.path, '{:s}.{:d}.worker{:d}.npz'.format(self.net_name, epoch, worker_index))
+
+    def epochs(self, worker_index=0):
+        """
+        Sorted epochs of the checkpoints on disk, or of the files of another
+        worker.
+        """
+        suffix = r'\.ckpt\.npz$' if worker_index == 0 else r'\.worker{:d}\.npz$'.format(worker_index)
+        pattern = re.compile(re.escape(self.net_name) + r'\.(\d+)' + suffix)
+        matches = [pattern.match(f) for f in os.listdir(self.path)]
+        return sorted(int(m.group(1)) for m in matches if m is not None)
+
+    def latest(self):
+        """
+        Last saved epoch, None if there is no checkpoint.
+        """
+        self.wait()
+        epochs = self.epochs()
+        return epochs[-1] if epochs else None
+
+    def append_history(self, **values):
+        """
+        Appends the values of an epoch to the history (loss=..., val_loss=..., ...).
+        """
+        for key, value in values.items():
+            self.history.setdefault(key, []).append(float(value))
+
+    def _snapshot(self, epoch, model, state, worker_state):
+        # Copies everything in the calling thread, the model keeps training meanwhile
+        arrays = {}
+        rngs = {}
+        arrays['rng_numpy'], rngs['numpy'] = _numpy_state(np.random)
+        for name, rng in self.rngs.items():
+            arrays['rng_' + name], rngs[name] = _numpy_state(rng)
+        arrays['rng_tf'] = tf.random.get_global_generator().state.numpy()
+        version, python_state, gauss_next = random.getstate()
+        meta = {
+            'epoch': epoch,
+            'rngs': rngs,
+            'rng_python': [version, list(python_state), gauss_next],
+            'worker_state': {} if worker_state is None else worker_state}
+
+        if self.is_chief:
+            weights = model.get_weights()
+            for i, w in enumerate(weights):
+                arrays['weight_{:d}'.format(i)] = w
+            variables = _optimizer_variables(model.optimizer) if model.optimizer is not None else []
+            for i, v in enumerate(variables):
+                arrays['optimizer_{:d}'.format(i)] = v.numpy()
+            meta.update({
+                'nbof_weights': len(weights),
+                'nbof_optimizer': len(variables),
+                'state': {} if state is None else state,
+                'history': {key: list(values) for key, values in self.history.items()}})
+        arrays['meta'] = np.array(json.dumps(meta))
+        return arrays
+
+    def _write(self, epoch, arrays, history):
+        filename = self._filename(epoch, self.worker_index)
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(filename + '.tmp', filename)
+
+        if self.is_chief and self.path_history is not None:
+            history_ = np.array([history[key] for key in HISTORY_KEYS if key in history])
+            np.save(os.path.join(self.path_history, '{:s}.{:d}.npy'.format(self.net_name, epoch)), history_)
+
+        epochs = self.epochs(self.worker_index)
+        for old in epochs[:max(len(epochs) - self.max_to_keep, 0)]:
+            os.remove(self._filename(old, self.worker_index))
+
+    def save(self, epoch, model, state=None, worker_state=None):
+        """
+        Saves a checkpoint of the end of epoch. Returns once the model is
+        copied in memory, the files are written in the background. Called by
+        every worker: the chief saves the model and the state, the other
+        workers only their own random generators and worker_state.
+
+        Args:
+         - epoch: integer.
+         - model: compiled keras model.
+         - state: json serializable dictionary, e.g. the adaptive mining state.
+         - worker_state: json serializable dictionary of this worker, e.g.
+         its PK sampler cursor.
+        """
+        arrays = self._snapshot(epoch, model, state, worker_state)
+        history = {key: list(values) for key, values in self.history.items()}
+        # At most one checkpoint waits to be written
+        self.wait()
+        self.pending = self.writer.submit(self._write, epoch, arrays, history)
+
+        if self.is_chief and self.h5_every > 0 and self.path_model is not None and (epoch + 1) % self.h5_every == 0:
+            self.export_h5(epoch, model)
+
+    def export_h5(self, epoch, model):
+        model.save(os.path.join(self.path_model, '{:s}.{:d}.h5'.format(self.net_name, epoch)))
+
+    def wait(self):
+        """
+        Waits for the pending write, raises its exception if it failed.
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.writer.shutdown()
+
+    def restore(self, model, epoch=None):
+        """
+        Restores the model weights, the optimizer variables, the history and
+        the random generator states of a checkpoint. The optimizer variables
+        have to exist, e.g. by training the model on one batch first, unless
+        the optimizer can build them.
+        The random generators and the worker state are the ones saved by
+        this worker. If it did not save them for epoch (e.g. killed before
+        its write), its generators are seeded from (worker_index, epoch).
+
+        Args:
+         - model: compiled keras model of the same architecture.
+         - epoch: integer. Epoch of the checkpoint, the last one if None.
+        Returns:
+         - the saved state dictionary, updated with the worker state and
+         with its 'epoch', or None if there is no checkpoint.
+        """
+        if epoch is None:
+            epoch = self.latest()
+            if epoch is None:
+                return None
+        self.wait()
+        with np.load(self._filename(epoch)) as f:
+            arrays = dict(f)
+        meta = json.loads(str(arrays['meta']))
+
+        model.set_weights([arrays['weight_{:d}'.format(i)] for i in range(meta['nbof_weights'])])
+        variables = _optimizer_variables(model.optimizer)
+        if len(variables) != meta['nbof_optimizer'] and hasattr(model.optimizer, 'build'):
+            # New keras optimizers create their variables on demand
+            model.optimizer.build(model.trainable_variables)
+            variables = _optimizer_variables(model.optimizer)
+        assert len(variables) == meta['nbof_optimizer'], \
+            '[Error] The optimizer variables do not match the checkpoint, train the model on one batch before restoring.'
+        for i, v in enumerate(variables):
+            v.assign(arrays['optimizer_{:d}'.format(i)])
+
+        self.history = {key: list(values) for key, values in meta['history'].items()}
+        state = dict(meta['state'])
+
+        if not self.is_chief:
+            filename = self._filename(epoch, self.worker_index)
+            if not os.path.isfile(filename):
+                self._seed(epoch)
+                state['epoch'] = epoch
+                return state
+            with np.load(filename) as f:
+                arrays = dict(f)
+            meta = json.loads(str(arrays['meta']))
+        self._restore_rngs(arrays, meta)
+        state.update(meta.get('worker_state', {}))
+        state['epoch'] = epoch
+        return state
+
+    def _restore_rngs(self, arrays, meta):
+        _set_numpy_state(np.random, arrays['rng_numpy'], meta['rngs']['numpy'])
+        for name, rng in self.rngs.items():
+            _set_numpy_state(rng, arrays['rng_' + name], meta['rngs'][name])
+        tf.random.get_global_generator().reset(arrays['rng_tf'])
+        version, python_state, gauss_next = meta['rng_python']
+        random.setstate((version, tuple(python_state), gauss_next))
+
+    def _seed(self, epoch):
+        # Deterministic generators of a worker without saved states
+        seed = [self.worker_index, epoch]
+        np.random.seed(seed)
+        for rng in self.rngs.values():
+            rng.seed(seed)
+        tf.random.get_global_generator().reset_from_seed(self.worker_index * 1000003 + epoch)
+        random.seed(self.worker_index * 1000003 + epoch)
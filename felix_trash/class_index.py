@@ -0,0 +1,147 @@
+"""
+DogFaceNet
+Precomputed class index of a dataset.
+The pictures of each class are stored contiguously (CSR-style offsets),
+so sampling a random picture of a class costs O(1) and gathering all the
+pictures of k classes costs O(k + number of gathered pictures), whatever
+the size of the dataset.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+
+
+class ClassIndex(object):
+    """
+    Index of the pictures of a dataset by class.
+    Classes are referred to by their position in ClassIndex.classes.
+
+    Attributes:
+     - classes: array of the sorted unique labels.
+     - counts: array of integers, number of pictures in each class.
+     - offsets: array of integers of size nbof_classes + 1. The pictures
+     of the class k are order[offsets[k]:offsets[k+1]].
+     - order: array of integers, indices of the pictures sorted by class.
+     - inverse: array of integers, class position of each picture.
+     - rank: array of integers, position of each picture in its class.
+     - multi_classes: positions of the classes with at least two pictures.
+    """
+
+    def __init__(self, labels):
+        classes, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        self._set_index(classes, inverse, counts, np.argsort(inverse, kind='stable'))
+
+    @classmethod
+    def from_counts(cls, classes, counts):
+        """
+        Builds the index of a dataset already sorted by class.
+        """
+        self = cls.__new__(cls)
+        inverse = np.repeat(np.arange(len(classes)), counts)
+        self._set_index(np.asarray(classes), inverse, np.asarray(counts), np.arange(len(inverse)))
+        return self
+
+    def _set_index(self, classes, inverse, counts, order):
+        self.classes = classes
+        self.counts = counts
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.order = order
+        self.inverse = inverse
+        self.rank = np.empty(len(order), dtype=np.int64)
+        self.rank[order] = np.arange(len(order)) - self.offsets[inverse[order]]
+        self.multi_classes = np.flatnonzero(counts > 1)
+
+    def __len__(self):
+        return len(self.classes)
+
+    @property
+    def nbof_images(self):
+        return len(self.order)
+
+    @property
+    def labels(self):
+        return self.classes[self.inverse]
+
+    def members(self, k):
+        """
+        Indices of the pictures of the class k.
+        """
+        return self.order[self.offsets[k]:self.offsets[k + 1]]
+
+    def gather(self, ks):
+        """
+        Indices of all the pictures of the classes ks, grouped by class.
+        """
+        if len(ks) == 0:
+            return np.empty(0, dtype=self.order.dtype)
+        return np.concatenate([self.order[self.offsets[k]:self.offsets[k + 1]] for k in ks])
+
+    def subset(self, ks):
+        """
+        Gathers the pictures of the classes ks.
+
+        Returns:
+         - idx: indices of the gathered pictures in the dataset.
+         - class_index: ClassIndex of the gathered pictures, indexed as idx.
+        """
+        ks = np.asarray(ks)
+        return self.gather(ks), ClassIndex.from_counts(self.classes[ks], self.counts[ks])
+
+    def random_classes(self, n, replace=False, multi_only=False):
+        """
+        Chooses n random class positions.
+        Sampling without replacement uses Floyd's algorithm, hence it
+        costs O(n) instead of O(nbof_classes).
+
+        Args:
+         - n: integer. Number of classes.
+         - replace: boolean. Sample with replacement?
+         - multi_only: boolean. Only choose classes with at least two pictures?
+        """
+        candidates = self.multi_classes if multi_only else None
+        nbof_candidates = len(candidates) if multi_only else len(self)
+        if replace:
+            chosen = np.random.randint(nbof_candidates, size=n)
+        elif 2 * n > nbof_candidates:
+            chosen = np.random.choice(nbof_candidates, size=n, replace=False)
+        else:
+            selected = set()
+            for j in range(nbof_candidates - n, nbof_candidates):
+                t = np.random.randint(j + 1)
+                selected.add(j if t in selected else t)
+            chosen = np.fromiter(selected, dtype=np.int64, count=n)
+            np.random.shuffle(chosen)
+        return candidates[chosen] if multi_only else chosen
+
+    def sample(self, ks, exclude=None):
+        """
+        Chooses a random picture in each class of ks.
+
+        Args:
+         - ks: array of class positions.
+         - exclude: optional array of picture indices, one per class of ks.
+         The chosen picture will be different from the excluded one when the
+         class contains more than one picture.
+        Returns:
+         - array of picture indices.
+        """
+        ks = np.asarray(ks)
+        counts = self.counts[ks]
+        if exclude is None:
+            ranks = np.random.randint(0, np.maximum(counts, 1))
+        else:
+            ranks = np.random.randint(0, np.maximum(counts - 1, 1))
+            ranks += np.logical_and(ranks >= self.rank[exclude], counts > 1)
+        return self.order[self.offsets[ks] + ranks]
+
+    def sample_outside(self, ks):
+        """
+        Chooses a random picture outside of each class of ks.
+        """
+        ks = np.asarray(ks)
+        start = self.offsets[ks]
+        counts = self.counts[ks]
+        ranks = np.random.randint(0, self.nbof_images - counts)
+        return self.order[np.where(ranks < start, ranks, ranks + counts)]
@@ -0,0 +1,231 @@
+"""
+DogFaceNet
+Data-parallel training on the CPU cores of one machine.
+launch_workers runs a training script in nbof_workers local processes,
+each with its TF_CONFIG and a share of the CPU threads. In each process
+make_strategy creates a MultiWorkerMirroredStrategy: the gradients are
+all-reduced between the workers at each step.
+Each worker mines its triplets in its own shard of the training classes
+(shard_classes) with its own generator, so the [a, p, n, ...] structure
+of the batches is kept on each replica. The input auto-sharding is turned
+off as the shards are already disjoint. The mining predictions are done
+by a LocalPredictor, a copy of the model outside of the strategy synced
+after each step, because a prediction of the distributed model would
+need all the workers at once.
+
+Usage, at the top of the training script:
+    if NBOF_WORKERS > 1 and 'TF_CONFIG' not in os.environ:
+        sys.exit(launch_workers(__file__, NBOF_WORKERS))
+    strategy = make_strategy()
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import sys
+import json
+import socket
+import subprocess
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+def free_ports(n):
+    """
+    n free TCP ports of localhost.
+    """
+    sockets = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets += [s]
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def tf_config(ports, index):
+    """
+    TF_CONFIG of the worker index of a localhost cluster.
+    """
+    return json.dumps({
+        'cluster': {'worker': ['localhost:{:d}'.format(port) for port in ports]},
+        'task': {'type': 'worker', 'index': index}})
+
+
+def launch_workers(script, nbof_workers, args=(), threads_per_worker=None):
+    """
+    Runs script in nbof_workers processes forming a localhost cluster, and
+    waits for them. If a worker fails the other ones are terminated.
+
+    Args:
+     - script: path of the python training script.
+     - nbof_workers: integer. Number of processes.
+     - args: command line arguments of the script.
+     - threads_per_worker: integer. Number of compute threads per worker,
+     the CPU cores are shared evenly by default.
+    Returns:
+     - 0 if all the workers succeeded, the first non-zero exit code otherwise.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // nbof_workers)
+    ports = free_ports(nbof_workers)
+    processes = []
+    for index in range(nbof_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = tf_config(ports, index)
+        env['CUDA_VISIBLE_DEVICES'] = '-1'
+        env['TF_NUM_INTRAOP_THREADS'] = str(threads_per_worker)
+        env['OMP_NUM_THREADS'] = str(threads_per_worker)
+        processes += [subprocess.Popen([sys.executable, script] + list(args), env=env)]
+    print('Launched {:d} workers on ports {:s}'.format(nbof_workers, str(ports)))
+
+    code = 0
+    remaining = list(processes)
+    while remaining:
+        for process in list(remaining):
+            try:
+                result = process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                continue
+            remaining.remove(process)
+            if result != 0 and code == 0:
+                code = result
+                print('[Error] A worker failed with exit code {:d}, stopping the others.'.format(result))
+                for other in remaining:
+                    other.terminate()
+    return code
+
+
+def worker_info():
+    """
+    Index of this worker and number of workers, (0, 1) without TF_CONFIG.
+    """
+    if 'TF_CONFIG' not in os.environ:
+        return 0, 1
+    config = json.loads(os.environ['TF_CONFIG'])
+    return config['task']['index'], len(config['cluster']['worker'])
+
+
+def make_strategy():
+    """
+    MultiWorkerMirroredStrategy of the TF_CONFIG cluster, or the default
+    strategy without TF_CONFIG. Has to be called before any other
+    tensorflow operation.
+    """
+    if 'TF_CONFIG' not in os.environ:
+        return tf.distribute.get_strategy()
+    threads = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+    if threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def shard_classes(class_index, index, nbof_workers, seed=0):
+    """
+    Disjoint shard of the classes for a worker. The classes are shuffled
+    with seed, the same on all the workers, then dealt out.
+
+    Returns:
+     - idx: indices of the pictures of the shard, in class order.
+     - class_index: ClassIndex of the pictures of the shard.
+    """
+    classes = np.random.RandomState(seed).permutation(len(class_index))
+    return class_index.subset(np.sort(classes[index::nbof_workers]))
+
+
+def generator_dataset(generator_fn, batch_size, image_shape, image_dtype=tf.float32):
+    """
+    tf.data.Dataset of the (images, labels) batches of a python generator.
+
+    Args:
+     - generator_fn: callable returning the generator.
+     - batch_size: integer. Size of the batches yielded by the generator.
+     - image_shape: tuple (h, w, c).
+     - image_dtype: dtype of the images.
+    """
+    return tf.data.Dataset.from_generator(
+        generator_fn,
+        output_signature=(tf.TensorSpec(shape=(batch_size,) + tuple(image_shape), dtype=image_dtype),
+                          tf.TensorSpec(shape=(batch_size,), dtype=tf.float32)))
+
+
+def distribute_dataset(strategy, dataset_fn, batch_size, group_size=3):
+    """
+    Distributes per-worker datasets: each worker runs dataset_fn() and feeds
+    its batches as they are to its replica, without auto-sharding.
+
+    Args:
+     - strategy: tf.distribute strategy.
+     - dataset_fn: callable returning a tf.data.Dataset of (images, labels)
+     batches of batch_size, e.g. the triplets of the worker shard.
+     - batch_size: integer. Batch size per replica.
+     - group_size: integer. The batches are made of groups which must not
+     be split: 3 for the [a, p, n] triplets, K for the PK batches.
+    Returns:
+     - a distributed dataset for model.fit.
+    """
+    assert batch_size % group_size == 0, \
+        '[Error] The batch size of each replica has to be a multiple of {:d}.'.format(group_size)
+
+    def worker_dataset(input_context):
+        assert input_context.num_replicas_in_sync == input_context.num_input_pipelines, \
+            '[Error] Each worker has to hold a single replica.'
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset_fn().with_options(options)
+
+    return strategy.distribute_datasets_from_function(worker_dataset)
+
+
+class LocalPredictor(tf.keras.callbacks.Callback):
+    """
+    Copy of the trained model used by the mining generators of a worker.
+    Its weights are copied from the distributed model (set by model.fit)
+    at the beginning of each epoch and after every sync_every steps.
+    Implements what the generators of online_training use from a model:
+    predict, predict_generator, inputs and output_shape.
+
+    Args:
+     - local_model: keras model of the same architecture, built outside of
+     the strategy scope.
+     - sync_every: integer. Number of steps between two weight copies.
+    """
+
+    def __init__(self, local_model, sync_every=1):
+        super(LocalPredictor, self).__init__()
+        self.local_model = local_model
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+
+    @property
+    def inputs(self):
+        return self.local_model.inputs
+
+    @property
+    def output_shape(self):
+        return self.local_model.output_shape
+
+    def sync(self, model=None):
+        weights = (self.model if model is None else model).get_weights()
+        with self.lock:
+            self.local_model.set_weights(weights)
+
+    def predict(self, *args, **kwargs):
+        with self.lock:
+            return self.local_model.predict(*args, **kwargs)
+
+    def predict_generator(self, generator, steps=None):
+        return self.predict(generator, steps=None if steps is None else int(steps))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.sync()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if (batch + 1) % self.sync_every == 0:
+            self.sync()
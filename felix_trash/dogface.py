@@ -7,11 +7,23 @@ from __future__ import print_function
 import tensorflow as tf
 
 import os
+import sys
 import numpy as np
-import skimage as sk
-import matplotlib.pyplot as plt
-import tensorflow.keras.backend as K
 from online_training import *
+from prefetch import make_executor, prefetch_generator
+from tf_pipeline import triplet_dataset, mined_triplet_dataset
+from embedding_cache import EmbeddingCache, EmbeddingCacheLogger
+from evaluation import EvaluationCallback
+from profiling import profiler, StageTimingCallback
+from dogfacenet import build_dogfacenet
+from precision import set_precision
+from checkpoint import CheckpointManager
+from records import RecordReader, class_split
+from manifest import update_manifest
+from distributed import launch_workers, worker_info, make_strategy, shard_classes, generator_dataset, \
+    distribute_dataset, LocalPredictor
+# The triplet losses and accuracies are defined in the losses module (alpha = 0.3)
+from losses import alpha, triplet, triplet_acc, custom_objects, LOSSES
 
 #----------------------------------------------------------------------------
 # Config.
@@ -19,157 +31,265 @@ from online_training import *
 PATH        = '../DFN_dataset/'  # Path to the directory of the saved dataset
 PATH_SAVE   = '../../output/history/'  # Path to the directory where the history will be stored
 PATH_MODEL  = '../../output/model/'  # Path to the directory where the model will be stored
+PATH_CKPT   = '../../output/checkpoint/'            # Path to the directory where the checkpoints will be stored
+PATH_CACHE  = None                                  # Prefix of the pre-decoded image cache (e.g. '../../output/cache/dfn'), None to decode the files at each batch
+PATH_MANIFEST = '../../output/manifest/dfn'         # Prefix of the cached listing of PATH, only the changed directories are listed again (None: full scan at each run)
+PATH_RECORDS = None                                 # Prefix of the record shards packed by records.py (e.g. '../../output/records/dfn'), read instead of walking PATH and opening the files
 SIZE        = (224,224,3)                           # Size of the input images
 TEST_SPLIT  = 0.1                                   # Train/test ratio
 
 LOAD_NET    = False                                 # Load a network from a saved model? If True NET_NAME and START_EPOCH have to be precised
 NET_NAME    = '2023.11.20.dogfacenet'               # Network saved name
 START_EPOCH = 0                                     # Start the training at a specified epoch
+RESUME      = False                                 # Resume from the last checkpoint of NET_NAME (weights, optimizer, mining and random states)
+CKPT_MAX_TO_KEEP = 3                                # Number of checkpoints kept on disk (at least 1)
+H5_EVERY    = 10                                    # Export the model to PATH_MODEL every H5_EVERY epochs and at the end (0: only at the end)
+NBOF_WORKERS = 1                                    # Number of local data-parallel training processes, each with its own shard of classes (only with HIGH_LEVEL)
 NBOF_EPOCHS = 50                                    # Number of epoch to train the network
 HIGH_LEVEL  = True                                  # Use high level training ('fit' keras method)
 STEPS_PER_EPOCH = 300                               # Number of steps per epoch
 VALIDATION_STEPS = 30
+LOADER_WORKERS = 0                                  # Number of workers decoding and augmenting the pictures (0: done by the generator itself)
+USE_PROCESSES = False                               # Use processes instead of threads for the loader workers
+PREFETCH_DEPTH = 0                                  # Number of batches prepared in advance by a background thread (0: no prefetching)
+EMB_CACHE_MAX_AGE = 0                               # Reuse the mining embeddings for this number of steps (0: predict them at each step)
+EMB_CACHE_REFRESH = 0                               # Number of the oldest cached embeddings refreshed at each step
+AUGMENTATION = 'batch'                              # 'batch': vectorized BatchAugmenter, 'datagen': ImageDataGenerator.flow
+EVAL_TIME_BUDGET = 0                                # Seconds allowed for the verification/identification evaluation at each epoch (0: no evaluation)
+INPUT_PIPELINE = 'generator'                        # 'generator': python generators of online_training, 'tf.data': tf_pipeline datasets (decodes the files, PATH_CACHE is not used)
+PROFILE     = False                                 # Record the time of each stage of the training steps and save it next to the history
+PRECISION   = 'float32'                             # 'float32', 'mixed_float16' or 'mixed_bfloat16' (kept in float32 if the hardware does not support it)
+JIT_COMPILE = False                                 # Compile the train step with XLA
+INPUT_DTYPE = 'float32'                             # Dtype of the pictures fed to a new model: 'float32' in [0,1] or 'uint8' pixels
+LOSS        = 'triplet'                             # 'triplet': [a, p, n] triplets mined by the generators, 'batch_hard' or 'batch_all': mining in the loss on PK batches
+PK_CLASSES  = 10                                    # P: number of classes of a PK batch
+PK_IMAGES   = 3                                     # K: number of pictures per class of a PK batch
+PK_BALANCED = False                                 # Sample the same number of PK groups from each class instead of each picture once per epoch
 
 #----------------------------------------------------------------------------
 # Import the dataset.
 
-assert os.path.isdir(PATH), '[Error] Provided PATH for dataset does not exist.'
-
-print('Loading the dataset...')
+def import_dataset():
+    """
+    File names and labels of the pictures, from the record index if
+    PATH_RECORDS is set (the RecordReader is returned too) or from the
+    manifest of PATH.
+    """
+    print('Loading the dataset...')
 
-filenames = np.empty(0)
-labels = np.empty(0)
-idx = 0
-for root,dirs,files in os.walk(PATH):
-    if len(files)>1:
-        for i in range(len(files)):
-            files[i] = f'{root}/{files[i]}'
-            print(files[i])
-        filenames = np.append(filenames,files)
-        labels = np.append(labels,np.ones(len(files))*idx)
-        idx += 1
-assert len(labels)!=0, '[Error] No data provided.'
+    records = None
+    if PATH_RECORDS is not None:
+        # File names and labels from the record index, the pictures are read from the shards
+        records = RecordReader(PATH_RECORDS)
+        filenames = records.filenames
+        labels = records.labels
+    else:
+        assert os.path.isdir(PATH), '[Error] Provided PATH for dataset does not exist.'
 
-print('Done.')
+        manifest = update_manifest(PATH, PATH_MANIFEST)
+        filenames = manifest.filenames
+        labels = manifest.labels
+    assert len(labels)!=0, '[Error] No data provided.'
 
-print('Total number of imported pictures: {:d}'.format(len(labels)))
+    print('Done.')
 
-nbof_classes = len(np.unique(labels))
-print('Total number of classes: {:d}'.format(nbof_classes))
+    print('Total number of imported pictures: {:d}'.format(len(labels)))
+    print('Total number of classes: {:d}'.format(len(np.unique(labels))))
+    return filenames, labels, records
 
 #----------------------------------------------------------------------------
 # Split the dataset.
 
-nbof_test = int(TEST_SPLIT*nbof_classes)
-
-keep_test = np.less(labels,nbof_test)
-keep_train = np.logical_not(keep_test)
-
-filenames_test = filenames[keep_test]
-labels_test = labels[keep_test]
+def split_dataset(filenames, labels, worker_index=0, nbof_workers=1):
+    """
+    Train/test split by class. With several workers, the training split is
+    reduced to the shard of classes of this worker.
 
-filenames_train = filenames[keep_train]
-labels_train = labels[keep_train]
+    Returns:
+     - (filenames, labels, class_index) of the training split.
+     - (filenames, labels, class_index) of the testing split.
+    """
+    nbof_classes = len(np.unique(labels))
+    nbof_test = int(TEST_SPLIT*nbof_classes)
 
-print("Number of training data: " + str(len(filenames_train)))
-print("Number of training classes: " + str(nbof_classes-nbof_test))
-print("Number of testing data: " + str(len(filenames_test)))
-print("Number of testing classes: " + str(nbof_test))
+    keep_train, keep_test = class_split(labels, TEST_SPLIT)
 
-#----------------------------------------------------------------------------
-# Loss definition.
+    filenames_test = filenames[keep_test]
+    labels_test = labels[keep_test]
 
-alpha = 0.3
+    filenames_train = filenames[keep_train]
+    labels_train = labels[keep_train]
 
+    print("Number of training data: " + str(len(filenames_train)))
+    print("Number of training classes: " + str(nbof_classes-nbof_test))
+    print("Number of testing data: " + str(len(filenames_test)))
+    print("Number of testing classes: " + str(nbof_test))
 
-def triplet(y_true, y_pred):
-    a = y_pred[::3]
-    p = y_pred[1::3]
-    n = y_pred[2::3]
+    # Class indexes, built once for all the generators
+    class_index_train = ClassIndex(labels_train)
+    class_index_test = ClassIndex(labels_test)
 
-    ap = K.sum(K.square(a - p), -1)
-    an = K.sum(K.square(a - n), -1)
+    # Each worker mines its triplets in its own shard of the training classes
+    if nbof_workers > 1:
+        keep_shard, class_index_train = shard_classes(class_index_train, worker_index, nbof_workers)
+        filenames_train = filenames_train[keep_shard]
+        labels_train = labels_train[keep_shard]
+        print('Worker {:d}: {:d} training pictures of {:d} classes'.format(worker_index, len(filenames_train),
+                                                                           len(class_index_train)))
 
-    return K.sum(tf.nn.relu(ap - an + alpha))
+    return (filenames_train, labels_train, class_index_train), (filenames_test, labels_test, class_index_test)
 
+#----------------------------------------------------------------------------
+# Pre-decoded image cache.
 
-def triplet_acc(y_true, y_pred):
-    a = y_pred[::3]
-    p = y_pred[1::3]
-    n = y_pred[2::3]
+def open_cache(filenames, records=None):
+    """
+    Image cache of PATH_CACHE, packed if it does not exist yet. Without
+    PATH_CACHE, the record shards if any.
+    """
+    cache = records
+    if PATH_CACHE is not None:
+        if os.path.isfile(PATH_CACHE + '.images.npy'):
+            print('Opening the image cache {:s} ...'.format(PATH_CACHE))
+            cache = open_image_cache(PATH_CACHE)
+        else:
+            print('Packing the dataset into {:s} ...'.format(PATH_CACHE))
+            cache = pack_images(filenames, PATH_CACHE, SIZE)
+        assert all(f in cache for f in filenames), '[Error] The image cache does not match the dataset, delete it to repack.'
+        print('Done.')
+    return cache
 
-    ap = K.sum(K.square(a - p), -1)
-    an = K.sum(K.square(a - n), -1)
+#----------------------------------------------------------------------------
+# Data pipeline.
 
-    return K.less(ap + alpha, an)
+class DataPipeline(object):
+    """
+    Training and validation data of a worker.
+
+    Args:
+     - train, test: (filenames, labels, class_index) of the splits.
+     - cache: optional ImageCache or RecordReader.
+     - strategy: tf.distribute strategy.
+     - nbof_workers: integer. Number of data-parallel workers.
+     - pk_sampler: PKSampler of the training split, used with the in-graph
+     mining losses.
+    """
 
+    def __init__(self, train, test, cache, strategy, nbof_workers=1, pk_sampler=None):
+        self.filenames_train, self.labels_train, self.class_index_train = train
+        self.filenames_test, self.labels_test, self.class_index_test = test
+        self.cache = cache
+        self.strategy = strategy
+        self.nbof_workers = nbof_workers
+        self.pk_sampler = pk_sampler
+        self.embedding_cache = None
+        self.executor = make_executor(LOADER_WORKERS, USE_PROCESSES)
+        self.augmenter = batch_datagen if AUGMENTATION == 'batch' else datagen
+
+    def prefetch(self, generator):
+        if PREFETCH_DEPTH > 0:
+            return prefetch_generator(generator, PREFETCH_DEPTH)
+        return generator
+
+    def distribute(self, data, batch_size, dtype):
+        """
+        With several workers, feeds the generator or dataset built by data to
+        the replica of this worker.
+        """
+        if self.nbof_workers == 1:
+            return data()
+        group_size = 3 if LOSS == 'triplet' else PK_IMAGES
+        if INPUT_PIPELINE == 'tf.data' and LOSS == 'triplet':
+            return distribute_dataset(self.strategy, data, batch_size, group_size)
+        return distribute_dataset(self.strategy, lambda: generator_dataset(data, batch_size, SIZE, tf.as_dtype(dtype)),
+                                  batch_size, group_size)
+
+    def training_data(self, model, loss, batch_size, nbof_subclasses):
+        """
+        Online adaptive hard triplets, from the python generator or from tf.data.
+        The mining predictions are done by model.
+        With the in-graph mining losses, PK batches from the python generator.
+        """
+        dtype = input_dtype(model)
+        if LOSS != 'triplet':
+            return self.distribute(lambda: self.prefetch(pk_image_generator(
+                self.filenames_train, self.labels_train, datagen=self.augmenter, cache=self.cache,
+                executor=self.executor, dtype=dtype, sampler=self.pk_sampler)), batch_size, dtype)
+        if INPUT_PIPELINE == 'tf.data':
+            return self.distribute(lambda: mined_triplet_dataset(
+                lambda: online_adaptive_hard_triplet_generator(self.filenames_train, self.labels_train, model, loss,
+                                                               batch_size, nbof_subclasses, self.cache,
+                                                               self.class_index_train, self.executor,
+                                                               self.embedding_cache),
+                batch_size, dtype=tf.as_dtype(dtype)), batch_size, dtype)
+        return self.distribute(lambda: self.prefetch(online_adaptive_hard_image_generator(
+            self.filenames_train, self.labels_train, model, loss, batch_size, nbof_subclasses=nbof_subclasses,
+            datagen=self.augmenter, cache=self.cache, class_index=self.class_index_train, executor=self.executor,
+            embedding_cache=self.embedding_cache)), batch_size, dtype)
+
+    def validation_data(self, batch_size, dtype=np.float32):
+        """
+        Soft triplets without augmentation, from the python generator or from tf.data.
+        With the in-graph mining losses, PK batches from the python generator.
+        """
+        if LOSS != 'triplet':
+            return self.distribute(lambda: self.prefetch(pk_image_generator(
+                self.filenames_test, self.labels_test, PK_CLASSES, PK_IMAGES, use_aug=False, cache=self.cache,
+                class_index=self.class_index_test, executor=self.executor, dtype=dtype)), batch_size, dtype)
+        if INPUT_PIPELINE == 'tf.data':
+            return self.distribute(lambda: triplet_dataset(self.filenames_test, self.labels_test, batch_size,
+                                                           use_aug=False, class_index=self.class_index_test,
+                                                           dtype=tf.as_dtype(dtype)),
+                                   batch_size, dtype)
+        return self.distribute(lambda: self.prefetch(image_generator(
+            self.filenames_test, self.labels_test, batch_size, use_aug=False, cache=self.cache,
+            class_index=self.class_index_test, executor=self.executor, dtype=dtype)), batch_size, dtype)
 
 # ----------------------------------------------------------------------------
 # Model definition.
 
-if LOAD_NET:
-    print('Loading model from {:s}{:s}.{:d}.h5 ...'.format(PATH_MODEL, NET_NAME, START_EPOCH))
-
-    model = tf.keras.models.load_model(
-        '{:s}{:s}.{:d}.h5'.format(PATH_MODEL, NET_NAME, START_EPOCH),
-        custom_objects={'triplet': triplet, 'triplet_acc': triplet_acc})
-
-else:
-    from tensorflow.keras import Model
-    from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Add, GlobalAveragePooling2D, DepthwiseConv2D
-    from tensorflow.keras.layers import Activation, Dropout, Flatten, Dense, Lambda, BatchNormalization
-
+def build_model(strategy, loss_fn, acc_fn):
     """
-    Model number 12: Paper version: a modified ResNet with Dropout layers and without bottleneck layers
+    Loads NET_NAME at START_EPOCH if LOAD_NET, or defines a new dogfacenet,
+    compiled for the chosen loss under the strategy scope.
     """
+    # The variables of the model are mirrored on the workers
+    with strategy.scope():
+        if LOAD_NET:
+            print('Loading model from {:s}{:s}.{:d}.h5 ...'.format(PATH_MODEL, NET_NAME, START_EPOCH))
 
-    print('Defining model {:s} ...'.format(NET_NAME))
-
-    emb_size = 32
+            model = tf.keras.models.load_model(
+                '{:s}{:s}.{:d}.h5'.format(PATH_MODEL, NET_NAME, START_EPOCH),
+                custom_objects=custom_objects)
 
-    inputs = Input(shape=SIZE)
+            # Recompiled with the saved optimizer for the chosen loss and XLA mode
+            model.compile(loss=loss_fn,
+                          optimizer=model.optimizer,
+                          metrics=[acc_fn],
+                          jit_compile=JIT_COMPILE)
 
-    x = Conv2D(16, (7, 7), (2, 2), use_bias=False, activation='relu', padding='same')(inputs)
-    x = BatchNormalization()(x)
-    x = MaxPooling2D((3, 3))(x)
+        else:
+            print('Defining model {:s} ...'.format(NET_NAME))
 
-    for layer in [16, 32, 64, 128, 512]:
-        x = Conv2D(layer, (3, 3), strides=(2, 2), use_bias=False, activation='relu', padding='same')(x)
-        r = BatchNormalization()(x)
+            model = build_dogfacenet(SIZE, emb_size=32, input_dtype=INPUT_DTYPE)
 
-        x = Conv2D(layer, (3, 3), use_bias=False, activation='relu', padding='same')(r)
-        x = BatchNormalization()(x)
-        r = Add()([r, x])
+            model.compile(loss=loss_fn,
+                          optimizer='adam',
+                          metrics=[acc_fn],
+                          jit_compile=JIT_COMPILE)
 
-        x = Conv2D(layer, (3, 3), use_bias=False, activation='relu', padding='same')(r)
-        x = BatchNormalization()(x)
-        x = Add()([r, x])
+    print('Done.')
+    print(model.summary())
+    return model
 
-    x = GlobalAveragePooling2D()(x)
-    x = Flatten()(x)
-    x = Dropout(0.5)(x)
-    x = Dense(emb_size, use_bias=False)(x)
-    outputs = Lambda(lambda x: tf.nn.l2_normalize(x, axis=-1))(x)
-
-    model = tf.keras.Model(inputs, outputs)
-
-    model.compile(loss=triplet,
-                  optimizer='adam',
-                  metrics=[triplet_acc])
-
-print('Done.')
-print(model.summary())
-
-batch_size = 3 * 10
 # ----------------------------------------------------------------------------
 # Model training.
 
-if HIGH_LEVEL:
+def train_high_level(model, predictor, data, manager, callbacks, evaluation, acc_fn, batch_size, end_epoch):
     """
     Hard training: high level of implementation
     """
-
-    histories = []
+    start_epoch = START_EPOCH
     crt_loss = 0.6
     crt_acc = 0
     nbof_subclasses = 40
@@ -181,17 +301,32 @@ if HIGH_LEVEL:
         os.makedirs(PATH_SAVE)
 
     # Bug fixed: keras models are to be initialized by a training on a single batch
-    for images_batch, labels_batch in online_adaptive_hard_image_generator(
-            filenames_train,
-            labels_train,
-            model,
-            crt_acc,
-            batch_size,
-            nbof_subclasses=nbof_subclasses):
-        h = model.train_on_batch(images_batch, labels_batch)
-        break
-
-    for i in range(START_EPOCH, START_EPOCH + NBOF_EPOCHS):
+    # (a PK batch with the in-graph mining losses). With several workers, the step goes
+    # through the distributed dataset so that the gradients are all-reduced like in fit
+    warmup_data = data.training_data(predictor, crt_acc, batch_size, nbof_subclasses)
+    if data.nbof_workers > 1:
+        model.fit(warmup_data, steps_per_epoch=1, epochs=1, verbose=0)
+    else:
+        for images_batch, labels_batch in warmup_data:
+            h = model.train_on_batch(images_batch, labels_batch)
+            break
+    if predictor is not model:
+        predictor.sync(model)
+
+    if RESUME:
+        state = manager.restore(model)
+        if state is not None:
+            print('Resuming from the checkpoint of epoch {:d}'.format(state['epoch']))
+            start_epoch = state['epoch'] + 1
+            crt_loss = state['crt_loss']
+            crt_acc = state['crt_acc']
+            # Cursor saved by this worker, see CheckpointManager.restore
+            if LOSS != 'triplet' and 'pk_sampler' in state:
+                data.pk_sampler.epoch, data.pk_sampler.position = state['pk_sampler']
+            if predictor is not model:
+                predictor.sync(model)
+
+    for i in range(start_epoch, end_epoch):
         print(f"Beginning epoch number: {str(i)}")
 
         hard_triplet_ratio = np.exp(-crt_loss * 10 / batch_size)
@@ -199,41 +334,40 @@ if HIGH_LEVEL:
 
         print(f"Current hard triplet ratio: {str(hard_triplet_ratio)}")
 
-        histories += [model.fit(
-            online_adaptive_hard_image_generator(filenames_train, labels_train, model, crt_loss, batch_size,
-                                                 nbof_subclasses=nbof_subclasses),
+        history = model.fit(
+            data.training_data(predictor, crt_loss, batch_size, nbof_subclasses),
             steps_per_epoch=STEPS_PER_EPOCH,
-            epochs=1,
-            validation_data=image_generator(filenames_test, labels_test, batch_size, use_aug=False),
-            validation_steps=VALIDATION_STEPS)]
-
-        crt_loss = histories[-1].history['loss'][0]
-        crt_acc = histories[-1].history['triplet_acc'][0]
-
-        # Save model
-        model.save('{:s}{:s}.{:d}.h5'.format(PATH_MODEL, NET_NAME, i))
-
-        # Save history
-        loss = np.empty(0)
-        val_loss = np.empty(0)
-        acc = np.empty(0)
-        val_acc = np.empty(0)
-
-        for history in histories:
-            loss = np.append(loss, history.history['loss'])
-            val_loss = np.append(val_loss, history.history['val_loss'])
-            acc = np.append(acc, history.history['triplet_acc'])
-            val_acc = np.append(val_acc, history.history['val_triplet_acc'])
-
-        history_ = np.array([loss, val_loss, acc, val_acc])
-        np.save('{:s}{:s}.{:d}.npy'.format(PATH_SAVE, NET_NAME, i), history_)
-
-else:
+            initial_epoch=i,
+            epochs=i + 1,
+            validation_data=data.validation_data(batch_size, input_dtype(model)),
+            validation_steps=VALIDATION_STEPS,
+            callbacks=callbacks)
+
+        crt_loss = history.history['loss'][0]
+        crt_acc = history.history[acc_fn.__name__][0]
+
+        if data.nbof_workers > 1 and evaluation is not None:
+            predictor.sync(model)
+            evaluation.on_epoch_end(i)
+
+        # Save checkpoint and history
+        manager.append_history(loss=crt_loss, val_loss=history.history['val_loss'][0], acc=crt_acc,
+                               val_acc=history.history['val_' + acc_fn.__name__][0])
+        # The chief saves the model, every worker its own generators and sampler cursor
+        state = {'crt_loss': float(crt_loss), 'crt_acc': float(crt_acc)}
+        worker_state = None
+        if LOSS != 'triplet':
+            worker_state = {'pk_sampler': [data.pk_sampler.epoch, data.pk_sampler.position]}
+        manager.save(i, model, state, worker_state)
+
+
+def train_low_level(model, data, manager, timing, evaluation, batch_size, end_epoch):
     """
-    Training: lower level of implementation
+    Training: lower level of implementation, on a single worker: the raw
+    train_on_batch steps are not distributed (see main)
     """
-
-    max_epoch = NBOF_EPOCHS + START_EPOCH
+    start_epoch = START_EPOCH
+    max_epoch = end_epoch
 
     max_step = 300
     max_step_test = 30
@@ -243,13 +377,13 @@ else:
     tot_acc_test = 0
     mean_acc_test = 0
 
-    # Save
-    loss = []
-    val_loss = []
-    acc = []
-    val_acc = []
+    if RESUME:
+        state = manager.restore(model)
+        if state is not None:
+            print('Resuming from the checkpoint of epoch {:d}'.format(state['epoch']))
+            start_epoch = state['epoch'] + 1
 
-    for epoch in range(START_EPOCH, max_epoch):
+    for epoch in range(start_epoch, max_epoch):
 
         step = 1
 
@@ -259,17 +393,17 @@ else:
         tot_acc = 0
         mean_acc = 0
 
+        if timing is not None:
+            timing.on_epoch_begin(epoch)
+
         # Training
-        for images_batch, labels_batch in online_adaptive_hard_image_generator(
-                filenames_train,
-                labels_train,
-                model,
-                mean_acc,
-                batch_size,
-                nbof_subclasses=10
-        ):
+        for images_batch, labels_batch in data.training_data(model, mean_acc, batch_size, 10):
 
+            if timing is not None:
+                timing.on_train_batch_begin(step)
             h = model.train_on_batch(images_batch, labels_batch)
+            if timing is not None:
+                timing.on_train_batch_end(step)
             tot_loss += h[0]
             mean_loss = tot_loss / step
             tot_acc += h[1]
@@ -288,8 +422,12 @@ else:
                 break
             step += 1
 
-        loss += [mean_loss]
-        acc += [mean_acc]
+        if data.embedding_cache is not None:
+            print(f"Embedding cache: {data.embedding_cache.stats()}")
+            data.embedding_cache.reset_stats()
+
+        if timing is not None:
+            timing.on_epoch_end(epoch)
 
         # Testing
         step = 1
@@ -300,7 +438,7 @@ else:
         tot_acc_test = 0
         mean_acc_test = 0
 
-        for images_batch, labels_batch in image_generator(filenames_test, labels_test, batch_size, use_aug=False):
+        for images_batch, labels_batch in data.validation_data(batch_size, input_dtype(model)):
             h = model.test_on_batch(images_batch, labels_batch)
 
             tot_loss_test += h[0]
@@ -312,10 +450,99 @@ else:
                 break
             step += 1
 
-        val_loss += [mean_loss_test]
-        val_acc += [mean_acc_test]
+        if evaluation is not None:
+            evaluation.on_epoch_end(epoch)
 
-        # Save
-        model.save('{:s}{:s}.{:d}.h5'.format(PATH_MODEL, NET_NAME, epoch))
-        history_ = np.array([loss, val_loss, acc, val_acc])
-        np.save('{:s}{:s}.{:d}.npy'.format(PATH_SAVE, NET_NAME, epoch), history_)
\ No newline at end of file
+        # Save checkpoint and history
+        manager.append_history(loss=mean_loss, val_loss=mean_loss_test, acc=mean_acc, val_acc=mean_acc_test)
+        manager.save(epoch, model)
+
+#----------------------------------------------------------------------------
+# Main.
+
+def main():
+    # Data-parallel workers: the script is run again in NBOF_WORKERS processes, which receive a TF_CONFIG
+    if NBOF_WORKERS > 1 and 'TF_CONFIG' not in os.environ:
+        sys.exit(launch_workers(__file__, NBOF_WORKERS))
+
+    strategy = make_strategy()
+    worker_index, nbof_workers = worker_info()
+    is_chief = worker_index == 0
+    if nbof_workers > 1:
+        assert HIGH_LEVEL, '[Error] Data-parallel training needs HIGH_LEVEL = True.'
+        # Each worker samples its own triplets
+        np.random.seed(worker_index)
+        print('Worker {:d}/{:d}'.format(worker_index, nbof_workers))
+
+    filenames, labels, records = import_dataset()
+    train, test = split_dataset(filenames, labels, worker_index, nbof_workers)
+
+    # PK samplers of the in-graph mining losses, the training one goes on from epoch to epoch
+    pk_sampler_train = None
+    if LOSS != 'triplet':
+        pk_sampler_train = PKSampler(train[2], PK_CLASSES, PK_IMAGES, 'balanced' if PK_BALANCED else None,
+                                     seed=worker_index)
+        print('Number of PK batches per sampler epoch: {:d}'.format(len(pk_sampler_train)))
+
+    data = DataPipeline(train, test, open_cache(filenames, records), strategy, nbof_workers, pk_sampler_train)
+    loss_fn, acc_fn = LOSSES[LOSS]
+
+    # The policy applies to the models defined from now on
+    precision = set_precision(PRECISION)
+    print('Training precision: {:s}'.format(precision))
+    model = build_model(strategy, loss_fn, acc_fn)
+
+    # Model used for the mining predictions: with several workers, a local copy synced after each step
+    predictor = model
+    if nbof_workers > 1:
+        predictor = LocalPredictor(build_dogfacenet(SIZE, model.output_shape[-1],
+                                                    'uint8' if input_dtype(model) == np.uint8 else 'float32'))
+        predictor.sync(model)
+
+    callbacks = [] if predictor is model else [predictor]
+    if EMB_CACHE_MAX_AGE > 0:
+        data.embedding_cache = EmbeddingCache(len(data.filenames_train), model.output_shape[-1], EMB_CACHE_MAX_AGE,
+                                              EMB_CACHE_REFRESH)
+        callbacks += [EmbeddingCacheLogger(data.embedding_cache)]
+
+    evaluation = None
+    if EVAL_TIME_BUDGET > 0:
+        evaluation = EvaluationCallback(data.filenames_test, data.labels_test, PATH_SAVE, NET_NAME, EVAL_TIME_BUDGET,
+                                        cache=data.cache, executor=data.executor)
+        if nbof_workers == 1:
+            evaluation.set_model(model)
+            callbacks += [evaluation]
+        elif is_chief:
+            # Evaluated by the chief only, with the local copy of the model (see train_high_level)
+            evaluation.set_model(predictor.local_model)
+        else:
+            evaluation = None
+
+    timing = None
+    if PROFILE:
+        profiler.enabled = True
+        timing = StageTimingCallback(profiler, PATH_SAVE, NET_NAME)
+        timing.set_model(model)
+        callbacks += [timing]
+
+    # Checkpoints are written in the background at the end of each epoch
+    manager = CheckpointManager(PATH_CKPT, NET_NAME, PATH_SAVE, CKPT_MAX_TO_KEEP, PATH_MODEL, H5_EVERY,
+                                rngs={'augmenter': data.augmenter.rng} if isinstance(data.augmenter, BatchAugmenter)
+                                else None, worker_index=worker_index)
+    end_epoch = START_EPOCH + NBOF_EPOCHS
+
+    batch_size = 3 * 10 if LOSS == 'triplet' else PK_CLASSES * PK_IMAGES
+
+    if HIGH_LEVEL:
+        train_high_level(model, predictor, data, manager, callbacks, evaluation, acc_fn, batch_size, end_epoch)
+    else:
+        train_low_level(model, data, manager, timing, evaluation, batch_size, end_epoch)
+
+    # Waits for the last checkpoint and exports the final model
+    manager.close()
+    if is_chief and (H5_EVERY == 0 or end_epoch % H5_EVERY != 0):
+        manager.export_h5(end_epoch - 1, model)
+
+
+if __name__ == '__main__':
+    main()
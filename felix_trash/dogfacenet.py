@@ -0,0 +1,57 @@
+"""
+DogFaceNet
+Definition of the dogfacenet model.
+Model number 12: Paper version: a modified ResNet with Dropout layers and without bottleneck layers.
+Under a mixed precision policy (see precision.set_precision) the
+convolutions run in half precision while the last Dense layer and the
+l2-normalization stay in float32.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Add, GlobalAveragePooling2D
+from tensorflow.keras.layers import Dropout, Flatten, Dense, Lambda, BatchNormalization, Rescaling
+
+SIZE = (224, 224, 3)
+
+
+def build_dogfacenet(input_shape=SIZE, emb_size=32, input_dtype='float32'):
+    """
+    Builds the (not compiled) dogfacenet model.
+
+    Args:
+     - input_shape: tuple (h, w, c). Size of the input images.
+     - emb_size: integer. Size of the L2-normalized embeddings.
+     - input_dtype: 'float32' for pictures in [0,1] or 'uint8' for raw
+     pixels, scaled to [0,1] by the model.
+    Returns:
+     - a keras Model.
+    """
+    assert input_dtype in ('float32', 'uint8'), '[Error] Unknown input dtype {:s}.'.format(input_dtype)
+    inputs = Input(shape=input_shape, dtype=input_dtype)
+    x = Rescaling(1. / 255.)(inputs) if input_dtype == 'uint8' else inputs
+
+    x = Conv2D(16, (7, 7), (2, 2), use_bias=False, activation='relu', padding='same')(x)
+    x = BatchNormalization()(x)
+    x = MaxPooling2D((3, 3))(x)
+
+    for layer in [16, 32, 64, 128, 512]:
+        x = Conv2D(layer, (3, 3), strides=(2, 2), use_bias=False, activation='relu', padding='same')(x)
+        r = BatchNormalization()(x)
+
+        x = Conv2D(layer, (3, 3), use_bias=False, activation='relu', padding='same')(r)
+        x = BatchNormalization()(x)
+        r = Add()([r, x])
+
+        x = Conv2D(layer, (3, 3), use_bias=False, activation='relu', padding='same')(r)
+        x = BatchNormalization()(x)
+        x = Add()([r, x])
+
+    x = GlobalAveragePooling2D()(x)
+    x = Flatten()(x)
+    x = Dropout(0.5)(x)
+    x = Dense(emb_size, use_bias=False, dtype='float32')(x)
+    outputs = Lambda(lambda x: tf.nn.l2_normalize(x, axis=-1), dtype='float32')(x)
+
+    return tf.keras.Model(inputs, outputs)
@@ -0,0 +1,207 @@
+"""
+DogFaceNet
+Lightweight inference entry point.
+Only numpy is imported with this module: tensorflow (or tflite_runtime for
+a .tflite model, see tflite_export.py) and the picture decoder are
+imported when the model is loaded, and nothing from the training code
+(online_training, offline_training, dogface) is imported. The keras
+models are loaded without their optimizer and loss. The command line
+reports the cold start: the time from the import of this module to the
+first embedding, split into imports, model loading and first batch.
+
+Usage:
+    embedder = Embedder('../../output/model/2023.11.20.dogfacenet.49.h5')
+    embeddings = embedder.embed_files(['dog_0.jpg', 'dog_1.jpg'])
+    python embedder.py --model ../../output/model/2023.11.20.dogfacenet.49.h5 dog_0.jpg dog_1.jpg
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+
+_START = time.perf_counter()
+
+import io
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+def _tflite_interpreter(path, num_threads=None):
+    # The standalone runtime avoids importing the whole tensorflow
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=path, num_threads=num_threads)
+
+
+class TFLiteEmbedder(object):
+    """
+    Runs a TFLite dogfacenet on batches of pictures.
+
+    Args:
+     - path: path of the .tflite file.
+     - num_threads: integer. Number of CPU threads of the interpreter.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.interpreter = _tflite_interpreter(path, num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    @property
+    def input_shape(self):
+        return tuple(int(d) for d in self.input['shape'][1:])
+
+    @property
+    def input_dtype(self):
+        return np.uint8 if self.input['dtype'] == np.uint8 else np.float32
+
+    def _resize(self, batch_size):
+        if batch_size != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], [batch_size] + list(self.input['shape'][1:]))
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict_on_batch(self, images):
+        self._resize(len(images))
+        scale, zero_point = self.input['quantization']
+        if scale and self.input['dtype'] != images.dtype:
+            info = np.iinfo(self.input['dtype'])
+            images = np.clip(np.round(images / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(self.input['index'], images.astype(self.input['dtype']))
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output['index'])
+        scale, zero_point = self.output['quantization']
+        if scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+class KerasEmbedder(object):
+    """
+    Runs a saved keras dogfacenet (.h5) on batches of pictures, loaded
+    without its optimizer and loss.
+    """
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+        if num_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        self.model = tf.keras.models.load_model(path, compile=False)
+
+    @property
+    def input_shape(self):
+        return tuple(self.model.input_shape[1:])
+
+    @property
+    def input_dtype(self):
+        return np.uint8 if self.model.inputs[0].dtype == 'uint8' else np.float32
+
+    def predict_on_batch(self, images):
+        return np.asarray(self.model(images, training=False))
+
+
+def decode_image(blob, size, dtype=np.float32):
+    """
+    Decodes an encoded picture (JPEG, PNG, ...) with PIL, resized to size
+    if needed, in [0,1] as float32 or as uint8 pixels.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(blob)).convert('RGB')
+    h, w, _ = size
+    if image.size != (w, h):
+        image = image.resize((w, h), Image.BILINEAR)
+    image = np.asarray(image)
+    if dtype == np.uint8:
+        return image
+    return image.astype(dtype) / np.asarray(255.0, dtype=dtype)
+
+
+class Embedder(object):
+    """
+    Embeds pictures with a dogfacenet model.
+
+    Args:
+     - path: path of a saved .h5 or .tflite model.
+     - batch_size: integer. Maximum number of pictures per forward pass.
+     - num_threads: integer. Number of CPU threads, default of the runtime if None.
+    """
+
+    def __init__(self, path, batch_size=64, num_threads=None):
+        assert os.path.isfile(path), '[Error] Model {:s} does not exist.'.format(path)
+        if path.endswith('.tflite'):
+            self.model = TFLiteEmbedder(path, num_threads)
+        else:
+            self.model = KerasEmbedder(path, num_threads)
+        self.batch_size = batch_size
+
+    def embed(self, images):
+        """
+        Embeddings of an array of decoded pictures, as float32.
+        """
+        if len(images) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate([self.model.predict_on_batch(images[i:i + self.batch_size])
+                               for i in range(0, len(images), self.batch_size)]).astype(np.float32, copy=False)
+
+    def embed_blobs(self, blobs):
+        """
+        Embeddings of encoded pictures (bytes).
+        """
+        if len(blobs) == 0:
+            return self.embed([])
+        size, dtype = self.model.input_shape, self.model.input_dtype
+        return self.embed(np.stack([decode_image(blob, size, dtype) for blob in blobs]))
+
+    def embed_files(self, filenames):
+        """
+        Embeddings of picture files.
+        """
+        blobs = []
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                blobs += [f.read()]
+        return self.embed_blobs(blobs)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='DogFaceNet embeddings of picture files.')
+    parser.add_argument('--model', required=True, help='path to a saved dogfacenet .h5 or .tflite model')
+    parser.add_argument('--out', default=None, help='.npy file of the embeddings, printed if not given')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('files', nargs='+', help='picture files')
+    args = parser.parse_args(args)
+
+    timings = {'imports_s': time.perf_counter() - _START}
+    start = time.perf_counter()
+    embedder = Embedder(args.model, args.batch_size, args.threads)
+    timings['model_load_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first = embedder.embed_files(args.files[:1])
+    timings['first_embedding_s'] = time.perf_counter() - start
+    timings['cold_start_s'] = time.perf_counter() - _START
+
+    start = time.perf_counter()
+    embeddings = np.concatenate((first, embedder.embed_files(args.files[1:]))) if len(args.files) > 1 else first
+    if len(args.files) > 1:
+        timings['images_per_sec'] = (len(args.files) - 1) / (time.perf_counter() - start)
+
+    if args.out is not None:
+        np.save(args.out, embeddings)
+    else:
+        for filename, embedding in zip(args.files, embeddings):
+            print(filename, ' '.join('{:.6f}'.format(x) for x in embedding))
+    print(json.dumps(timings, indent=2))
+
+
+if __name__ == '__main__':
+    main()
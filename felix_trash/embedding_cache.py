@@ -0,0 +1,107 @@
+"""
+DogFaceNet
+Embedding cache for online hard mining.
+Keeps the last predicted embedding of every picture of the training set
+with the step at which it was computed. The online generators read the
+embeddings of the sampled subclasses from it and only predict again the
+entries older than max_age steps, plus optionally a few of the oldest
+ones at each step (rolling refresh). A larger max_age trades mining
+quality for fewer forward passes.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+class EmbeddingCache(object):
+    """
+    Per-picture embedding store with a staleness budget.
+
+    Args:
+     - nbof_images: integer. Number of pictures, the pictures are referred
+     to by their index in the filenames array of the generator.
+     - emb_size: integer. Size of the embeddings.
+     - max_age: integer. An embedding computed more than max_age steps ago
+     is predicted again. 0 refreshes everything at each step.
+     - refresh_per_step: integer. Number of the oldest, still valid,
+     requested embeddings additionally refreshed at each step.
+    """
+
+    def __init__(self, nbof_images, emb_size=32, max_age=100, refresh_per_step=0):
+        self.embeddings = np.zeros((nbof_images, emb_size), dtype=np.float32)
+        self.refreshed_at = np.full(nbof_images, -1, dtype=np.int64)
+        self.max_age = max_age
+        self.refresh_per_step = refresh_per_step
+        self.step = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nbof_requested = 0
+        self.nbof_refreshed = 0
+        self.nbof_steps = 0
+
+    def stats(self):
+        """
+        Counters since the last reset_stats: hit rate, number of requested
+        and refreshed embeddings, number of steps.
+        """
+        hit_rate = 1. - self.nbof_refreshed / self.nbof_requested if self.nbof_requested else 0.
+        return {
+            'hit_rate': hit_rate,
+            'requested': self.nbof_requested,
+            'refreshed': self.nbof_refreshed,
+            'steps': self.nbof_steps}
+
+    def lookup(self, idx, predict_fn):
+        """
+        Returns the embeddings of the pictures idx, predicting the stale ones.
+
+        Args:
+         - idx: array of integers. Indices of the pictures.
+         - predict_fn: function taking an array of picture indices and
+         returning their embeddings.
+        Returns:
+         - array of shape (len(idx), emb_size).
+        """
+        age = self.step - self.refreshed_at[idx]
+        refresh = np.logical_or(self.refreshed_at[idx] < 0, age > self.max_age)
+
+        # Rolling refresh of the oldest valid entries
+        valid = np.flatnonzero(np.logical_not(refresh))
+        if self.refresh_per_step > 0 and len(valid) > 0:
+            k = min(self.refresh_per_step, len(valid))
+            oldest = valid[np.argpartition(-age[valid], k - 1)[:k]]
+            refresh[oldest] = True
+
+        to_refresh = idx[refresh]
+        if len(to_refresh) > 0:
+            self.embeddings[to_refresh] = predict_fn(to_refresh)
+            self.refreshed_at[to_refresh] = self.step
+
+        self.nbof_requested += len(idx)
+        self.nbof_refreshed += len(to_refresh)
+        self.nbof_steps += 1
+        self.step += 1
+        return self.embeddings[idx]
+
+
+class EmbeddingCacheLogger(tf.keras.callbacks.Callback):
+    """
+    Prints the embedding cache counters at the end of each epoch, adds them
+    to the logs (hence to the History) and resets them.
+    """
+
+    def __init__(self, cache):
+        super(EmbeddingCacheLogger, self).__init__()
+        self.cache = cache
+
+    def on_epoch_end(self, epoch, logs=None):
+        stats = self.cache.stats()
+        print('Embedding cache: hit rate {:.3f}, {:d} refreshed / {:d} requested in {:d} steps'.format(
+            stats['hit_rate'], stats['refreshed'], stats['requested'], stats['steps']))
+        if logs is not None:
+            logs['emb_cache_hit_rate'] = stats['hit_rate']
+            logs['emb_cache_refreshed'] = stats['refreshed']
+        self.cache.reset_stats()
@@ -0,0 +1,184 @@
+"""
+DogFaceNet
+Verification and identification evaluation.
+The test pictures are embedded once, then all the pairs are evaluated from
+the distance matrix, computed by blocks of rows so the memory does not
+grow with the square of the number of pictures:
+ - Verification: ROC curve, AUC and TAR@FAR over all the pairs. The
+ distances of the genuine (same dog) and impostor pairs are accumulated in
+ histograms, the ROC is read from their cumulative sums.
+ - Identification: top-k accuracy, each picture is a query against all the
+ other ones (leave-one-out).
+EvaluationCallback runs it at the end of each epoch within a time budget
+and writes the results next to the history files.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import json
+import time
+import numpy as np
+import tensorflow as tf
+
+from gallery import squared_distances
+
+
+def verification_metrics(embeddings, labels, far_targets=(1e-4, 1e-3, 1e-2, 1e-1), nbof_bins=4096,
+                         block_size=2048):
+    """
+    ROC over all the pairs of pictures.
+
+    Args:
+     - embeddings: array of shape (n, emb_size).
+     - labels: array of size n.
+     - far_targets: false accept rates at which the true accept rate is reported.
+     - nbof_bins: integer. Resolution of the distance thresholds.
+     - block_size: integer. Number of rows of the distance matrix per block.
+    Returns:
+     - dictionary with auc, tar@far=..., eer and the roc curve (far, tar, thresholds).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels)
+    sq_norms = np.sum(np.square(embeddings), axis=-1)
+    max_dist = 4. * float(np.max(sq_norms)) if len(sq_norms) else 4.
+    scale = nbof_bins / max_dist
+
+    genuine = np.zeros(nbof_bins, dtype=np.int64)
+    impostor = np.zeros(nbof_bins, dtype=np.int64)
+    n = len(embeddings)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        # Pairs (i, j) with i in the block and j > i
+        dist = squared_distances(embeddings[start:end], embeddings[start:], sq_norms[start:])
+        upper = np.arange(start, n)[None, :] > np.arange(start, end)[:, None]
+        same = np.equal(labels[start:end, None], labels[None, start:])
+        bins = np.minimum((dist * scale).astype(np.int64), nbof_bins - 1)
+        genuine += np.bincount(bins[np.logical_and(upper, same)], minlength=nbof_bins)
+        impostor += np.bincount(bins[np.logical_and(upper, np.logical_not(same))], minlength=nbof_bins)
+
+    # A pair is accepted if its distance is below the threshold
+    thresholds = np.arange(1, nbof_bins + 1) / scale
+    tar = np.cumsum(genuine) / max(1, np.sum(genuine))
+    far = np.cumsum(impostor) / max(1, np.sum(impostor))
+    roc_far = np.concatenate(([0.], far))
+    roc_tar = np.concatenate(([0.], tar))
+    auc = float(np.sum(np.diff(roc_far) * (roc_tar[1:] + roc_tar[:-1]) / 2.))
+
+    metrics = {'auc': auc, 'nbof_genuine_pairs': int(np.sum(genuine)), 'nbof_impostor_pairs': int(np.sum(impostor))}
+    for target in far_targets:
+        below = np.flatnonzero(far <= target)
+        metrics['tar@far={:g}'.format(target)] = float(tar[below[-1]]) if len(below) else 0.
+    eer_idx = np.argmin(np.abs((1. - tar) - far))
+    metrics['eer'] = float((1. - tar[eer_idx] + far[eer_idx]) / 2.)
+    metrics['roc'] = {'far': far, 'tar': tar, 'thresholds': thresholds}
+    return metrics
+
+
+def identification_metrics(embeddings, labels, ks=(1, 5), block_size=2048):
+    """
+    Leave-one-out top-k identification accuracy: each picture is searched
+    among all the other ones, it is correctly identified at rank k if one of
+    its k nearest neighbours has its label. Only the pictures with at least
+    one other picture of the same dog are used as queries.
+
+    Returns:
+     - dictionary with top1, top5, ... accuracies and the number of queries.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    has_pair = counts[inverse.ravel()] > 1
+    max_k = min(max(ks), len(embeddings) - 1)
+    sq_norms = np.sum(np.square(embeddings), axis=-1)
+
+    correct = {k: 0 for k in ks}
+    for start in range(0, len(embeddings), block_size):
+        end = min(start + block_size, len(embeddings))
+        queries = np.flatnonzero(has_pair[start:end]) + start
+        if len(queries) == 0:
+            continue
+        dist = squared_distances(embeddings[queries], embeddings, sq_norms)
+        dist[np.arange(len(queries)), queries] = np.inf
+        neighbours = np.argpartition(dist, max_k - 1, axis=-1)[:, :max_k]
+        order = np.argsort(np.take_along_axis(dist, neighbours, axis=-1), axis=-1, kind='stable')
+        neighbours = np.take_along_axis(neighbours, order, axis=-1)
+        hits = np.equal(labels[neighbours], labels[queries, None])
+        for k in ks:
+            correct[k] += int(np.sum(np.any(hits[:, :k], axis=-1)))
+
+    nbof_queries = int(np.sum(has_pair))
+    metrics = {'top{:d}'.format(k): correct[k] / max(1, nbof_queries) for k in ks}
+    metrics['nbof_queries'] = nbof_queries
+    return metrics
+
+
+def evaluate_embeddings(embeddings, labels, far_targets=(1e-4, 1e-3, 1e-2, 1e-1), ks=(1, 5), block_size=2048):
+    """
+    Verification and identification metrics of embeddings, without the roc curve.
+    """
+    metrics = verification_metrics(embeddings, labels, far_targets, block_size=block_size)
+    del metrics['roc']
+    metrics.update(identification_metrics(embeddings, labels, ks, block_size))
+    metrics['nbof_images'] = len(embeddings)
+    return metrics
+
+
+def evaluate(model, filenames, labels, batch_size=128, cache=None, executor=None, **kwargs):
+    """
+    Embeds the pictures with the model and evaluates the embeddings.
+    """
+    from online_training import predict_embeddings
+
+    embeddings = predict_embeddings(model, filenames, batch_size, cache, executor)
+    return evaluate_embeddings(embeddings, labels, **kwargs)
+
+
+class EvaluationCallback(tf.keras.callbacks.Callback):
+    """
+    Evaluates the model on a test split at the end of each epoch and writes
+    the metrics to path_save/net_name.epoch.eval.json.
+    If an evaluation takes longer than time_budget seconds, the next ones
+    use a fixed random subset of the test pictures small enough to fit in it.
+
+    Args:
+     - filenames, labels: test split.
+     - path_save: directory of the history files.
+     - net_name: network saved name.
+     - time_budget: float. Seconds allowed per evaluation.
+     - max_images: integer. Initial maximum number of evaluated pictures, None for all.
+    """
+
+    def __init__(self, filenames, labels, path_save, net_name, time_budget=60., max_images=None, batch_size=128,
+                 cache=None, executor=None, seed=0):
+        super(EvaluationCallback, self).__init__()
+        self.filenames = np.asarray(filenames)
+        self.labels = np.asarray(labels)
+        self.path_save = path_save
+        self.net_name = net_name
+        self.time_budget = time_budget
+        self.max_images = len(self.filenames) if max_images is None else max_images
+        self.batch_size = batch_size
+        self.cache = cache
+        self.executor = executor
+        self.permutation = np.random.RandomState(seed).permutation(len(self.filenames))
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+        keep = np.sort(self.permutation[:self.max_images])
+        metrics = evaluate(self.model, self.filenames[keep], self.labels[keep], self.batch_size, self.cache,
+                           self.executor)
+        elapsed = time.time() - start
+        metrics['time'] = elapsed
+
+        with open('{:s}{:s}.{:d}.eval.json'.format(self.path_save, self.net_name, epoch), 'w') as f:
+            json.dump(metrics, f, indent=2)
+        print('Evaluation on {:d} pictures ({:.1f}s): auc {:.4f}, tar@far=0.001 {:.4f}, top1 {:.4f}, top5 {:.4f}'.format(
+            len(keep), elapsed, metrics['auc'], metrics['tar@far=0.001'], metrics['top1'], metrics['top5']))
+
+        if logs is not None:
+            logs['val_auc'] = metrics['auc']
+            logs['val_top1'] = metrics['top1']
+
+        # Shrinks the evaluated subset to fit in the time budget
+        if elapsed > self.time_budget and len(keep) > 2:
+            self.max_images = max(2, int(len(keep) * self.time_budget / elapsed * 0.9))
@@ -0,0 +1,311 @@
+"""
+DogFaceNet
+Gallery index for dog identification.
+Stores the embeddings of known dogs with their labels and answers top-k
+nearest neighbour queries, either exactly (blocked matrix multiplication
+over the whole gallery) or approximately with an inverted file (IVF):
+the gallery is partitioned by k-means and only the nprobe closest
+partitions are searched.
+The index is saved as .npy files which can be memory-mapped when loaded,
+and supports incremental add and remove.
+
+Usage:
+    gallery = build_gallery(model, filenames, labels)
+    gallery.train(nlist=64)
+    distances, ids, labels = gallery.search(queries, k=5, nprobe=8)
+    gallery.save('../../output/gallery/')
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import numpy as np
+
+
+def squared_distances(queries, embeddings, sq_norms=None):
+    """
+    Squared euclidean distances between queries and embeddings,
+    computed with ||q||^2 + ||e||^2 - 2qe.
+    """
+    if sq_norms is None:
+        sq_norms = np.sum(np.square(embeddings), axis=-1)
+    dist = np.sum(np.square(queries), axis=-1)[:, None] + sq_norms[None, :] - 2 * np.dot(queries, embeddings.T)
+    return np.maximum(dist, 0)
+
+
+def top_k(dist, k):
+    """
+    Indices and values of the k smallest distances of each row, sorted.
+    """
+    k = min(k, dist.shape[-1])
+    if k < dist.shape[-1]:
+        idx = np.argpartition(dist, k - 1, axis=-1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(dist.shape[-1]), dist.shape)
+    values = np.take_along_axis(dist, idx, axis=-1)
+    order = np.argsort(values, axis=-1, kind='stable')
+    return np.take_along_axis(idx, order, axis=-1), np.take_along_axis(values, order, axis=-1)
+
+
+def kmeans(x, k, nbof_iter=20, seed=0, block_size=65536):
+    """
+    Lloyd's k-means, the assignments are computed by blocks of block_size
+    points. k is clamped to the number of points.
+
+    Returns:
+     - centroids: array of shape (min(k, len(x)), dim).
+     - assign: array of integers, centroid of each point.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    assert len(x) > 0, '[Error] k-means needs at least one point.'
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    assign = np.zeros(len(x), dtype=np.int64)
+    for _ in range(nbof_iter):
+        assign = assign_centroids(x, centroids, block_size)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        # Empty clusters are re-seeded with random points
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.randint(len(x), size=np.sum(empty))]
+    return centroids, assign_centroids(x, centroids, block_size)
+
+
+def assign_centroids(x, centroids, block_size=65536):
+    """
+    Closest centroid of each point.
+    """
+    sq_norms = np.sum(np.square(centroids), axis=-1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for i in range(0, len(x), block_size):
+        assign[i:i + block_size] = np.argmin(squared_distances(x[i:i + block_size], centroids, sq_norms), axis=-1)
+    return assign
+
+
+class GalleryIndex(object):
+    """
+    Nearest neighbour index of embeddings with their labels.
+
+    Args:
+     - emb_size: integer. Size of the embeddings.
+     - block_size: integer. Number of gallery entries per block of the
+     exact search.
+    """
+
+    _arrays = ('embeddings', 'labels', 'ids', 'alive', 'assign')
+
+    def __init__(self, emb_size=32, block_size=65536):
+        self.emb_size = emb_size
+        self.block_size = block_size
+        self.size = 0
+        self.embeddings = np.empty((0, emb_size), dtype=np.float32)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.assign = np.empty(0, dtype=np.int64)
+        self.centroids = None
+        self._lists = None
+        self._sq_norms = None
+
+    def __len__(self):
+        return int(np.sum(self.alive[:self.size]))
+
+    def _reserve(self, n):
+        # Amortized growth: the arrays are reallocated with a doubled capacity
+        capacity = len(self.ids)
+        if self.size + n <= capacity and not isinstance(self.embeddings, np.memmap):
+            return
+        capacity = max(self.size + n, 2 * capacity, 1024)
+        for name in self._arrays:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _changed(self):
+        self._lists = None
+        self._sq_norms = None
+
+    def add(self, embeddings, labels, ids=None):
+        """
+        Adds entries to the gallery.
+
+        Args:
+         - embeddings: array of shape (n, emb_size).
+         - labels: array of size n, label (dog identity) of each entry.
+         - ids: array of size n of integers identifying the entries, used
+         by remove. Consecutive integers by default.
+        Returns:
+         - the ids of the added entries.
+        """
+        n = len(embeddings)
+        if ids is None:
+            start = int(self.ids[:self.size].max()) + 1 if self.size else 0
+            ids = np.arange(start, start + n)
+        self._reserve(n)
+        end = self.size + n
+        self.embeddings[self.size:end] = embeddings
+        self.labels[self.size:end] = labels
+        self.ids[self.size:end] = ids
+        self.alive[self.size:end] = True
+        if self.centroids is not None:
+            self.assign[self.size:end] = assign_centroids(self.embeddings[self.size:end], self.centroids)
+        self.size = end
+        self._changed()
+        return np.asarray(ids)
+
+    def remove(self, ids):
+        """
+        Removes the entries with the given ids. The rows are only marked as
+        removed, see compact.
+        """
+        self._reserve(0)
+        removed = np.logical_and(np.isin(self.ids[:self.size], ids), self.alive[:self.size])
+        self.alive[:self.size][removed] = False
+        self._changed()
+        return int(np.sum(removed))
+
+    def compact(self):
+        """
+        Drops the removed entries from the arrays.
+        """
+        keep = np.flatnonzero(self.alive[:self.size])
+        for name in self._arrays:
+            setattr(self, name, np.ascontiguousarray(getattr(self, name)[keep]))
+        self.size = len(keep)
+        self._changed()
+
+    def train(self, nlist=64, sample_size=100000, nbof_iter=20, seed=0):
+        """
+        Trains the IVF partition with k-means on a sample of the gallery and
+        assigns every entry to its partition. A gallery smaller than nlist
+        gets one partition per entry.
+        """
+        alive = np.flatnonzero(self.alive[:self.size])
+        assert len(alive) > 0, '[Error] The gallery is empty, add entries before training.'
+        rng = np.random.RandomState(seed)
+        sample = alive if len(alive) <= sample_size else rng.choice(alive, size=sample_size, replace=False)
+        self.centroids, _ = kmeans(self.embeddings[np.sort(sample)], nlist, nbof_iter, seed)
+        self._reserve(0)
+        self.assign[:self.size] = assign_centroids(self.embeddings[:self.size], self.centroids)
+        self._changed()
+
+    def _inverted_lists(self):
+        # CSR-style lists: the alive entries of partition j are order[offsets[j]:offsets[j+1]]
+        if self._lists is None:
+            alive = np.flatnonzero(self.alive[:self.size])
+            assign = self.assign[alive]
+            order = alive[np.argsort(assign, kind='stable')]
+            counts = np.bincount(assign, minlength=len(self.centroids))
+            self._lists = order, np.concatenate(([0], np.cumsum(counts)))
+        return self._lists
+
+    def _norms(self):
+        if self._sq_norms is None:
+            self._sq_norms = np.sum(np.square(self.embeddings[:self.size]), axis=-1)
+        return self._sq_norms
+
+    def search(self, queries, k=5, nprobe=None):
+        """
+        Searches the k nearest entries of each query.
+
+        Args:
+         - queries: array of shape (m, emb_size).
+         - k: integer. Number of neighbours.
+         - nprobe: integer. Number of IVF partitions searched, None for an
+         exact search (also used when the index is not trained).
+        Returns:
+         - distances: squared distances, array of shape (m, k), inf when
+         less than k entries were found.
+         - ids: ids of the neighbours, -1 when less than k entries were found.
+         - labels: labels of the neighbours.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self) == 0:
+            missing = np.full((len(queries), k), -1, dtype=np.int64)
+            return np.full((len(queries), k), np.inf, dtype=np.float32), missing, missing.copy()
+        if nprobe is None or self.centroids is None:
+            rows, dist = self._search_exact(queries, k)
+        else:
+            rows, dist = self._search_ivf(queries, k, nprobe)
+        found = rows >= 0
+        ids = np.where(found, self.ids[np.maximum(rows, 0)], -1)
+        labels = np.where(found, self.labels[np.maximum(rows, 0)], -1)
+        return dist, ids, labels
+
+    def _search_exact(self, queries, k):
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+        sq_norms = self._norms()
+        for start in range(0, self.size, self.block_size):
+            end = min(start + self.block_size, self.size)
+            dist = squared_distances(queries, self.embeddings[start:end], sq_norms[start:end])
+            dist[:, np.logical_not(self.alive[start:end])] = np.inf
+            rows = np.concatenate((best_rows, np.broadcast_to(np.arange(start, end), dist.shape)), axis=-1)
+            dist = np.concatenate((best_dist, dist), axis=-1)
+            idx, best_dist = top_k(dist, k)
+            best_rows = np.take_along_axis(rows, idx, axis=-1)
+        best_rows[np.isinf(best_dist)] = -1
+        return best_rows, best_dist
+
+    def _search_ivf(self, queries, k, nprobe):
+        order, offsets = self._inverted_lists()
+        sq_norms = self._norms()
+        probes, _ = top_k(squared_distances(queries, self.centroids), nprobe)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, probe in enumerate(probes):
+            candidates = np.concatenate([order[offsets[j]:offsets[j + 1]] for j in probe])
+            if len(candidates) == 0:
+                continue
+            dist = squared_distances(queries[i:i + 1], self.embeddings[candidates], sq_norms[candidates])
+            idx, dist = top_k(dist, k)
+            best_rows[i, :idx.shape[-1]] = candidates[idx[0]]
+            best_dist[i, :idx.shape[-1]] = dist[0]
+        return best_rows, best_dist
+
+    def save(self, path):
+        """
+        Saves the gallery into the directory path, one .npy file per array.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self._arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name)[:self.size])
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        with open(os.path.join(path, 'gallery.json'), 'w') as f:
+            json.dump({'emb_size': self.emb_size, 'size': self.size, 'trained': self.centroids is not None}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Loads a gallery saved by save. With mmap_mode='r' the arrays are
+        memory-mapped, they are copied in memory at the first add or remove.
+        """
+        with open(os.path.join(path, 'gallery.json')) as f:
+            meta = json.load(f)
+        gallery = cls(meta['emb_size'])
+        for name in cls._arrays:
+            setattr(gallery, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        if meta['trained']:
+            gallery.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        gallery.size = meta['size']
+        return gallery
+
+
+def build_gallery(model, filenames, labels, batch_size=64, cache=None, executor=None):
+    """
+    Embeds pictures with a dogfacenet model and ingests them in a new
+    GalleryIndex, the ids are the indices in filenames.
+    """
+    from online_training import predict_embeddings
+
+    embeddings = predict_embeddings(model, filenames, batch_size, cache, executor)
+    gallery = GalleryIndex(embeddings.shape[-1])
+    gallery.add(embeddings, labels)
+    return gallery
@@ -0,0 +1,110 @@
+"""
+DogFaceNet
+Pre-decoded image cache.
+The pictures are decoded once and packed into a uint8 memory-mapped
+array, so the training generators can gather whole batches with fancy
+indexing instead of decoding every JPEG again. Several training
+processes can share the same page-cached file.
+
+Usage:
+    pack_images(filenames, '../../output/cache/dfn')
+    cache = open_image_cache('../../output/cache/dfn')
+    images = load_images(batch_filenames, cache=cache)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import numpy as np
+
+SIZE = (224, 224, 3)
+
+
+class ImageCache(object):
+    """
+    Memory-mapped images and the filename to row index.
+
+    Attributes:
+     - images: uint8 array of shape (nbof_images, h, w, c), memory-mapped.
+     - filenames: array of strings, the file name stored in each row.
+     - index: dictionary mapping a file name to its row in images.
+    """
+
+    def __init__(self, images, filenames):
+        self.images = images
+        self.filenames = filenames
+        self.index = {f: i for i, f in enumerate(filenames)}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def rows(self, filenames):
+        """
+        Returns the rows of the given file names as an array of integers.
+        """
+        return np.fromiter((self.index[f] for f in filenames), dtype=np.int64, count=len(filenames))
+
+    def gather(self, filenames, dtype=np.float32):
+        """
+        Gathers the images of the given file names.
+        The conversion to dtype (and the scaling to [0,1]) is only
+        done on the gathered batch.
+        """
+        images = self.images[self.rows(filenames)]
+        if dtype == np.uint8:
+            return images
+        return images.astype(dtype) / np.asarray(255.0, dtype=dtype)
+
+
+def _cache_paths(path):
+    return path + '.images.npy', path + '.filenames.npy'
+
+
+def pack_images(filenames, path, size=SIZE, verbose=True):
+    """
+    Decodes the pictures once and writes them into a memory-mapped file.
+
+    Args:
+     - filenames: array of strings. Pictures to pack, for example the
+     whole dataset or only the training split.
+     - path: string. Prefix of the cache files, two files are written:
+     path.images.npy and path.filenames.npy
+     - size: tuple (h, w, c). Size of the pictures.
+
+    Returns:
+     - an ImageCache opened on the written files.
+    """
+    import skimage.io
+
+    filenames = np.asarray(filenames)
+    path_images, path_filenames = _cache_paths(path)
+    directory = os.path.dirname(path_images)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    images = np.lib.format.open_memmap(path_images, mode='w+', dtype=np.uint8, shape=(len(filenames),) + tuple(size))
+    for i, f in enumerate(filenames):
+        images[i] = skimage.io.imread(f)
+        if verbose and (i + 1) % 1000 == 0:
+            print('Packed {:d}/{:d} pictures'.format(i + 1, len(filenames)))
+    images.flush()
+    del images
+
+    np.save(path_filenames, filenames.astype(str))
+    return open_image_cache(path)
+
+
+def open_image_cache(path):
+    """
+    Opens a cache written by pack_images. The images are memory-mapped
+    in read-only mode.
+    """
+    path_images, path_filenames = _cache_paths(path)
+    assert os.path.isfile(path_images), '[Error] Image cache {:s} does not exist.'.format(path_images)
+    images = np.load(path_images, mmap_mode='r')
+    filenames = np.load(path_filenames)
+    assert len(images) == len(filenames), '[Error] Corrupted image cache {:s}.'.format(path)
+    return ImageCache(images, filenames)
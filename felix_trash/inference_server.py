@@ -0,0 +1,247 @@
+"""
+DogFaceNet
+Batched embedding inference service.
+Loads a saved dogfacenet model once and serves embeddings over a local
+HTTP endpoint. Concurrent requests are grouped by a micro-batcher into a
+single forward pass of at most max_batch_size pictures, waiting at most
+max_wait seconds for the batch to fill up.
+
+Endpoints:
+ - POST /embed: body is a single JPEG/PNG picture, or a JSON object
+ {"images": [base64 encoded pictures]}. Returns {"embeddings": [[...], ...]}.
+ - GET /stats: throughput and latency percentiles.
+
+Usage:
+    python inference_server.py --model ../../output/model/2023.11.20.dogfacenet.49.h5 --port 8080
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import argparse
+import base64
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+
+import numpy as np
+import tensorflow as tf
+
+from losses import custom_objects
+
+SIZE = (224, 224, 3)
+
+
+def load_model(path):
+    """
+    Loads a dogfacenet model saved by dogface.py (.h5).
+    """
+    return tf.keras.models.load_model(path, custom_objects=custom_objects)
+
+
+def decode_images(blobs, size=SIZE, dtype=np.float32):
+    """
+    Decodes encoded pictures (JPEG, PNG, ...) to a float32 array in [0,1],
+    or to uint8 pixels if dtype is np.uint8, resized to size if needed.
+    """
+    h, w, c = size
+    images = np.empty((len(blobs), h, w, c), dtype=dtype)
+    for i, blob in enumerate(blobs):
+        image = tf.io.decode_image(blob, channels=c, expand_animations=False)
+        image = tf.image.convert_image_dtype(image, tf.float32)
+        if image.shape[0] != h or image.shape[1] != w:
+            image = tf.image.resize(image, (h, w))
+        if dtype == np.uint8:
+            image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+        images[i] = image.numpy()
+    return images
+
+
+class LatencyStats(object):
+    """
+    Request latencies and throughput of the service.
+    Only the last window latencies are kept for the percentiles.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.nbof_images = 0
+        self.nbof_requests = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add_batch(self, batch_size, latencies):
+        with self.lock:
+            self.batch_sizes.append(batch_size)
+            self.latencies.extend(latencies)
+            self.nbof_images += batch_size
+            self.nbof_requests += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            latencies = np.array(self.latencies) * 1000.
+            summary = {
+                'requests': self.nbof_requests,
+                'images': self.nbof_images,
+                'images_per_sec': self.nbof_images / elapsed if elapsed > 0 else 0.,
+                'requests_per_sec': self.nbof_requests / elapsed if elapsed > 0 else 0.,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.}
+            for p in (50, 90, 95, 99):
+                summary['latency_p{:d}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else 0.
+            return summary
+
+
+class MicroBatcher(object):
+    """
+    Groups the pictures of concurrent requests into single forward passes.
+
+    Args:
+     - predict_fn: function taking a float32 array of pictures and
+     returning their embeddings.
+     - max_batch_size: integer. Maximum number of pictures per forward pass.
+     - max_wait: float. Maximum time in seconds a request waits for the
+     batch to fill up.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait=0.005):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.stats = LatencyStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, images):
+        """
+        Queues pictures for embedding, returns a Future of their embeddings.
+        """
+        future = Future()
+        self.queue.put((images, future, time.time()))
+        return future
+
+    def embed(self, images):
+        return self.submit(images).result()
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        size = len(requests[0][0])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            requests += [request]
+            size += len(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            try:
+                images = np.concatenate([images for images, _, _ in requests])
+                embeddings = self.predict_fn(images)
+            except Exception as e:
+                for _, future, _ in requests:
+                    future.set_exception(e)
+                continue
+            end = time.time()
+            i = 0
+            for images, future, _ in requests:
+                future.set_result(embeddings[i:i + len(images)])
+                i += len(images)
+            self.stats.add_batch(len(embeddings), [end - start for _, _, start in requests])
+
+
+def make_handler(batcher, size=SIZE, dtype=np.float32):
+    """
+    HTTP request handler class bound to a MicroBatcher.
+    """
+
+    class EmbeddingHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats.summary())
+            else:
+                self._send_json(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            if self.path != '/embed':
+                self._send_json(404, {'error': 'unknown path'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    blobs = [base64.b64decode(b) for b in json.loads(body)['images']]
+                else:
+                    blobs = [body]
+                images = decode_images(blobs, size, dtype)
+            except Exception as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                embeddings = batcher.embed(images)
+            except Exception as e:
+                # Model errors are raised by the batcher thread through the future
+                self._send_json(500, {'error': str(e)})
+                return
+            self._send_json(200, {'embeddings': embeddings.tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return EmbeddingHandler
+
+
+def serve(model_path, host='127.0.0.1', port=8080, max_batch_size=64, max_wait=0.005):
+    """
+    Loads the model and serves the embeddings until interrupted.
+    """
+    print('Loading model from {:s} ...'.format(model_path))
+    model = load_model(model_path)
+    size = tuple(model.input_shape[1:])
+    dtype = np.uint8 if model.inputs[0].dtype == tf.uint8 else np.float32
+    batcher = MicroBatcher(lambda images: model.predict_on_batch(images), max_batch_size, max_wait)
+
+    # Warm up the graph before accepting requests
+    batcher.embed(np.zeros((1,) + size, dtype=dtype))
+    batcher.stats = LatencyStats()
+
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, size, dtype))
+    print('Serving embeddings on http://{:s}:{:d}/embed'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary(), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DogFaceNet embedding service.')
+    parser.add_argument('--model', required=True, help='path to a saved dogfacenet .h5 model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    args = parser.parse_args()
+    serve(args.model, args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000.)
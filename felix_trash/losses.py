@@ -0,0 +1,113 @@
+"""
+DogFaceNet
+Losses and metrics of the triplet training.
+ - triplet, triplet_acc: the batches are made of triplets mined outside of
+ the graph: anchor, positive and negative pictures interleaved
+ ([a, p, n, a, p, n, ...]).
+ - batch_hard_triplet, batch_hard_acc: in-graph mining on PK batches (P
+ classes x K pictures, see online_training.pk_image_generator). Each
+ picture is an anchor with the farthest picture of its class as positive
+ and the closest picture of another class as negative.
+ - batch_all_triplet, batch_all_acc: in-graph mining on PK batches, all
+ the valid triplets of the batch, averaged over the non-zero ones.
+They are computed in float32, whatever the precision of the model.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import tensorflow as tf
+import tensorflow.keras.backend as K
+
+alpha = 0.3
+
+
+def triplet(y_true, y_pred):
+    y_pred = tf.cast(y_pred, tf.float32)
+    a = y_pred[::3]
+    p = y_pred[1::3]
+    n = y_pred[2::3]
+
+    ap = K.sum(K.square(a - p), -1)
+    an = K.sum(K.square(a - n), -1)
+
+    return K.sum(tf.nn.relu(ap - an + alpha))
+
+
+def triplet_acc(y_true, y_pred):
+    y_pred = tf.cast(y_pred, tf.float32)
+    a = y_pred[::3]
+    p = y_pred[1::3]
+    n = y_pred[2::3]
+
+    ap = K.sum(K.square(a - p), -1)
+    an = K.sum(K.square(a - n), -1)
+
+    return K.less(ap + alpha, an)
+
+
+def pairwise_distances(embeddings):
+    """
+    Squared euclidean distances between all the embeddings of a batch.
+    """
+    dot = tf.matmul(embeddings, embeddings, transpose_b=True)
+    sq_norms = tf.linalg.diag_part(dot)
+    return tf.nn.relu(sq_norms[:, None] - 2. * dot + sq_norms[None, :])
+
+
+def _pair_masks(y_true):
+    # Positive pairs: same label but different pictures, negative pairs: different labels
+    labels = tf.reshape(y_true, [-1])
+    same = tf.equal(labels[:, None], labels[None, :])
+    positive = tf.logical_and(same, tf.logical_not(tf.eye(tf.shape(labels)[0], dtype=tf.bool)))
+    return positive, tf.logical_not(same)
+
+
+def _batch_hard(y_true, y_pred):
+    # Hardest positive and negative distances of each anchor, and the anchors having both
+    dist = pairwise_distances(tf.cast(y_pred, tf.float32))
+    positive, negative = _pair_masks(y_true)
+    ap = tf.reduce_max(tf.where(positive, dist, tf.zeros_like(dist)), axis=-1)
+    an = tf.reduce_min(tf.where(negative, dist, tf.fill(tf.shape(dist), float('inf'))), axis=-1)
+    valid = tf.logical_and(tf.reduce_any(positive, axis=-1), tf.reduce_any(negative, axis=-1))
+    return ap, an, tf.cast(valid, tf.float32)
+
+
+def _batch_all(y_true, y_pred):
+    # Margins ap - an + alpha of all the (anchor, positive, negative) triplets and the valid ones
+    dist = pairwise_distances(tf.cast(y_pred, tf.float32))
+    positive, negative = _pair_masks(y_true)
+    margins = dist[:, :, None] - dist[:, None, :] + alpha
+    valid = tf.logical_and(positive[:, :, None], negative[:, None, :])
+    return margins, tf.cast(valid, tf.float32)
+
+
+def batch_hard_triplet(y_true, y_pred):
+    ap, an, valid = _batch_hard(y_true, y_pred)
+    return K.sum(tf.nn.relu(ap - an + alpha) * valid) / K.maximum(K.sum(valid), 1.)
+
+
+def batch_hard_acc(y_true, y_pred):
+    ap, an, valid = _batch_hard(y_true, y_pred)
+    return K.sum(K.cast(K.less(ap + alpha, an), tf.float32) * valid) / K.maximum(K.sum(valid), 1.)
+
+
+def batch_all_triplet(y_true, y_pred):
+    margins, valid = _batch_all(y_true, y_pred)
+    losses = tf.nn.relu(margins) * valid
+    nbof_active = K.sum(K.cast(K.greater(losses, 1e-16), tf.float32))
+    return K.sum(losses) / K.maximum(nbof_active, 1.)
+
+
+def batch_all_acc(y_true, y_pred):
+    margins, valid = _batch_all(y_true, y_pred)
+    return K.sum(K.cast(K.less(margins, 0.), tf.float32) * valid) / K.maximum(K.sum(valid), 1.)
+
+
+# Loss and accuracy of each training mode
+LOSSES = {
+    'triplet': (triplet, triplet_acc),
+    'batch_hard': (batch_hard_triplet, batch_hard_acc),
+    'batch_all': (batch_all_triplet, batch_all_acc)}
+
+# Custom objects needed to load a saved dogfacenet model
+custom_objects = {f.__name__: f for pair in LOSSES.values() for f in pair}
@@ -0,0 +1,284 @@
+"""
+DogFaceNet
+Cached manifest of the dataset directory.
+The dataset tree is scanned with os.scandir by a pool of threads, one
+level of directories at a time, and the file names, sizes and
+modification times are stored in a columnar .npz file: one row per
+directory (path, mtime, first file, number of files) and one row per
+file (name, size, mtime). The next scans only list the directories whose
+mtime changed, i.e. where files or sub-directories were added, removed or
+renamed; the other ones are taken from the manifest after a single stat.
+A file modified in place keeps the size and mtime of the previous scan.
+As with os.walk in dogface.py, each directory holding more than one
+file is a class, labelled in the sorted order of the directory paths.
+
+Usage:
+    manifest = update_manifest('../DFN_dataset/', '../../output/manifest/dfn')
+    filenames, labels = manifest.filenames, manifest.labels
+    keep_train, keep_test = manifest.split(0.1)
+    python manifest.py --path ../DFN_dataset/ --out ../../output/manifest/dfn
+    python manifest.py --check
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from records import class_split, list_dataset
+
+
+def _scan(directory, previous):
+    # One directory: its mtime, files and sub-directories, listed again only if its mtime changed
+    mtime = os.stat(directory).st_mtime_ns
+    if previous is not None and previous[0] == mtime:
+        return previous
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=True):
+                subdirs += [entry.path]
+            elif entry.is_file(follow_symlinks=True):
+                stat = entry.stat()
+                files += [(entry.name, stat.st_size, stat.st_mtime_ns)]
+    return mtime, sorted(files), subdirs
+
+
+class Manifest(object):
+    """
+    Columnar listing of a dataset directory.
+
+    Attributes:
+     - root: string, the scanned directory.
+     - dirs: array of strings, the directory paths in sorted order.
+     - dir_parents: row of the parent of each directory, -1 for root.
+     - dir_mtimes, dir_starts, dir_counts: mtime (ns), first file row and
+     number of files of each directory.
+     - names: bytes array, the file names, grouped by directory.
+     - sizes, mtimes: size (bytes) and mtime (ns) of each file.
+    """
+
+    def __init__(self, root, dirs, dir_parents, dir_mtimes, dir_counts, names, sizes, mtimes):
+        self.root = root
+        self.dirs = dirs
+        self.dir_parents = dir_parents
+        self.dir_mtimes = dir_mtimes
+        self.dir_counts = dir_counts
+        self.dir_starts = np.concatenate(([0], np.cumsum(dir_counts)[:-1])).astype(np.int64)
+        self.names = names
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self._filenames = None
+
+    def __len__(self):
+        return int(np.sum(self.dir_counts[self.dir_counts > 1]))
+
+    @property
+    def keep(self):
+        """
+        Boolean mask of the file rows in a class directory (more than one file).
+        """
+        return np.repeat(self.dir_counts > 1, self.dir_counts)
+
+    @property
+    def filenames(self):
+        """
+        Array of the paths of the pictures of the classes, as built by os.walk.
+        """
+        if self._filenames is None:
+            classes = np.flatnonzero(self.dir_counts > 1)
+            self._filenames = np.array([
+                self.dirs[d] + '/' + name.decode('utf-8', 'surrogateescape')
+                for d in classes
+                for name in self.names[self.dir_starts[d]:self.dir_starts[d] + self.dir_counts[d]]])
+        return self._filenames
+
+    @property
+    def labels(self):
+        """
+        Float array of the class of each picture, in the order of filenames.
+        """
+        counts = self.dir_counts[self.dir_counts > 1]
+        return np.repeat(np.arange(len(counts), dtype=np.float64), counts)
+
+    def split(self, test_split, seed=None):
+        """
+        Train/test split by class, see records.class_split.
+
+        Returns:
+         - keep_train, keep_test: boolean masks of the pictures of filenames.
+        """
+        return class_split(self.labels, test_split, seed)
+
+    def entries(self):
+        """
+        Dictionary of directory: (mtime, slice of its file rows, subdirs), the
+        input of the next scan.
+        """
+        # Plain str paths: os.scandir on a numpy.str_ path yields bytes paths
+        dirs = self.dirs.tolist()
+        children = {}
+        for d, parent in zip(dirs, self.dir_parents.tolist()):
+            if parent >= 0:
+                children.setdefault(dirs[parent], []).append(d)
+        return {d: (int(mtime), slice(int(start), int(start + count)), children.get(d, []))
+                for d, mtime, start, count in zip(dirs, self.dir_mtimes, self.dir_starts, self.dir_counts)}
+
+    def save(self, path):
+        """
+        Writes the manifest to path.manifest.npz.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = path + '.manifest.npz'
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, root=np.array(self.root), dirs=self.dirs, dir_parents=self.dir_parents,
+                     dir_mtimes=self.dir_mtimes, dir_counts=self.dir_counts, names=self.names, sizes=self.sizes,
+                     mtimes=self.mtimes)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads path.manifest.npz, None if it does not exist.
+        """
+        filename = path + '.manifest.npz'
+        if not os.path.isfile(filename):
+            return None
+        with np.load(filename) as f:
+            return cls(str(f['root']), f['dirs'], f['dir_parents'], f['dir_mtimes'], f['dir_counts'], f['names'],
+                       f['sizes'], f['mtimes'])
+
+
+def scan_dataset(root, previous=None, workers=16):
+    """
+    Scans a dataset directory, level by level with a pool of threads.
+
+    Args:
+     - root: string. Dataset directory.
+     - previous: Manifest of an earlier scan of root, its unchanged
+     directories are not listed again.
+     - workers: integer. Number of scanning threads.
+    Returns:
+     - a Manifest.
+    """
+    assert os.path.isdir(root), '[Error] Dataset directory {:s} does not exist.'.format(root)
+    known = {} if previous is None or previous.root != root else previous.entries()
+    scanned = {}
+    parents = {root: None}
+    level = [root]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            results = list(executor.map(lambda d: _scan(d, known.get(d)), level))
+            scanned.update(zip(level, results))
+            parents.update((subdir, d) for d, (_, _, subdirs) in zip(level, results) for subdir in subdirs)
+            level = [subdir for _, _, subdirs in results for subdir in subdirs]
+
+    dirs = sorted(scanned)
+    rows = {d: i for i, d in enumerate(dirs)}
+    # The files of the unchanged directories are copied from the previous columns
+    names, sizes, mtimes, counts = [np.empty(0, dtype=bytes)], [np.empty(0, dtype=np.int64)], \
+        [np.empty(0, dtype=np.int64)], []
+    for d in dirs:
+        files = scanned[d][1]
+        if isinstance(files, slice):
+            names += [previous.names[files]]
+            sizes += [previous.sizes[files]]
+            mtimes += [previous.mtimes[files]]
+            counts += [files.stop - files.start]
+        else:
+            names += [np.array([name.encode('utf-8', 'surrogateescape') for name, _, _ in files], dtype=bytes)]
+            sizes += [np.array([size for _, size, _ in files], dtype=np.int64)]
+            mtimes += [np.array([mtime for _, _, mtime in files], dtype=np.int64)]
+            counts += [len(files)]
+    return Manifest(root, np.array(dirs, dtype=str),
+                    np.array([-1 if parents[d] is None else rows[parents[d]] for d in dirs], dtype=np.int64),
+                    np.array([scanned[d][0] for d in dirs], dtype=np.int64), np.array(counts, dtype=np.int64),
+                    np.concatenate(names), np.concatenate(sizes), np.concatenate(mtimes))
+
+
+def update_manifest(root, path=None, workers=16, verbose=True):
+    """
+    Scans root again from the manifest saved at path, and saves the result.
+
+    Args:
+     - root: string. Dataset directory.
+     - path: string. Prefix of the manifest file, None to scan without cache.
+     - workers: integer. Number of scanning threads.
+    Returns:
+     - the up-to-date Manifest.
+    """
+    start = time.perf_counter()
+    previous = Manifest.load(path) if path is not None else None
+    manifest = scan_dataset(root, previous, workers)
+    if path is not None:
+        manifest.save(path)
+    if verbose:
+        changed = len(manifest.dirs)
+        if previous is not None:
+            old = dict(zip(previous.dirs, previous.dir_mtimes))
+            changed = sum(old.get(d) != m for d, m in zip(manifest.dirs, manifest.dir_mtimes))
+        print('Scanned {:s}: {:d} directories ({:d} listed), {:d} pictures in {:.2f}s'.format(
+            root, len(manifest.dirs), changed, len(manifest), time.perf_counter() - start))
+    return manifest
+
+
+def check_rescans(workers=4):
+    """
+    Rescans a temporary dataset after adding and removing pictures and class
+    directories, and compares each manifest to a full os.walk.
+    """
+    directory = tempfile.mkdtemp()
+    root, path = os.path.join(directory, 'dataset') + '/', os.path.join(directory, 'manifest')
+
+    def add(filename):
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(b'jpeg')
+
+    changes = [
+        ('unchanged', lambda: None),
+        ('add picture', lambda: add(root + 'dog_1/new.jpg')),
+        ('remove picture', lambda: os.remove(root + 'dog_2/0.jpg')),
+        ('add class', lambda: [add(root + 'dog_9/{:d}.jpg'.format(i)) for i in range(2)]),
+        ('add sub-class', lambda: [add(root + 'dog_9/puppy/{:d}.jpg'.format(i)) for i in range(2)]),
+        ('remove class', lambda: shutil.rmtree(root + 'dog_3')),
+        ('remove sub-class', lambda: shutil.rmtree(root + 'dog_9/puppy')),
+    ]
+    try:
+        for c in range(5):
+            for i in range(3):
+                add(root + 'dog_{:d}/{:d}.jpg'.format(c, i))
+        update_manifest(root, path, workers, verbose=False)
+        for name, change in changes:
+            change()
+            manifest = update_manifest(root, path, workers, verbose=False)
+            filenames, labels = list_dataset(root)
+            assert np.array_equal(manifest.filenames, filenames) and np.array_equal(manifest.labels, labels), \
+                '[Error] Manifest differs from os.walk after: {:s}.'.format(name)
+            print('Rescan after {:s}: ok'.format(name))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scans the DogFaceNet dataset into a cached manifest.')
+    parser.add_argument('--path', default='../DFN_dataset/', help='dataset directory, one directory per class')
+    parser.add_argument('--out', default='../../output/manifest/dfn', help='prefix of the manifest file')
+    parser.add_argument('--workers', type=int, default=16, help='number of scanning threads')
+    parser.add_argument('--check', action='store_true', help='checks the incremental rescans on a temporary dataset')
+    args = parser.parse_args()
+
+    if args.check:
+        check_rescans()
+    else:
+        update_manifest(args.path, args.out, args.workers)
@@ -5,6 +5,10 @@ The online_training module should be prefered instead of this one.
 offline_training will load all the dataset into computer memory.
 Even if the training is slighty faster the computer can rapidly
 ran out of memory.
+The stream_* functions and write_triplet_store avoid this: they take the
+images as a (memory-mapped) uint8 or float32 array, for example
+image_cache.open_image_cache(path).images, and build the triplets by
+chunks, so the memory is bounded by the chunk size.
 
 Licensed under the MIT License (see LICENSE for details)
 Written by Guillaume Mougeot
@@ -12,7 +16,9 @@ Written by Guillaume Mougeot
 
 import tensorflow as tf
 import numpy as np
-from tqdm import tqdm_notebook
+from prefetch import split_chunks, executor_workers
+from augmentation import BatchAugmenter
+from class_index import ClassIndex
 
 datagen = tf.keras.preprocessing.image.ImageDataGenerator(
     rotation_range=8,
@@ -21,6 +27,9 @@ datagen = tf.keras.preprocessing.image.ImageDataGenerator(
     channel_shift_range=0.1
 )
 
+# Same transformations as datagen, applied to whole batches at once
+batch_datagen = BatchAugmenter.from_datagen(datagen)
+
 
 def single_apply_transform(image, datagen):
     """
@@ -32,6 +41,8 @@ def single_apply_transform(image, datagen):
         -an image of the same shape of the input but transformed
     """
     image_exp = np.expand_dims(image, 0)
+    if isinstance(datagen, BatchAugmenter):
+        return datagen(image_exp)[0]
     for x in datagen.flow(image_exp, batch_size=1):
         return x[0]
 
@@ -41,65 +52,178 @@ def apply_transform(images, datagen):
     Apply a data preprocessing transformation to n images
     Args:
         -images
-        -ImageDataGenerator
+        -ImageDataGenerator or BatchAugmenter
     Return:
         -images of the same shape of the inputs but transformed
     """
+    if isinstance(datagen, BatchAugmenter):
+        return datagen(images)
     for x in datagen.flow(images, batch_size=len(images), shuffle=False):
         return x
 
 
+def _transform_chunk(images, params, datagen):
+    """
+    Applies already drawn transformations, can be run in a worker.
+    """
+    out = np.empty(images.shape, dtype=np.float32)
+    for i in range(len(images)):
+        out[i] = datagen.standardize(datagen.apply_transform(images[i].astype(np.float32), params[i]))
+    return out
+
+
+def parallel_apply_transform(images, datagen, executor=None):
+    """
+    Same as apply_transform but the images are transformed by the workers
+    of an executor (see prefetch.make_executor).
+    The random transformations are drawn in the calling thread, in the same
+    order as datagen.flow does, so the result is identical to apply_transform.
+    Args:
+        -images
+        -ImageDataGenerator
+        -executor: thread or process pool, apply_transform is used if None
+    Return:
+        -images of the same shape of the inputs but transformed
+    """
+    if executor is None or len(images) == 0 or isinstance(datagen, BatchAugmenter):
+        return apply_transform(images, datagen)
+    params = [datagen.get_random_transform(images.shape[1:]) for _ in range(len(images))]
+    chunks = split_chunks(len(images), executor_workers(executor))
+    futures = [executor.submit(_transform_chunk, images[chunk], params[chunk], datagen) for chunk in chunks]
+    return np.concatenate([future.result() for future in futures])
+
+
+def to_float(images):
+    """
+    Converts a batch of images to float32, uint8 images are scaled to [0,1].
+    """
+    images = np.asarray(images)
+    if images.dtype == np.uint8:
+        return images.astype(np.float32) / 255.
+    return images.astype(np.float32, copy=False)
+
+
+def transform_indices(images, idx, out, datagen=datagen, chunk_size=256):
+    """
+    Writes the transformed images[idx] into out, chunk_size images at a time.
+    """
+    for i in range(0, len(idx), chunk_size):
+        out[i:i + chunk_size] = apply_transform(to_float(images[idx[i:i + chunk_size]]), datagen)
+    return out
+
+
+def triplet_indices(labels, nbof_triplet=10000 * 3, class_index=None):
+    """
+    Selects soft triplets: the anchor and the positive are two different
+    pictures of a random class, the negative is a picture of another random
+    class.
+
+    Args:
+        -labels: labels of the images
+        -nbof_triplet: integer. Has to be a multiple of 3.
+        -class_index: ClassIndex of labels, built from labels if None
+    Returns:
+        -idx_triplets: indices of the anchors, positives and negatives interleaved
+    """
+    if class_index is None:
+        class_index = ClassIndex(labels)
+    nbof_anchors = nbof_triplet // 3
+
+    # Pick a class and chose two pictures from this class
+    class_ap = class_index.random_classes(nbof_anchors, replace=True, multi_only=True)
+    idx_image1 = class_index.sample(class_ap)
+    idx_image2 = class_index.sample(class_ap, exclude=idx_image1)
+
+    # Pick a class for the negative picture
+    class_n = np.random.randint(len(class_index) - 1, size=nbof_anchors)
+    class_n += class_n >= class_ap
+    idx_image3 = class_index.sample(class_n)
+
+    return np.stack((idx_image1, idx_image2, idx_image3), axis=-1).ravel()
+
+
 def define_triplets(images, labels, nbof_triplet=10000 * 3, datagen=datagen):
     _, h, w, c = images.shape
-    triplet_train = np.empty((nbof_triplet, h, w, c))
-    y_triplet = np.empty(nbof_triplet)
-    classes = np.unique(labels)
-    for i in tqdm_notebook(range(0, nbof_triplet, 3)):
-        # Pick a class and chose two pictures from this class
-        classAP = classes[np.random.randint(len(classes))]
-        keep = np.equal(labels, classAP)
-        keep_classAP = images[keep]
-        keep_classAP_idx = labels[keep]
-        idx_image1 = np.random.randint(len(keep_classAP))
-        idx_image2 = np.random.randint(len(keep_classAP))
-        while idx_image1 == idx_image2:
-            idx_image2 = np.random.randint(len(keep_classAP))
-
-        triplet_train[i] = single_apply_transform(keep_classAP[idx_image1], datagen)
-        triplet_train[i + 1] = single_apply_transform(keep_classAP[idx_image2], datagen)
-        y_triplet[i] = keep_classAP_idx[idx_image1]
-        y_triplet[i + 1] = keep_classAP_idx[idx_image2]
-        # Pick a class for the negative picture
-        classN = classes[np.random.randint(len(classes))]
-        while classN == classAP:
-            classN = classes[np.random.randint(len(classes))]
-        keep = np.equal(labels, classN)
-        keep_classN = images[keep]
-        keep_classN_idx = labels[keep]
-        idx_image3 = np.random.randint(len(keep_classN))
-        triplet_train[i + 2] = single_apply_transform(keep_classN[idx_image3], datagen)
-        y_triplet[i + 2] = keep_classN_idx[idx_image3]
-
-    return triplet_train, y_triplet
+    idx_triplets = triplet_indices(labels, nbof_triplet)
+    triplet_train = np.empty((len(idx_triplets), h, w, c), dtype=np.float32)
+    transform_indices(images, idx_triplets, triplet_train, datagen)
+    return triplet_train, labels[idx_triplets]
+
+
+def shuffled_class_order(labels):
+    """
+    Indices of the pictures grouped by class, with the classes in a random
+    order. Indexing with it is equivalent to shuffle_classes.
+    """
+    class_index = ClassIndex(labels)
+    classes = np.arange(len(class_index))
+    np.random.shuffle(classes)
+    return class_index.gather(classes)
 
 
 def shuffle_classes(images, labels):
     """
     Shuffles the classes
     """
-    classes = np.unique(labels)
-    np.random.shuffle(classes)
+    order = shuffled_class_order(labels)
+    return images[order], labels[order]
+
+
+def hardest_indices(idx_anchor, predict, class_ids, block_size=1024, use_pos=True, use_neg=True):
+    """
+    Block-tiled all-pairs hard mining.
+    The anchors are processed by blocks of block_size against the whole
+    embedding matrix: the squared distances are computed with a matrix
+    multiplication (||a||^2 + ||b||^2 - 2ab) and the same-class entries are
+    masked with a label comparison. The memory used is bounded by
+    block_size * len(predict).
+
+    Args:
+        -idx_anchor: indices of the anchors
+        -predict: predicted embeddings for the images by the trained model
+        -class_ids: class of each image (labels or class positions)
+        -block_size: number of anchors per tile
+        -use_pos: compute the hardest positives?
+        -use_neg: compute the hardest negatives?
+    Returns:
+        -idx_pos: farthest image of the anchor class, for each anchor (None if not use_pos)
+        -idx_neg: closest image of the other classes, for each anchor (None if not use_neg)
+    """
+    idx_pos = np.empty(len(idx_anchor), dtype=np.int64) if use_pos else None
+    idx_neg = np.empty(len(idx_anchor), dtype=np.int64) if use_neg else None
+    sq_norms = np.sum(np.square(predict), axis=-1)
+    for i in range(0, len(idx_anchor), block_size):
+        anchors = idx_anchor[i:i + block_size]
+        dist = sq_norms[anchors, None] + sq_norms[None, :] - 2 * np.dot(predict[anchors], predict.T)
+        same = np.equal(class_ids[anchors, None], class_ids[None, :])
+        if use_pos:
+            idx_pos[i:i + block_size] = np.argmax(np.where(same, dist, -np.inf), axis=-1)
+        if use_neg:
+            idx_neg[i:i + block_size] = np.argmin(np.where(same, np.inf, dist), axis=-1)
+    return idx_pos, idx_neg
+
+
+def global_hard_triplet_indices(labels, predict, block_size=1024):
+    """
+    Selects the hard triplets of global_define_hard_triplets: every picture
+    is an anchor, with the farthest picture of its class as positive and the
+    closest picture of the other classes as negative.
+    The anchors are ordered class by class (in order of first appearance).
+
+    Args:
+        -labels: labels of the images
+        -predict: predicted embeddings for the images by the trained model
+        -block_size: number of anchors per distance tile (see hardest_indices)
+    Returns:
+        -idx_triplets: indices of the anchors, positives and negatives interleaved
+    """
+    _, idx_classes, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    first_appearance = np.argsort(np.argsort(idx_classes))
+    idx_anchor = np.argsort(first_appearance[inverse], kind='stable')
 
-    shuffled_images = np.empty(images.shape)
-    shuffled_labels = np.empty(labels.shape)
-    idx = 0
-    for i in range(len(classes)):
-        keep_classes = np.equal(labels, classes[i])
-        length = np.sum(keep_classes.astype(int))
-        shuffled_labels[idx:idx + length] = labels[keep_classes]
-        shuffled_images[idx:idx + length] = images[keep_classes]
-        idx += length
-    return shuffled_images, shuffled_labels
+    idx_pos, idx_neg = hardest_indices(idx_anchor, predict, inverse, block_size)
+    return np.stack((idx_anchor, idx_pos, idx_neg), axis=-1).ravel()
 
 
 def global_define_hard_triplets(images, labels, predict, datagen=datagen):
@@ -115,51 +239,40 @@ def global_define_hard_triplets(images, labels, predict, datagen=datagen):
         -triplet
         -y_triplet: labels of the triplets
     """
-    _, idx_classes = np.unique(labels, return_index=True)
-    classes = labels[np.sort(idx_classes)]
-    nbof_classes = len(classes)
     _, h, w, c = images.shape
-    triplets = np.empty((3 * len(predict), h, w, c))
-    y_triplets = np.empty(3 * len(predict))
-
-    idx_triplets = 0
-    idx_images = 0
-
-    for i in range(nbof_classes):
-        keep_class = np.equal(labels, classes[i])
-
-        # predict_class = mask_class.dot(predict)
-        predict_other = np.copy(predict)
-        for j in range(len(predict)):
-            if keep_class[j]:
-                predict_other[j] += np.inf
-
-        keep_predict_class = predict[keep_class]
+    idx_triplets = global_hard_triplet_indices(labels, predict)
+    triplets = np.empty((len(idx_triplets), h, w, c), dtype=np.float32)
 
-        for j in range(len(keep_predict_class)):
-            # Computes the distance between the current vector and the vectors in the class
-            dist_class = np.sum(np.square(keep_predict_class - keep_predict_class[j]), axis=-1)
+    # The transformations are applied by batches instead of one image at a time
+    transform_indices(images, idx_triplets, triplets, datagen)
 
-            # Add the anchor
-            triplets[idx_triplets] = single_apply_transform(images[idx_images + j], datagen)
-            y_triplets[idx_triplets] = labels[idx_images + j]
+    return triplets, labels[idx_triplets]
 
-            # Add the hard positive
-            triplets[idx_triplets + 1] = single_apply_transform(images[idx_images + np.argmax(dist_class)], datagen)
-            y_triplets[idx_triplets + 1] = labels[idx_images + np.argmax(dist_class)]
 
-            # Computes the distance between the current vector and the vectors of the others classes
-            dist_other = np.sum(np.square(predict_other - keep_predict_class[j]), axis=-1)
-
-            # Add the hard negative
-            triplets[idx_triplets + 2] = single_apply_transform(images[np.argmin(dist_other)], datagen)
-            y_triplets[idx_triplets + 2] = labels[np.argmin(dist_other)]
-
-            idx_triplets += 3
+def hard_triplet_indices(labels, predict, class_subset_size=10, add=100 * 3):
+    """
+    Selects the triplets of define_hard_triplets: the hard triplets of each
+    subset of class_subset_size classes followed by add soft triplets.
 
-        idx_images += len(keep_predict_class)
+    Args:
+        -labels: labels of the images
+        -predict: predicted embeddings for the images by the trained model
+        -class_subset_size: number of classes in a subset
+        -add: number of soft triplets added after each subset
+    Returns:
+        -idx_triplets: indices of the anchors, positives and negatives interleaved
+    """
+    _, idx_classes = np.unique(labels, return_index=True)
+    classes = labels[np.sort(idx_classes)]
+    from tqdm import tqdm_notebook
 
-    return triplets, y_triplets
+    class_index = ClassIndex(labels)
+    idx_triplets = []
+    for i in tqdm_notebook(range(0, len(classes), class_subset_size)):
+        keep_classes = np.flatnonzero(np.isin(labels, classes[i:i + class_subset_size]))
+        idx_triplets += [keep_classes[global_hard_triplet_indices(labels[keep_classes], predict[keep_classes])]]
+        idx_triplets += [triplet_indices(labels, add, class_index)]
+    return np.concatenate(idx_triplets)
 
 
 def define_hard_triplets(images, labels, predict, class_subset_size=10, add=100 * 3):
@@ -177,33 +290,107 @@ def define_hard_triplets(images, labels, predict, class_subset_size=10, add=100
         -triplet
         -y_triplet: labels of the triplets
     """
-    _, idx_classes = np.unique(labels, return_index=True)
-    classes = labels[np.sort(idx_classes)]
-    nbof_classes = len(classes)
     _, h, w, c = images.shape
-    triplets = np.empty((3 * len(predict) + add * (nbof_classes // class_subset_size + 1), h, w, c))
-    y_triplets = np.empty(3 * len(predict) + add * (nbof_classes // class_subset_size + 1))
-    idx = 0
-    for i in tqdm_notebook(range(0, len(classes), class_subset_size)):
-        selected_classes = classes[i:i + class_subset_size]
-        keep_classes = np.array([labels[j] in selected_classes for j in range(len(labels))])
+    idx_triplets = hard_triplet_indices(labels, predict, class_subset_size, add)
+    triplets = np.empty((len(idx_triplets), h, w, c), dtype=np.float32)
+    transform_indices(images, idx_triplets, triplets)
+    return triplets, labels[idx_triplets]
+
+
+def stream_triplets(images, labels, idx_triplets, chunk_size=3 * 256, use_aug=True, datagen=datagen):
+    """
+    Lazily builds the triplets idx_triplets by chunks.
+    Only the pictures of the current chunk are read from images, which can
+    be a memory-mapped array.
+
+    Args:
+        -images: array (or memmap) of uint8 or float images
+        -labels: labels of the images
+        -idx_triplets: indices of the triplets (see the *_indices functions)
+        -chunk_size: integer. Number of images per chunk, multiple of 3.
+        -use_aug: use data augmentation?
+    Yields:
+        -triplets: float32 array of chunk_size images (less for the last chunk)
+        -y_triplets: labels of the triplets
+    """
+    assert chunk_size % 3 == 0
+    for i in range(0, len(idx_triplets), chunk_size):
+        idx = idx_triplets[i:i + chunk_size]
+        triplets = to_float(images[idx])
+        if use_aug:
+            triplets = apply_transform(triplets, datagen)
+        yield triplets, labels[idx]
+
+
+def stream_define_triplets(images, labels, nbof_triplet=10000 * 3, chunk_size=3 * 256, datagen=datagen):
+    """
+    Streaming version of define_triplets.
+    """
+    return stream_triplets(images, labels, triplet_indices(labels, nbof_triplet), chunk_size, datagen=datagen)
+
 
-        selected_predict = predict[keep_classes]
-        length = len(selected_predict) * 3
+def stream_global_define_hard_triplets(images, labels, predict, chunk_size=3 * 256, datagen=datagen):
+    """
+    Streaming version of global_define_hard_triplets.
+    """
+    return stream_triplets(images, labels, global_hard_triplet_indices(labels, predict), chunk_size,
+                           datagen=datagen)
 
-        triplets_tmp, y_triplets_tmp = global_define_hard_triplets(
-            images[keep_classes],
-            labels[keep_classes],
-            selected_predict
-        )
-        print(len(triplets_tmp))
 
-        triplets[idx:idx + length] = triplets_tmp
-        y_triplets[idx:idx + length] = y_triplets_tmp
+def stream_define_hard_triplets(images, labels, predict, class_subset_size=10, add=100 * 3, chunk_size=3 * 256,
+                                datagen=datagen):
+    """
+    Streaming version of define_hard_triplets.
+    """
+    idx_triplets = hard_triplet_indices(labels, predict, class_subset_size, add)
+    return stream_triplets(images, labels, idx_triplets, chunk_size, datagen=datagen)
 
-        triplets[idx + length:idx + length + add], y_triplets[idx + length:idx + length + add] = define_triplets(images,
-                                                                                                                 labels,
-                                                                                                                 add)
 
-        idx += len(triplets_tmp) + add
-    return triplets, y_triplets
\ No newline at end of file
+def write_triplet_store(path, images, labels, idx_triplets, chunk_size=3 * 256, dtype=np.uint8, use_aug=True,
+                        datagen=datagen):
+    """
+    Writes the triplets idx_triplets into a chunked on-disk store:
+    path.triplets.npy (images) and path.labels.npy (labels).
+
+    Args:
+        -path: prefix of the store files
+        -images: array (or memmap) of uint8 or float images
+        -labels: labels of the images
+        -idx_triplets: indices of the triplets (see the *_indices functions)
+        -chunk_size: integer. Number of images written at once, multiple of 3.
+        -dtype: np.uint8 (4 times smaller) or np.float32
+    Returns:
+        -triplets: memory-mapped array of the triplets
+        -y_triplets: labels of the triplets
+    """
+    _, h, w, c = images.shape
+    triplets = np.lib.format.open_memmap(path + '.triplets.npy', mode='w+', dtype=dtype,
+                                         shape=(len(idx_triplets), h, w, c))
+    y_triplets = labels[idx_triplets]
+    np.save(path + '.labels.npy', y_triplets)
+
+    i = 0
+    for triplets_chunk, _ in stream_triplets(images, labels, idx_triplets, chunk_size, use_aug, datagen):
+        if dtype == np.uint8:
+            triplets_chunk = np.clip(np.round(triplets_chunk * 255.), 0, 255)
+        triplets[i:i + len(triplets_chunk)] = triplets_chunk
+        i += len(triplets_chunk)
+    triplets.flush()
+    return triplets, y_triplets
+
+
+def open_triplet_store(path):
+    """
+    Opens a store written by write_triplet_store, the images are memory-mapped.
+    """
+    return np.load(path + '.triplets.npy', mmap_mode='r'), np.load(path + '.labels.npy')
+
+
+def triplet_store_generator(triplets, y_triplets, batch_size=63):
+    """
+    Training generator reading a triplet store sequentially.
+    """
+    assert batch_size % 3 == 0
+    while True:
+        for i in range(0, len(triplets) - batch_size + 1, batch_size):
+            yield to_float(triplets[i:i + batch_size]), y_triplets[i:i + batch_size]
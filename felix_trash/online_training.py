@@ -20,16 +20,19 @@ import tensorflow as tf
 import os
 import pickle
 import numpy as np
-import skimage as sk
-import matplotlib.pyplot as plt
 import tensorflow.keras.backend as K
 from offline_training import *
+from image_cache import ImageCache, open_image_cache, pack_images
+from class_index import ClassIndex
+from pk_sampler import PKSampler
+from prefetch import split_chunks, executor_workers
+from profiling import profiler
 from math import isnan
 
 SIZE = (224, 224, 3)
 
 
-def define_triplets_batch(filenames, labels, nbof_triplet=21 * 3):
+def define_triplets_batch(filenames, labels, nbof_triplet=21 * 3, class_index=None):
     """
     Generates offline soft triplet.
     Given a list of file names of pictures, their specific label and
@@ -40,114 +43,90 @@ def define_triplets_batch(filenames, labels, nbof_triplet=21 * 3):
      - filenames: array of strings. List of file names of the pictures.
      - labels: array of integers.
      - nbof_triplet: integer. Has to be a multiple of 3.
+     - class_index: ClassIndex of labels. Built from labels if None, pass
+     it to avoid rebuilding it at each call.
 
      Returns:
      - triplet_train: array of pictures --> a 4D array.
      - y_triplet: array of integers of same dimension as the first
      dimension of triplet_train. Contains the labels of the pictures.
     """
-    triplet_train = []
-    y_triplet = np.empty(nbof_triplet)
-    classes = np.unique(labels)
-    for i in range(0, nbof_triplet, 3):
-        # Pick a class and chose two pictures from this class
-        classAP = classes[np.random.randint(len(classes))]
-        keep = np.equal(labels, classAP)
-        keep_classAP = filenames[keep]
-        keep_classAP_idx = labels[keep]
-        idx_image1 = np.random.randint(len(keep_classAP))
-        idx_image2 = np.random.randint(len(keep_classAP))
-        while idx_image1 == idx_image2:
-            idx_image2 = np.random.randint(len(keep_classAP))
-
-        triplet_train += [keep_classAP[idx_image1]]
-        triplet_train += [keep_classAP[idx_image2]]
-        y_triplet[i] = keep_classAP_idx[idx_image1]
-        y_triplet[i + 1] = keep_classAP_idx[idx_image2]
-        # Pick a class for the negative picture
-        classN = classes[np.random.randint(len(classes))]
-        while classN == classAP:
-            classN = classes[np.random.randint(len(classes))]
-        keep = np.equal(labels, classN)
-        keep_classN = filenames[keep]
-        keep_classN_idx = labels[keep]
-        idx_image3 = np.random.randint(len(keep_classN))
-        triplet_train += [keep_classN[idx_image3]]
-        y_triplet[i + 2] = keep_classN_idx[idx_image3]
-
-    return triplet_train, y_triplet
-
-
-def define_hard_triplets_batch(filenames, labels, predict, nbof_triplet=21 * 3, use_neg=True, use_pos=True):
+    idx_triplets = triplet_indices(labels, nbof_triplet, class_index)
+    return filenames[idx_triplets], labels[idx_triplets]
+
+
+def triplet_indices_batch(labels, predict, nbof_triplet=21 * 3, use_neg=True, use_pos=True, block_size=1024,
+                          class_index=None):
     """
-    [DEPRECATED] Use define_adaptive_hard_triplets_batch instead!
-    Generates hard triplet for offline selection. It will consider the whole dataset.
+    Selects triplets with array operations only.
+    The anchors are chosen randomly (a random class then a random picture of
+    this class). The positives are the farthest pictures of the anchor class
+    if use_pos, else a random other picture of the class. The negatives are
+    the closest pictures of the other classes if use_neg, else a random
+    picture of another class.
+    The squared distances are computed for blocks of block_size anchors
+    against the whole batch with ||a||^2 + ||b||^2 - 2ab (see hardest_indices).
 
     Args:
-        -images: images from which the triplets will be created
-        -labels: labels of the images
-        -predict: predicted embeddings for the images by the trained model
-        -alpha: threshold of the triplet loss
+        -labels: labels of the pictures
+        -predict: predicted embeddings for the pictures by the trained model
+        -nbof_triplet: integer. Has to be a multiple of 3.
+        -use_neg: use hard negatives?
+        -use_pos: use hard positives?
+        -block_size: number of anchors per distance matrix
+        -class_index: ClassIndex of labels, built from labels if None
     Returns:
-        -triplet
-        -y_triplet: labels of the triplets
+        -idx_triplets: array of integers of size nbof_triplet, indices of the
+        anchors, positives and negatives interleaved
     """
     # Check if we have the right number of triplets
     assert nbof_triplet % 3 == 0
+    nbof_anchors = nbof_triplet // 3
 
-    _, idx_classes = np.unique(labels, return_index=True)
-    classes = labels[np.sort(idx_classes)]
+    if class_index is None:
+        class_index = ClassIndex(labels)
 
-    triplets = []
-    y_triplets = np.empty(nbof_triplet)
+    # Chooses the anchors randomly
+    class_anchor = class_index.random_classes(nbof_anchors, replace=True)
+    idx_anchor = class_index.sample(class_anchor)
 
-    for i in range(0, nbof_triplet, 3):
-        # Chooses the first class randomly
-        keep = np.equal(labels, classes[np.random.randint(len(classes))])
-        keep_filenames = filenames[keep]
-        keep_labels = labels[keep]
+    # Random positives: another picture of the anchor class (the anchor itself for single picture classes)
+    idx_pos = class_index.sample(class_anchor, exclude=idx_anchor)
 
-        # Chooses the first image among this class randomly
-        idx_image1 = np.random.randint(len(keep_labels))
+    # Random negatives: a picture outside of the anchor class
+    idx_neg = class_index.sample_outside(class_anchor)
 
-        # Computes the distance between the chosen image and the rest of the class
-        if use_pos:
-            dist_class = np.sum(np.square(predict[keep] - predict[keep][idx_image1]), axis=-1)
+    if use_pos or use_neg:
+        hard_pos, hard_neg = hardest_indices(idx_anchor, predict, class_index.inverse, block_size, use_pos, use_neg)
+        idx_pos = hard_pos if use_pos else idx_pos
+        idx_neg = hard_neg if use_neg else idx_neg
 
-            idx_image2 = np.argmax(dist_class)
-        else:
-            idx_image2 = np.random.randint(len(keep_labels))
-            i = 0
-            while idx_image1 == idx_image2:
-                idx_image2 = np.random.randint(len(keep_labels))
-                # Just to prevent endless loop:
-                i += 1
-                if i == 1000:
-                    print("[Error: define_hard_triplets_batch] Endless loop.")
-                    break
-
-        triplets += [keep_filenames[idx_image1]]
-        y_triplets[i] = keep_labels[idx_image1]
-        triplets += [keep_filenames[idx_image2]]
-        y_triplets[i + 1] = keep_labels[idx_image2]
-
-        # Computes the distance between the chosen image and the rest of the other classes
-        not_keep = np.logical_not(keep)
-
-        if use_neg:
-            dist_other = np.sum(np.square(predict[not_keep] - predict[keep][idx_image1]), axis=-1)
-            idx_image3 = np.argmin(dist_other)
-        else:
-            idx_image3 = np.random.randint(len(filenames[not_keep]))
+    return np.stack((idx_anchor, idx_pos, idx_neg), axis=-1).ravel()
 
-        triplets += [filenames[not_keep][idx_image3]]
-        y_triplets[i + 2] = labels[not_keep][idx_image3]
 
-    # return triplets, y_triplets
-    return np.array(triplets), y_triplets
+def define_hard_triplets_batch(filenames, labels, predict, nbof_triplet=21 * 3, use_neg=True, use_pos=True,
+                               class_index=None):
+    """
+    [DEPRECATED] Use define_adaptive_hard_triplets_batch instead!
+    Generates hard triplet for offline selection. It will consider the whole dataset.
+
+    Args:
+        -images: images from which the triplets will be created
+        -labels: labels of the images
+        -predict: predicted embeddings for the images by the trained model
+        -alpha: threshold of the triplet loss
+        -class_index: ClassIndex of labels, built from labels if None
+    Returns:
+        -triplet
+        -y_triplet: labels of the triplets
+    """
+    idx_triplets = triplet_indices_batch(labels, predict, nbof_triplet, use_neg=use_neg, use_pos=use_pos,
+                                         class_index=class_index)
+    return filenames[idx_triplets], labels[idx_triplets]
 
 
-def define_adaptive_hard_triplets_batch(filenames, labels, predict, nbof_triplet=21 * 3, use_neg=True, use_pos=True):
+def define_adaptive_hard_triplets_batch(filenames, labels, predict, nbof_triplet=21 * 3, use_neg=True, use_pos=True,
+                                        class_index=None):
     """
     Generates hard triplet for offline selection. It will consider the whole dataset.
     This function will also return the predicted values.
@@ -157,115 +136,154 @@ def define_adaptive_hard_triplets_batch(filenames, labels, predict, nbof_triplet
         -labels: labels of the images
         -predict: predicted embeddings for the images by the trained model
         -alpha: threshold of the triplet loss
+        -class_index: ClassIndex of labels, built from labels if None
     Returns:
         -triplets
         -y_triplets: labels of the triplets
         -pred_triplets: predicted embeddings of the triplets
     """
-    # Check if we have the right number of triplets
-    assert nbof_triplet % 3 == 0
+    idx_triplets = triplet_indices_batch(labels, predict, nbof_triplet, use_neg=use_neg, use_pos=use_pos,
+                                         class_index=class_index)
+    return filenames[idx_triplets], labels[idx_triplets], predict[idx_triplets]
 
-    _, idx_classes = np.unique(labels, return_index=True)
-    classes = labels[np.sort(idx_classes)]
 
-    triplets = []
-    y_triplets = np.empty(nbof_triplet)
-    pred_triplets = np.empty((nbof_triplet, predict.shape[-1]))
+def load_images(filenames, cache=None, dtype=np.float32):
+    """
+    Use scikit-image library to load the pictures from files to numpy array.
+    If an ImageCache is given (see image_cache.pack_images), the pictures are
+    gathered from the memory-mapped cache.
+    The pictures are returned in [0,1] as float32, or as raw uint8 pixels
+    if dtype is np.uint8.
+    """
+    if cache is not None:
+        return cache.gather(filenames, dtype)
+    # Imported on first use, the inference does not need it
+    import skimage.io
+    h, w, c = SIZE
+    images = np.empty((len(filenames), h, w, c), dtype=dtype)
+    for i, f in enumerate(filenames):
+        if dtype == np.uint8:
+            images[i] = skimage.io.imread(f)
+        else:
+            images[i] = skimage.io.imread(f) / np.asarray(255.0, dtype=dtype)
+    return images
 
-    for i in range(0, nbof_triplet, 3):
-        # Chooses the first class randomly
-        keep = np.equal(labels, classes[np.random.randint(len(classes))])
-        keep_filenames = filenames[keep]
-        keep_labels = labels[keep]
 
-        # Chooses the first image among this class randomly
-        idx_image1 = np.random.randint(len(keep_labels))
+def parallel_load_images(filenames, executor=None, cache=None, dtype=np.float32):
+    """
+    Same as load_images but the files are decoded by the workers of an
+    executor (see prefetch.make_executor). The pre-decoded ImageCache is
+    gathered directly, the JPEG bytes of a RecordReader are decoded by the
+    workers.
+    """
+    if executor is None or isinstance(cache, ImageCache) or len(filenames) == 0:
+        return load_images(filenames, cache, dtype)
+    if cache is not None:
+        return cache.gather(filenames, dtype, executor)
+    chunks = split_chunks(len(filenames), executor_workers(executor))
+    futures = [executor.submit(load_images, filenames[chunk], None, dtype) for chunk in chunks]
+    return np.concatenate([future.result() for future in futures])
 
-        # Computes the distance between the chosen image and the rest of the class
-        if use_pos:
-            dist_class = np.sum(np.square(predict[keep] - predict[keep][idx_image1]), axis=-1)
 
-            idx_image2 = np.argmax(dist_class)
-        else:
-            idx_image2 = np.random.randint(len(keep_labels))
-            j = 0
-            while idx_image1 == idx_image2:
-                idx_image2 = np.random.randint(len(keep_labels))
-                # Just to prevent endless loop:
-                j += 1
-                if j == 1000:
-                    print("[Error: define_hard_triplets_batch] Endless loop.")
-                    break
-
-        triplets += [keep_filenames[idx_image1]]
-        y_triplets[i] = keep_labels[idx_image1]
-        pred_triplets[i] = predict[keep][idx_image1]
-        triplets += [keep_filenames[idx_image2]]
-        y_triplets[i + 1] = keep_labels[idx_image2]
-        pred_triplets[i + 1] = predict[keep][idx_image2]
-
-        # Computes the distance between the chosen image and the rest of the other classes
-        not_keep = np.logical_not(keep)
-
-        if use_neg:
-            dist_other = np.sum(np.square(predict[not_keep] - predict[keep][idx_image1]), axis=-1)
-            idx_image3 = np.argmin(dist_other)
-        else:
-            idx_image3 = np.random.randint(len(filenames[not_keep]))
+def to_uint8(images):
+    """
+    Converts a batch of images in [0,1] to uint8 pixels.
+    """
+    return np.clip(images * 255. + 0.5, 0, 255).astype(np.uint8)
 
-        triplets += [filenames[not_keep][idx_image3]]
-        y_triplets[i + 2] = labels[not_keep][idx_image3]
-        pred_triplets[i + 2] = predict[not_keep][idx_image3]
 
-    return np.array(triplets), y_triplets, pred_triplets
+def input_dtype(model):
+    """
+    Dtype of the pictures expected by a model: np.uint8 for a dogfacenet
+    built with input_dtype='uint8', np.float32 otherwise.
+    """
+    return np.uint8 if model.inputs[0].dtype == tf.uint8 else np.float32
 
 
-def load_images(filenames):
+def load_batch(filenames, cache=None, use_aug=True, datagen=datagen, executor=None, dtype=np.float32):
     """
-    Use scikit-image library to load the pictures from files to numpy array.
+    Loads a batch of pictures and applies the data augmentation.
+    The augmentation is done in float32, the augmented batch is converted to
+    uint8 pixels if dtype is np.uint8.
     """
-    h, w, c = SIZE
-    images = np.empty((len(filenames), h, w, c))
-    for i, f in enumerate(filenames):
-        images[i] = sk.io.imread(f) / 255.0
+    with profiler.stage('load'):
+        images = parallel_load_images(filenames, executor, cache, np.float32 if use_aug else dtype)
+    if use_aug:
+        with profiler.stage('augmentation'):
+            images = parallel_apply_transform(images, datagen, executor)
+            if dtype == np.uint8:
+                images = to_uint8(images)
     return images
 
 
-def image_generator(filenames, labels, batch_size=63, use_aug=True, datagen=datagen):
+def image_generator(filenames, labels, batch_size=63, use_aug=True, datagen=datagen, cache=None, class_index=None,
+                    executor=None, dtype=np.float32):
     """
     Training generator for soft triplets.
     """
+    if class_index is None:
+        class_index = ClassIndex(labels)
     while True:
-        f_triplet, y_triplet = define_triplets_batch(filenames, labels, batch_size)
-        i_triplet = load_images(f_triplet)
-        if use_aug:
-            i_triplet = apply_transform(i_triplet, datagen)
+        with profiler.stage('sampling'):
+            f_triplet, y_triplet = define_triplets_batch(filenames, labels, batch_size, class_index)
+        i_triplet = load_batch(f_triplet, cache, use_aug, datagen, executor, dtype)
         yield (i_triplet, y_triplet)
 
 
+def pk_image_generator(filenames, labels, nbof_classes=10, nbof_images=3, use_aug=True, datagen=datagen, cache=None,
+                       class_index=None, executor=None, dtype=np.float32, sampler=None):
+    """
+    Training generator of PK batches (nbof_classes x nbof_images pictures)
+    for the in-graph mining losses (losses.batch_hard_triplet and
+    losses.batch_all_triplet). No prediction is needed to build a batch.
+    The batches come from sampler, a PKSampler of labels (built from
+    class_index if None).
+    """
+    if sampler is None:
+        if class_index is None:
+            class_index = ClassIndex(labels)
+        sampler = PKSampler(class_index, nbof_classes, nbof_images)
+    for idx in sampler:
+        i_batch = load_batch(filenames[idx], cache, use_aug, datagen, executor, dtype)
+        yield (i_batch, labels[idx])
+
+
 def hard_image_generator(filenames, labels, predict, batch_size=63, use_neg=True, use_pos=True, use_aug=True,
-                         datagen=datagen):
+                         datagen=datagen, cache=None, class_index=None, executor=None, dtype=np.float32):
     """
     Training generator for offline hard triplets.
     """
+    if class_index is None:
+        class_index = ClassIndex(labels)
     while True:
-        f_triplet, y_triplet = define_hard_triplets_batch(filenames, labels, predict, batch_size, use_neg=use_neg,
-                                                          use_pos=use_pos)
-        i_triplet = load_images(f_triplet)
-        if use_aug:
-            i_triplet = apply_transform(i_triplet, datagen)
+        with profiler.stage('selection'):
+            f_triplet, y_triplet = define_hard_triplets_batch(filenames, labels, predict, batch_size, use_neg=use_neg,
+                                                              use_pos=use_pos, class_index=class_index)
+        i_triplet = load_batch(f_triplet, cache, use_aug, datagen, executor, dtype)
         yield (i_triplet, y_triplet)
 
 
-def predict_generator(filenames, batch_size=32):
+def predict_generator(filenames, batch_size=32, cache=None, executor=None, dtype=np.float32):
     """
     Prediction generator.
     """
     for i in range(0, len(filenames), batch_size):
-        images_batch = load_images(filenames[i:i + batch_size])
+        images_batch = parallel_load_images(filenames[i:i + batch_size], executor, cache, dtype)
         yield images_batch
 
 
+def predict_embeddings(model, filenames, batch_size=64, cache=None, executor=None):
+    """
+    Predicts the embeddings of all the given pictures, by batches of batch_size.
+    Returns a float32 array of shape (len(filenames), embedding size).
+    """
+    if len(filenames) == 0:
+        return np.empty((0, model.output_shape[-1]), dtype=np.float32)
+    predict = model.predict(predict_generator(filenames, batch_size, cache, executor, input_dtype(model)),
+                            steps=int(np.ceil(len(filenames) / batch_size)))
+    return predict.astype(np.float32, copy=False)
+
+
 def online_hard_image_generator(
         filenames,
         labels,
@@ -275,81 +293,98 @@ def online_hard_image_generator(
         use_neg=True,
         use_pos=True,
         use_aug=True,
-        datagen=datagen):
+        datagen=datagen,
+        cache=None,
+        class_index=None,
+        executor=None):
     """
     Generator to select online hard triplets for training.
 
     Arguments:
         -filenames
         -labels
+        -cache: optional ImageCache used instead of decoding the files
+        -class_index: ClassIndex of labels, built once from labels if None
+        -executor: optional pool decoding and augmenting the pictures (see prefetch.make_executor)
     """
+    if class_index is None:
+        class_index = ClassIndex(labels)
+    dtype = input_dtype(model)
     while True:
         # Select a certain amount of subclasses
-        classes = np.unique(labels)
-        subclasses = np.random.choice(classes, size=nbof_subclasses, replace=False)
-
-        keep_classes = np.equal(labels, subclasses[0])
-        for i in range(1, len(subclasses)):
-            keep_classes = np.logical_or(keep_classes, np.equal(labels, subclasses[i]))
-        subfilenames = filenames[keep_classes]
-        sublabels = labels[keep_classes]
-        predict = model.predict_generator(predict_generator(subfilenames, 32),
-                                          steps=np.ceil(len(subfilenames) / 32))
-
-        f_triplet, y_triplet = define_hard_triplets_batch(subfilenames, sublabels, predict, batch_size, use_neg=use_neg,
-                                                          use_pos=use_pos)
-        i_triplet = load_images(f_triplet)
-        if use_aug:
-            i_triplet = apply_transform(i_triplet, datagen)
+        with profiler.stage('sampling'):
+            subclasses = class_index.random_classes(nbof_subclasses)
+            keep_classes, subclass_index = class_index.subset(subclasses)
+            subfilenames = filenames[keep_classes]
+            sublabels = labels[keep_classes]
+        with profiler.stage('predict'):
+            predict = model.predict_generator(predict_generator(subfilenames, 32, cache, executor, dtype),
+                                              steps=np.ceil(len(subfilenames) / 32))
+
+        with profiler.stage('selection'):
+            f_triplet, y_triplet = define_hard_triplets_batch(subfilenames, sublabels, predict, batch_size,
+                                                              use_neg=use_neg, use_pos=use_pos,
+                                                              class_index=subclass_index)
+        i_triplet = load_batch(f_triplet, cache, use_aug, datagen, executor, dtype)
         yield (i_triplet, y_triplet)
 
 
-def online_adaptive_hard_image_generator(
+def online_adaptive_hard_triplet_generator(
         filenames,  # Absolute path of the images
         labels,  # Labels of the images
         model,  # A keras model
         loss,  # Current loss of the model
         batch_size=63,  # Batch size (has to be a multiple of 3 for dogfacenet)
         nbof_subclasses=10,  # Number of subclasses from which the triplets will be selected
-        use_aug=True,  # Use data augmentation?
-        datagen=datagen):  # Data augmentation parameter
+        cache=None,  # Optional ImageCache used instead of decoding the files
+        class_index=None,  # ClassIndex of labels, built once from labels if None
+        executor=None,  # Optional pool decoding the pictures for the prediction (see prefetch.make_executor)
+        embedding_cache=None):  # Optional EmbeddingCache of the pictures of filenames
     """
     Generator to select online hard triplets for training.
     Include an adaptive control on the number of hard triplets included during the training.
+    Yields the file names and the labels of the triplets, the pictures are
+    loaded by online_adaptive_hard_image_generator or by a tf.data pipeline.
     """
 
+    if class_index is None:
+        class_index = ClassIndex(labels)
+    dtype = input_dtype(model)
     hard_triplet_ratio = 0
     nbof_hard_triplets = 0
     while True:
         # Select a certain amount of subclasses
-        classes = np.unique(labels)
         # In order to limit the number of computation for prediction,
         # we will not computes nbof_subclasses predictions for the hard triplets generation,
         # but int(nbof_subclasses*hard_triplet_ratio)+2, which means that the higher the
         # accuracy is the more prediction are going to be computed.
-        subclasses = np.random.choice(classes, size=int(nbof_subclasses * hard_triplet_ratio) + 2, replace=False)
-
-        keep_classes = np.equal(labels, subclasses[0])
-        for i in range(1, len(subclasses)):
-            keep_classes = np.logical_or(keep_classes, np.equal(labels, subclasses[i]))
-        subfilenames = filenames[keep_classes]
-        sublabels = labels[keep_classes]
-        predict = model.predict(predict_generator(subfilenames, 32),
-                                          steps=int(np.ceil(len(subfilenames) / 32)))
-
-        f_triplet_hard, y_triplet_hard, predict_hard = define_adaptive_hard_triplets_batch(subfilenames, sublabels,
-                                                                                           predict,
-                                                                                           nbof_hard_triplets * 3,
-                                                                                           use_neg=True, use_pos=True)
-        f_triplet_soft, y_triplet_soft, predict_soft = define_adaptive_hard_triplets_batch(subfilenames, sublabels,
-                                                                                           predict,
-                                                                                           batch_size - nbof_hard_triplets * 3,
-                                                                                           use_neg=False, use_pos=False)
-
-        f_triplet = np.append(f_triplet_hard, f_triplet_soft)
-        y_triplet = np.append(y_triplet_hard, y_triplet_soft)
-
-        predict = np.append(predict_hard, predict_soft, axis=0)
+        with profiler.stage('sampling'):
+            subclasses = class_index.random_classes(int(nbof_subclasses * hard_triplet_ratio) + 2)
+            keep_classes, subclass_index = class_index.subset(subclasses)
+            subfilenames = filenames[keep_classes]
+            sublabels = labels[keep_classes]
+        with profiler.stage('predict'):
+            if embedding_cache is None:
+                predict = model.predict(predict_generator(subfilenames, 32, cache, executor, dtype),
+                                        steps=int(np.ceil(len(subfilenames) / 32)))
+            else:
+                predict = embedding_cache.lookup(
+                    keep_classes,
+                    lambda idx: model.predict(predict_generator(filenames[idx], 32, cache, executor, dtype),
+                                              steps=int(np.ceil(len(idx) / 32))))
+
+        with profiler.stage('selection'):
+            f_triplet_hard, y_triplet_hard, predict_hard = define_adaptive_hard_triplets_batch(
+                subfilenames, sublabels, predict, nbof_hard_triplets * 3, use_neg=True, use_pos=True,
+                class_index=subclass_index)
+            f_triplet_soft, y_triplet_soft, predict_soft = define_adaptive_hard_triplets_batch(
+                subfilenames, sublabels, predict, batch_size - nbof_hard_triplets * 3, use_neg=False, use_pos=False,
+                class_index=subclass_index)
+
+            f_triplet = np.append(f_triplet_hard, f_triplet_soft)
+            y_triplet = np.append(y_triplet_hard, y_triplet_soft)
+
+            predict = np.append(predict_hard, predict_soft, axis=0)
 
         # Proportion of hard triplets in the generated batch
         # hard_triplet_ratio = max(0,1.2/(1+np.exp(-10*acc+5.3))-0.19)
@@ -359,13 +394,33 @@ def online_adaptive_hard_image_generator(
             hard_triplet_ratio = 0
         nbof_hard_triplets = int(batch_size // 3 * hard_triplet_ratio)
 
-        i_triplet = load_images(f_triplet)
-        if use_aug:
-            i_triplet = apply_transform(i_triplet, datagen)
-
         # Potential modif for different losses: re-labels the dataset from 0 to nbof_subclasses
-        # dict_subclass = {subclasses[i]:i for i in range(nbof_subclasses)}
+        # dict_subclass = {class_index.classes[subclasses[i]]:i for i in range(nbof_subclasses)}
         # ridx_y_triplet = [dict_subclass[y_triplet[i]] for i in range(len(y_triplet))]
 
-        yield (i_triplet, y_triplet)
+        yield (f_triplet, y_triplet)
 
+
+def online_adaptive_hard_image_generator(
+        filenames,  # Absolute path of the images
+        labels,  # Labels of the images
+        model,  # A keras model
+        loss,  # Current loss of the model
+        batch_size=63,  # Batch size (has to be a multiple of 3 for dogfacenet)
+        nbof_subclasses=10,  # Number of subclasses from which the triplets will be selected
+        use_aug=True,  # Use data augmentation?
+        datagen=datagen,  # Data augmentation parameter
+        cache=None,  # Optional ImageCache used instead of decoding the files
+        class_index=None,  # ClassIndex of labels, built once from labels if None
+        executor=None,  # Optional pool decoding and augmenting the pictures (see prefetch.make_executor)
+        embedding_cache=None):  # Optional EmbeddingCache of the pictures of filenames
+    """
+    Generator to select online hard triplets for training.
+    Include an adaptive control on the number of hard triplets included during the training.
+    """
+    dtype = input_dtype(model)
+    for f_triplet, y_triplet in online_adaptive_hard_triplet_generator(filenames, labels, model, loss, batch_size,
+                                                                       nbof_subclasses, cache, class_index, executor,
+                                                                       embedding_cache):
+        i_triplet = load_batch(f_triplet, cache, use_aug, datagen, executor, dtype)
+        yield (i_triplet, y_triplet)
@@ -0,0 +1,127 @@
+"""
+DogFaceNet
+PK batch sampler.
+Emits batches of P classes x K pictures as index arrays, built from a
+ClassIndex. An epoch is a pass over the pictures: the pictures of each
+class are shuffled and cut into groups of K (the last group of a class is
+completed with its first pictures), so every picture is seen once per
+epoch and the classes with less than K pictures are repeated instead of
+being retried. The groups of a class are spread evenly over the epoch,
+so a class rarely appears twice in a batch. When the number of groups is
+not a multiple of P, the last batch of the epoch is completed with groups
+of other classes taken from the start of the epoch.
+Class weights change the number of groups of each class per epoch, e.g.
+'balanced' gives the same number of groups to every class. Each epoch is
+drawn from its own seed (seed, epoch), hence it can be replayed, and the
+iteration goes on from (epoch, position) so the sampler can be shared by
+successive generators and saved in a checkpoint.
+
+Usage:
+    sampler = PKSampler(class_index, nbof_classes=10, nbof_images=3, seed=0)
+    for idx in sampler:
+        images, labels = load_batch(filenames[idx]), labels[idx]
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+
+
+class PKSampler(object):
+    """
+    Epoch-aware PK batch sampler.
+
+    Args:
+     - class_index: ClassIndex of the dataset.
+     - nbof_classes: integer. P, number of classes per batch.
+     - nbof_images: integer. K, number of pictures per class.
+     - class_weights: None (each picture once per epoch), 'balanced' (the
+     same number of groups for each class) or array of one weight per
+     class, the number of groups of each class is proportional to it.
+     - min_images: integer. The classes with less pictures are not sampled.
+     - seed: integer. Seed of the epochs, random if None.
+    """
+
+    def __init__(self, class_index, nbof_classes=10, nbof_images=3, class_weights=None, min_images=2, seed=None):
+        self.class_index = class_index
+        self.nbof_classes = nbof_classes
+        self.nbof_images = nbof_images
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.epoch = 0
+        self.position = 0
+
+        counts = class_index.counts
+        self.eligible = np.flatnonzero(counts >= min_images)
+        assert len(self.eligible) >= nbof_classes, '[Error] Not enough classes for a PK batch.'
+
+        # Number of groups of K pictures of each eligible class per epoch
+        groups = -(-counts[self.eligible] // nbof_images)
+        if class_weights is not None:
+            weights = np.ones(len(counts)) if isinstance(class_weights, str) else np.asarray(class_weights, float)
+            weights = weights[self.eligible]
+            groups = np.maximum(1, np.round(weights / np.sum(weights) * np.sum(groups))).astype(np.int64)
+        self.groups = groups
+
+    def __len__(self):
+        """
+        Number of batches per epoch, the last one completed if needed.
+        """
+        return -(-int(np.sum(self.groups)) // self.nbof_classes)
+
+    def epoch_batches(self, epoch):
+        """
+        All the batches of an epoch.
+
+        Returns:
+         - array of shape (len(self), P*K) of picture indices, the K
+         pictures of a class are consecutive.
+        """
+        rng = np.random.RandomState([self.seed, epoch])
+        ci = self.class_index
+        ks = self.eligible
+        counts = ci.counts[ks]
+        K = self.nbof_images
+
+        # Shuffles the pictures within each class
+        members = ci.gather(ks)
+        member_class = np.repeat(np.arange(len(ks)), counts)
+        members = members[np.lexsort((rng.rand(len(members)), member_class))]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        # Picture slots of the groups, cycling through the shuffled pictures of the class
+        group_class = np.repeat(np.arange(len(ks)), self.groups)
+        group_rank = np.arange(len(group_class)) - np.repeat(np.cumsum(self.groups) - self.groups, self.groups)
+        slots = group_rank[:, None] * K + np.arange(K)[None, :]
+        idx = members[starts[group_class, None] + slots % counts[group_class, None]]
+
+        # Spreads the groups of each class evenly over the epoch
+        keys = (group_rank + rng.rand(len(group_class))) / self.groups[group_class]
+        order = np.argsort(keys, kind='stable')
+        idx, group_class = idx[order], group_class[order]
+
+        # The leftover groups are completed with groups of other classes from the start of the epoch
+        rest = len(idx) % self.nbof_classes
+        if rest > 0:
+            used = set(group_class[len(idx) - rest:])
+            fill = []
+            for i in range(len(idx) - rest):
+                if len(fill) == self.nbof_classes - rest:
+                    break
+                if group_class[i] not in used:
+                    used.add(group_class[i])
+                    fill += [i]
+            idx = np.concatenate((idx, idx[fill]))
+
+        return idx.reshape(len(self), self.nbof_classes * K)
+
+    def __iter__(self):
+        """
+        Infinite iterator over the batches, from the batch position of epoch.
+        """
+        while True:
+            batches = self.epoch_batches(self.epoch)
+            while self.position < len(batches):
+                self.position += 1
+                yield batches[self.position - 1]
+            self.epoch += 1
+            self.position = 0
@@ -0,0 +1,82 @@
+"""
+DogFaceNet
+Mixed precision training mode.
+Sets the keras global dtype policy ('float32', 'mixed_float16' or
+'mixed_bfloat16') if the hardware computes in this precision natively:
+a GPU of compute capability 7.0 (float16) or 8.0 (bfloat16), or a CPU with
+the AVX512/AMX float16 or bfloat16 instructions. Otherwise the half
+precision ops are emulated and slower than float32, so float32 is kept.
+build_dogfacenet keeps its last Dense layer and the l2-normalization in
+float32, and the losses are computed in float32.
+
+Usage:
+    precision = set_precision('mixed_bfloat16')
+    model = build_dogfacenet(SIZE)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import tensorflow as tf
+
+PRECISIONS = ('float32', 'mixed_float16', 'mixed_bfloat16')
+
+# Native half precision instructions and GPU compute capabilities
+_CPU_FLAGS = {'mixed_float16': ('avx512_fp16', 'amx_fp16'), 'mixed_bfloat16': ('avx512_bf16', 'amx_bf16')}
+_GPU_CAPABILITY = {'mixed_float16': (7, 0), 'mixed_bfloat16': (8, 0)}
+
+
+def cpu_flags():
+    """
+    Instruction set flags of the CPU, read from /proc/cpuinfo (empty if not available).
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def gpu_capabilities():
+    """
+    Compute capabilities of the visible GPUs.
+    """
+    capabilities = []
+    for gpu in tf.config.list_physical_devices('GPU'):
+        capability = tf.config.experimental.get_device_details(gpu).get('compute_capability')
+        if capability is not None:
+            capabilities += [tuple(capability)]
+    return capabilities
+
+
+def is_precision_supported(precision):
+    """
+    Is precision computed natively by the GPUs or, without GPU, by the CPU?
+    """
+    assert precision in PRECISIONS, '[Error] Unknown precision {:s}.'.format(precision)
+    if precision == 'float32':
+        return True
+    capabilities = gpu_capabilities()
+    if len(capabilities) > 0:
+        return min(capabilities) >= _GPU_CAPABILITY[precision]
+    return len(cpu_flags().intersection(_CPU_FLAGS[precision])) > 0
+
+
+def set_precision(precision='float32', force=False):
+    """
+    Sets the keras global dtype policy, has to be called before building
+    the model.
+
+    Args:
+     - precision: string. One of PRECISIONS.
+     - force: boolean. Set the policy even if the hardware does not support it.
+    Returns:
+     - the precision actually set.
+    """
+    if not force and not is_precision_supported(precision):
+        print('[Warning] {:s} is not supported natively by this hardware, training in float32.'.format(precision))
+        precision = 'float32'
+    tf.keras.mixed_precision.set_global_policy(precision)
+    return precision
@@ -0,0 +1,101 @@
+"""
+DogFaceNet
+Parallel prefetching for the training generators.
+The generators of online_training are run in a background thread which
+fills a bounded queue, while the file decoding and the data augmentation
+are spread over a pool of threads or processes (see the executor argument
+of the generators).
+
+Usage:
+    executor = make_executor(4)
+    generator = prefetch_generator(
+        image_generator(filenames, labels, executor=executor), depth=4)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import threading
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def make_executor(workers, use_processes=False):
+    """
+    Creates the pool used for decoding and augmentation.
+
+    Args:
+     - workers: integer. Number of workers, 0 to disable the pool.
+     - use_processes: boolean. Use processes instead of threads? Threads
+     are enough when decoding releases the GIL, processes scale better
+     with the scipy based augmentation.
+    Returns:
+     - an executor or None if workers is 0.
+    """
+    if workers <= 0:
+        return None
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def split_chunks(nbof_items, nbof_chunks):
+    """
+    Splits range(nbof_items) into at most nbof_chunks contiguous slices.
+    """
+    nbof_chunks = max(1, min(nbof_chunks, nbof_items))
+    bounds = [nbof_items * i // nbof_chunks for i in range(nbof_chunks + 1)]
+    return [slice(bounds[i], bounds[i + 1]) for i in range(nbof_chunks)]
+
+
+def executor_workers(executor):
+    """
+    Number of workers of a ThreadPoolExecutor or ProcessPoolExecutor.
+    """
+    return getattr(executor, '_max_workers', 1)
+
+
+def _put(queue, stop, item):
+    # Waits for a free slot, unless the consumer is gone
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def prefetch_generator(generator, depth=2):
+    """
+    Runs a generator in a background thread and yields its items in the
+    same order. At most depth items are prepared in advance.
+
+    Args:
+     - generator: any iterable, typically one of the online_training generators.
+     - depth: integer. Size of the prefetch queue.
+    """
+    queue = Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in generator:
+                if not _put(queue, stop, (True, item)):
+                    return
+            _put(queue, stop, (False, None))
+        except BaseException as e:
+            _put(queue, stop, (False, e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_item, item = queue.get()
+            if is_item:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stop.set()
@@ -0,0 +1,175 @@
+"""
+DogFaceNet
+Per-stage timing of the training steps.
+The generators of online_training wrap each stage of a step (subclass
+sampling, mining prediction, triplet selection, image loading and
+augmentation) in profiler.stage(name), and StageTimingCallback records the
+train_on_batch time. At the end of each epoch the count, total, mean, p50
+and p95 of each stage, and its time per step, are written to
+path_save/net_name.epoch.timing.json next to the history files.
+When the profiler is disabled, stage returns a shared no-op context manager.
+
+Usage:
+    profiler.enabled = True
+    with profiler.stage('load'):
+        images = load_images(filenames)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import tensorflow as tf
+
+_null_stage = nullcontext()
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    Wall time of named stages, grouped by training step.
+    Thread safe: the stages can be timed from the loader workers or from a
+    prefetching thread, in which case they are counted in the step during
+    which they ran rather than in the step consuming the batch.
+
+    Args:
+     - enabled: boolean. Record the stages?
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.step = 0
+            self.samples = {}
+
+    def stage(self, name):
+        """
+        Context manager timing its body as the stage name.
+        """
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def add(self, name, duration):
+        """
+        Records a duration in seconds for the stage name in the current step.
+        """
+        with self.lock:
+            steps, durations = self.samples.setdefault(name, ([], []))
+            steps.append(self.step)
+            durations.append(duration)
+
+    def next_step(self):
+        with self.lock:
+            self.step += 1
+
+    def summary(self):
+        """
+        Returns:
+         - dictionary with the number of steps and, for each stage, its count,
+         total time in seconds, mean/p50/p95/max times in milliseconds and
+         the list of its total time in milliseconds at each step.
+        """
+        with self.lock:
+            nbof_steps = self.step
+            samples = {name: (np.array(steps), np.array(durations)) for name, (steps, durations) in
+                       self.samples.items()}
+        summary = {'steps': nbof_steps, 'stages': {}}
+        for name, (steps, durations) in samples.items():
+            per_step = np.bincount(steps, weights=durations, minlength=max(nbof_steps, int(steps.max()) + 1))
+            summary['stages'][name] = {
+                'count': len(durations),
+                'total_s': float(np.sum(durations)),
+                'mean_ms': float(np.mean(durations) * 1000.),
+                'p50_ms': float(np.percentile(durations, 50) * 1000.),
+                'p95_ms': float(np.percentile(durations, 95) * 1000.),
+                'max_ms': float(np.max(durations) * 1000.),
+                'per_step_ms': (per_step * 1000.).tolist()}
+        return summary
+
+
+# Profiler shared by the generators, disabled by default
+profiler = StageTimer()
+
+
+class StageTimingCallback(tf.keras.callbacks.Callback):
+    """
+    Times the training steps with a StageTimer and saves its summary at the
+    end of each epoch. Records two stages:
+     - train_on_batch: from on_train_batch_begin to on_train_batch_end. With
+     model.fit it includes waiting for the input pipeline.
+     - step: between two consecutive on_train_batch_end, the whole step.
+    The validation batches are not recorded.
+
+    Args:
+     - timer: StageTimer, usually profiling.profiler.
+     - path_save: directory of the history files.
+     - net_name: network saved name.
+    """
+
+    def __init__(self, timer, path_save, net_name):
+        super(StageTimingCallback, self).__init__()
+        self.timer = timer
+        self.path_save = path_save
+        self.net_name = net_name
+        self.enabled = timer.enabled
+        self.start = None
+        self.last_end = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.timer.reset()
+        self.last_end = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.timer.enabled:
+            self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if not self.timer.enabled or self.start is None:
+            return
+        end = time.perf_counter()
+        self.timer.add('train_on_batch', end - self.start)
+        if self.last_end is not None:
+            self.timer.add('step', end - self.last_end)
+        self.last_end = end
+        self.timer.next_step()
+
+    def on_test_begin(self, logs=None):
+        self.enabled = self.timer.enabled
+        self.timer.enabled = False
+
+    def on_test_end(self, logs=None):
+        self.timer.enabled = self.enabled
+
+    def on_epoch_end(self, epoch, logs=None):
+        summary = self.timer.summary()
+        with open('{:s}{:s}.{:d}.timing.json'.format(self.path_save, self.net_name, epoch), 'w') as f:
+            json.dump(summary, f)
+
+        print('Stage timings over {:d} steps:'.format(summary['steps']))
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['total_s']):
+            print('  {:15s} count {:6d}, total {:8.2f}s, p50 {:8.2f}ms, p95 {:8.2f}ms'.format(
+                name, stage['count'], stage['total_s'], stage['p50_ms'], stage['p95_ms']))
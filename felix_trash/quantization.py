@@ -0,0 +1,414 @@
+"""
+DogFaceNet
+Quantized embedding store for large galleries.
+The embeddings are stored as compact codes:
+ - ScalarQuantizer ('int8'): one byte per dimension, each dimension is
+ scaled between its minimum and maximum over a training sample.
+ - ProductQuantizer ('pq'): the embedding is cut into m sub-vectors, each
+ one is replaced by the index of its closest centroid of a k-means
+ codebook (one byte for 256 centroids), i.e. m bytes per embedding.
+QuantizedIndex searches with asymmetric distances (ADC): the queries stay
+in float32 and are compared to the codes directly, with a table of the
+query to centroid distances for PQ. The top candidates can be re-ranked
+with the exact vectors, which are memory-mapped from disk so that only
+the candidate rows are read.
+evaluate_codecs reports the recall@k of each codec against its memory
+footprint.
+
+Usage:
+    codec = ProductQuantizer(m=8).train(embeddings[:100000])
+    index = QuantizedIndex(codec)
+    index.add(embeddings, labels)
+    distances, ids, labels = index.search(queries, k=5, rerank=100)
+    python quantization.py --embeddings ../../output/embeddings/dfn/
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from gallery import squared_distances, top_k, kmeans, assign_centroids
+
+
+class ScalarQuantizer(object):
+    """
+    int8 scalar quantizer, one byte per dimension.
+    """
+
+    name = 'int8'
+
+    def __init__(self):
+        self.low = None
+        self.scale = None
+
+    @property
+    def code_size(self):
+        return len(self.low)
+
+    def train(self, x):
+        """
+        Learns the range of each dimension from a sample x.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        self.low = x.min(axis=0)
+        self.scale = np.maximum(x.max(axis=0) - self.low, 1e-12) / 255.
+        return self
+
+    def encode(self, x):
+        codes = np.round((np.asarray(x, dtype=np.float32) - self.low) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return (codes.astype(np.float32) + 128) * self.scale + self.low
+
+    def distances(self, queries, codes):
+        """
+        Squared distances between float queries and a block of codes.
+        """
+        return squared_distances(queries, self.decode(codes))
+
+    def params(self):
+        return {'low': self.low, 'scale': self.scale}
+
+    def set_params(self, params):
+        self.low, self.scale = params['low'], params['scale']
+        return self
+
+
+class ProductQuantizer(object):
+    """
+    Product quantizer.
+
+    Args:
+     - m: integer. Number of sub-vectors, has to divide the embedding size.
+     - nbits: integer. Bits per sub-vector code (at most 8), the codebooks
+     have 2**nbits centroids.
+    """
+
+    name = 'pq'
+
+    def __init__(self, m=8, nbits=8):
+        assert nbits <= 8, '[Error] The product quantizer codes are stored on one byte.'
+        self.m = m
+        self.nbits = nbits
+        self.codebooks = None
+
+    @property
+    def code_size(self):
+        return self.m
+
+    def _split(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        assert x.shape[-1] % self.m == 0, '[Error] The embedding size has to be a multiple of m.'
+        return x.reshape(len(x), self.m, x.shape[-1] // self.m)
+
+    def train(self, x, nbof_iter=20, seed=0):
+        """
+        Learns a k-means codebook for each sub-vector from a sample x.
+        """
+        sub = self._split(x)
+        ksub = min(2 ** self.nbits, len(x))
+        self.codebooks = np.stack([kmeans(sub[:, j], ksub, nbof_iter, seed + j)[0] for j in range(self.m)])
+        return self
+
+    def encode(self, x):
+        sub = self._split(x)
+        codes = np.empty((len(sub), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_centroids(sub[:, j], self.codebooks[j])
+        return codes
+
+    def decode(self, codes):
+        return self.codebooks[np.arange(self.m), codes.astype(np.int64)].reshape(len(codes), -1)
+
+    def distances(self, queries, codes):
+        """
+        Asymmetric squared distances: sums the distances between the query
+        sub-vectors and the centroids looked up in per-query tables.
+        """
+        sub = self._split(queries)
+        codes = codes.astype(np.int64)
+        dist = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            table = squared_distances(sub[:, j], self.codebooks[j])
+            dist += table[:, codes[:, j]]
+        return dist
+
+    def params(self):
+        return {'m': np.array(self.m), 'nbits': np.array(self.nbits), 'codebooks': self.codebooks}
+
+    def set_params(self, params):
+        self.m, self.nbits = int(params['m']), int(params['nbits'])
+        self.codebooks = params['codebooks']
+        return self
+
+
+CODECS = {'int8': ScalarQuantizer, 'pq': ProductQuantizer}
+
+
+class QuantizedIndex(object):
+    """
+    Gallery of quantized embeddings with their labels.
+
+    Args:
+     - codec: trained ScalarQuantizer or ProductQuantizer.
+     - block_size: integer. Number of codes per block of the search.
+    """
+
+    _arrays = ('codes', 'labels', 'ids')
+
+    def __init__(self, codec, block_size=65536):
+        self.codec = codec
+        self.block_size = block_size
+        self.size = 0
+        self.codes = np.empty((0, codec.code_size), dtype=np.uint8 if codec.name == 'pq' else np.int8)
+        self.labels = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.exact = None
+
+    def __len__(self):
+        return self.size
+
+    def _resized(self):
+        return self._arrays + (('exact',) if self.exact is not None else ())
+
+    def _reserve(self, n):
+        # Amortized growth as in GalleryIndex: the arrays are reallocated with a doubled capacity
+        capacity = len(self.ids)
+        if self.size + n <= capacity and not any(isinstance(getattr(self, name), np.memmap) for name in self._resized()):
+            return
+        capacity = max(self.size + n, 2 * capacity, 1024)
+        for name in self._resized():
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, embeddings, labels, ids=None, keep_exact=True):
+        """
+        Encodes and adds entries. The arrays grow by doubling their
+        capacity, the memory-mapped arrays of a loaded index are copied in
+        memory at the first add.
+
+        Args:
+         - embeddings: array of shape (n, emb_size).
+         - labels: array of size n.
+         - ids: array of size n, consecutive integers by default.
+         - keep_exact: boolean. Keep the float32 vectors for the re-ranking.
+        Returns:
+         - the ids of the added entries.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n = len(embeddings)
+        if ids is None:
+            start = int(self.ids[:self.size].max()) + 1 if self.size else 0
+            ids = np.arange(start, start + n)
+        if self.size == 0:
+            self.exact = np.empty((0, embeddings.shape[-1]), dtype=np.float32) if keep_exact else None
+        assert keep_exact == (self.exact is not None), \
+            '[Error] The exact vectors have to be kept for all the entries or none.'
+        self._reserve(n)
+        end = self.size + n
+        for i in range(0, n, self.block_size):
+            self.codes[self.size + i:self.size + min(i + self.block_size, n)] = \
+                self.codec.encode(embeddings[i:i + self.block_size])
+        self.labels[self.size:end] = labels
+        self.ids[self.size:end] = ids
+        if keep_exact:
+            self.exact[self.size:end] = embeddings
+        self.size = end
+        return np.asarray(ids)
+
+    def memory(self):
+        """
+        Bytes of the codes, and of the exact vectors (on disk once saved).
+        """
+        return self.codes[:self.size].nbytes, 0 if self.exact is None else self.exact[:self.size].nbytes
+
+    def search(self, queries, k=5, rerank=0):
+        """
+        Searches the k nearest entries of each query.
+
+        Args:
+         - queries: array of shape (m, emb_size).
+         - k: integer. Number of neighbours.
+         - rerank: integer. Number of ADC candidates re-ranked with the exact
+         vectors (0: no re-ranking).
+        Returns:
+         - distances: squared distances, array of shape (m, k), approximated
+         by the codes unless re-ranked.
+         - ids: ids of the neighbours, -1 when less than k entries were found.
+         - labels: labels of the neighbours.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.size == 0:
+            missing = np.full((len(queries), k), -1, dtype=np.int64)
+            return np.full((len(queries), k), np.inf, dtype=np.float32), missing, missing.copy()
+        rerank = rerank if self.exact is not None else 0
+        rows, dist = self._search_codes(queries, max(k, rerank))
+        if rerank > 0:
+            rows, dist = self._rerank(queries, rows, k)
+        rows, dist = rows[:, :k], dist[:, :k]
+        found = rows >= 0
+        ids = np.where(found, self.ids[np.maximum(rows, 0)], -1)
+        labels = np.where(found, self.labels[np.maximum(rows, 0)], -1)
+        return dist, ids, labels
+
+    def _search_codes(self, queries, k):
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            dist = self.codec.distances(queries, self.codes[start:end])
+            rows = np.concatenate((best_rows, np.broadcast_to(np.arange(start, end), dist.shape)), axis=-1)
+            dist = np.concatenate((best_dist, dist), axis=-1)
+            idx, best_dist = top_k(dist, k)
+            best_rows = np.take_along_axis(rows, idx, axis=-1)
+        best_rows[np.isinf(best_dist)] = -1
+        return best_rows, best_dist
+
+    def _rerank(self, queries, rows, k):
+        # Reads the candidate rows only, sorted for the memory-mapped vectors
+        candidates = np.unique(rows[rows >= 0])
+        exact = np.asarray(self.exact[candidates], dtype=np.float32)
+        positions = np.searchsorted(candidates, np.maximum(rows, 0))
+        diff = exact[positions] - queries[:, None, :]
+        dist = np.where(rows >= 0, np.sum(np.square(diff), axis=-1), np.inf).astype(np.float32)
+        idx, dist = top_k(dist, k)
+        return np.take_along_axis(rows, idx, axis=-1), dist
+
+    def save(self, path):
+        """
+        Saves the index into the directory path, one .npy file per array.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self._arrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name)[:self.size])
+        if self.exact is not None:
+            np.save(os.path.join(path, 'exact.npy'), self.exact[:self.size])
+        np.savez(os.path.join(path, 'codec.npz'), **self.codec.params())
+        with open(os.path.join(path, 'quantized.json'), 'w') as f:
+            json.dump({'codec': self.codec.name, 'size': len(self), 'exact': self.exact is not None}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Loads an index saved by save. The exact vectors are memory-mapped,
+        the codes too with mmap_mode='r'.
+        """
+        with open(os.path.join(path, 'quantized.json')) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, 'codec.npz')) as params:
+            codec = CODECS[meta['codec']]().set_params(dict(params))
+        index = cls(codec)
+        for name in cls._arrays:
+            setattr(index, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        if meta['exact']:
+            index.exact = np.load(os.path.join(path, 'exact.npy'), mmap_mode='r')
+        index.size = meta['size']
+        return index
+
+
+def exact_neighbours(queries, embeddings, k, block_size=65536):
+    """
+    Exact k nearest neighbours (rows of embeddings) of the queries.
+    """
+    best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+    best_dist = np.full((len(queries), k), np.inf, dtype=np.float32)
+    for start in range(0, len(embeddings), block_size):
+        end = min(start + block_size, len(embeddings))
+        dist = squared_distances(queries, np.asarray(embeddings[start:end], dtype=np.float32))
+        rows = np.concatenate((best_rows, np.broadcast_to(np.arange(start, end), dist.shape)), axis=-1)
+        idx, best_dist = top_k(np.concatenate((best_dist, dist), axis=-1), k)
+        best_rows = np.take_along_axis(rows, idx, axis=-1)
+    return best_rows
+
+
+def evaluate_codecs(embeddings, queries, codecs, ks=(1, 10, 100), reranks=(0, 100), train_size=100000, seed=0):
+    """
+    Recall@k against memory footprint of quantized indexes of embeddings.
+    The recall@k is the ratio of queries whose exact nearest neighbour is
+    in the k first results.
+
+    Args:
+     - embeddings: array of shape (n, emb_size), the gallery.
+     - queries: array of shape (m, emb_size).
+     - codecs: dictionary of name: untrained codec.
+     - ks: tuple of integers. The k of the recalls.
+     - reranks: tuple of integers. Numbers of re-ranked candidates tested.
+     - train_size: integer. Size of the training sample of the codecs.
+    Returns:
+     - list of dictionaries, one per codec and re-ranking.
+    """
+    rng = np.random.RandomState(seed)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    truth = exact_neighbours(queries, embeddings, 1)[:, 0]
+    sample = embeddings[np.sort(rng.choice(len(embeddings), min(train_size, len(embeddings)), replace=False))]
+    kmax = max(ks)
+
+    results = []
+    for name, codec in codecs.items():
+        start = time.perf_counter()
+        codec.train(sample)
+        index = QuantizedIndex(codec)
+        index.add(embeddings, np.zeros(len(embeddings), dtype=np.int64))
+        build_s = time.perf_counter() - start
+        code_bytes, exact_bytes = index.memory()
+        for rerank in reranks:
+            start = time.perf_counter()
+            _, ids, _ = index.search(queries, kmax, rerank=max(rerank, kmax) if rerank > 0 else 0)
+            query_ms = (time.perf_counter() - start) * 1000. / len(queries)
+            result = {'codec': name, 'rerank': rerank, 'bytes_per_vector': codec.code_size,
+                      'memory_mb': code_bytes / 2. ** 20, 'exact_mb_on_disk': exact_bytes / 2. ** 20 if rerank else 0.,
+                      'build_s': build_s, 'query_ms': query_ms}
+            for k in ks:
+                result['recall@{:d}'.format(k)] = float(np.mean(np.any(ids[:, :k] == truth[:, None], axis=-1)))
+            results += [result]
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DogFaceNet quantized gallery benchmark.')
+    parser.add_argument('--embeddings', default=None,
+                        help='directory written by bulk_embed.py, random unit vectors if not given')
+    parser.add_argument('--size', type=int, default=200000, help='number of random embeddings')
+    parser.add_argument('--emb-size', type=int, default=32)
+    parser.add_argument('--nbof-queries', type=int, default=1000)
+    parser.add_argument('--pq-m', type=int, nargs='*', default=[4, 8, 16], help='sub-vectors of the tested PQ codecs')
+    parser.add_argument('--rerank', type=int, nargs='*', default=[0, 100])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='quantization.json')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    if args.embeddings is not None:
+        from bulk_embed import load_embeddings
+        embeddings, _ = load_embeddings(args.embeddings)
+    else:
+        embeddings = rng.randn(args.size, args.emb_size).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    # The queries are held out of the gallery
+    held_out = np.zeros(len(embeddings), dtype=bool)
+    held_out[rng.choice(len(embeddings), args.nbof_queries, replace=False)] = True
+    queries, embeddings = embeddings[held_out], embeddings[np.logical_not(held_out)]
+
+    codecs = {'int8': ScalarQuantizer()}
+    for m in args.pq_m:
+        codecs['pq{:d}'.format(m)] = ProductQuantizer(m)
+    results = evaluate_codecs(embeddings, queries, codecs, reranks=args.rerank, seed=args.seed)
+    results.insert(0, {'codec': 'float32', 'rerank': 0, 'bytes_per_vector': 4 * embeddings.shape[-1],
+                       'memory_mb': embeddings.nbytes / 2. ** 20, 'recall@1': 1., 'recall@10': 1., 'recall@100': 1.})
+
+    for r in results:
+        recalls = ' '.join('{:s}={:.3f}'.format(key, value) for key, value in r.items() if key.startswith('recall'))
+        print('{:8s} rerank={:4d} {:4d} B/vector {:9.1f} MB {:s}'.format(
+            r['codec'], r['rerank'], r['bytes_per_vector'], r['memory_mb'], recalls))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to {:s}'.format(args.out))
@@ -0,0 +1,328 @@
+"""
+DogFaceNet
+Packed record shards of the dataset.
+The dataset directory is walked once and packed into nbof_shards files of
+length-prefixed records: a header (payload length, crc32, label, image id)
+followed by the raw JPEG bytes, without decoding them. A small JSON
+manifest lists the shards, and an index (file names, labels, shards and
+offsets of the records) gives the file names, the labels and the train/test
+split by class without walking the directory again.
+A RecordReader streams the shards sequentially through a shuffle buffer,
+or gathers batches of pictures by file name from the opened shards like an
+ImageCache, so an epoch reads a few large files instead of opening every
+JPEG file.
+
+Usage:
+    python records.py --path ../DFN_dataset/ --out ../../output/records/dfn --shards 16
+    records = RecordReader('../../output/records/dfn')
+    keep_train, keep_test = class_split(records.labels, 0.1)
+    for data, label, image_id in records.stream(keep_train, shuffle_buffer=1000):
+        image = decode_jpeg(data)
+    images = load_images(batch_filenames, cache=records)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import io
+import json
+import zlib
+import struct
+import argparse
+import threading
+
+import numpy as np
+
+from prefetch import make_executor, split_chunks, executor_workers
+
+# Payload length, crc32 of the payload, label, image id
+HEADER = struct.Struct('<IIqq')
+VERSION = 1
+
+
+def list_dataset(path):
+    """
+    File names and labels of a dataset stored as one directory per class,
+    the directories with a single picture are skipped. The labels are
+    floats, as in dogface.py.
+    """
+    filenames = []
+    labels = []
+    idx = 0
+    for root, dirs, files in sorted(os.walk(path)):
+        if len(files) > 1:
+            filenames += [os.path.join(root, f) for f in sorted(files)]
+            labels += [idx] * len(files)
+            idx += 1
+    return np.array(filenames), np.array(labels, dtype=np.float64)
+
+
+def class_split(labels, test_split, seed=None):
+    """
+    Train/test split by class: the pictures of a class are all in the same split.
+
+    Args:
+     - labels: array of the class of each picture.
+     - test_split: float. Ratio of the classes in the test split.
+     - seed: integer. Random test classes drawn with seed, or the first
+     classes if None (as in dogface.py).
+    Returns:
+     - keep_train, keep_test: boolean masks of the pictures.
+    """
+    classes = np.unique(labels)
+    nbof_test = int(test_split * len(classes))
+    if seed is not None:
+        classes = np.random.RandomState(seed).permutation(classes)
+    keep_test = np.isin(labels, classes[:nbof_test])
+    return np.logical_not(keep_test), keep_test
+
+
+def _paths(prefix):
+    return prefix + '.manifest.json', prefix + '.index.npz'
+
+
+def _shard_name(prefix, shard, nbof_shards):
+    return '{:s}-{:05d}-of-{:05d}.rec'.format(os.path.basename(prefix), shard, nbof_shards)
+
+
+def _read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def write_records(filenames, labels, prefix, nbof_shards=16, seed=0, executor=None, verbose=True):
+    """
+    Packs the pictures into nbof_shards record files, the manifest and the index.
+
+    Args:
+     - filenames: array of strings. The image id of a picture is its index
+     in filenames.
+     - labels: array of integers. Class of each picture.
+     - prefix: string. Prefix of the written files: prefix.manifest.json,
+     prefix.index.npz and prefix-00000-of-00016.rec, ...
+     - nbof_shards: integer. Number of record files.
+     - seed: integer. The pictures are shuffled over the shards with seed,
+     so that each shard holds all the classes, None to keep their order.
+     - executor: optional concurrent.futures executor reading the files.
+    Returns:
+     - a RecordReader opened on the written files.
+    """
+    filenames = np.asarray(filenames).astype(str)
+    labels = np.asarray(labels).astype(np.int64)
+    assert len(filenames) == len(labels), '[Error] filenames and labels do not have the same length.'
+    directory = os.path.dirname(prefix)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    order = np.arange(len(filenames)) if seed is None else np.random.RandomState(seed).permutation(len(filenames))
+    shards = np.empty(len(filenames), dtype=np.int32)
+    offsets = np.empty(len(filenames), dtype=np.int64)
+    lengths = np.empty(len(filenames), dtype=np.int64)
+
+    manifest = {'version': VERSION, 'nbof_images': len(filenames), 'nbof_classes': len(np.unique(labels)),
+                'header': HEADER.format, 'shards': []}
+    bounds = np.linspace(0, len(filenames), nbof_shards + 1).astype(np.int64)
+    packed = 0
+    for shard in range(nbof_shards):
+        ids = order[bounds[shard]:bounds[shard + 1]]
+        name = _shard_name(prefix, shard, nbof_shards)
+        path = os.path.join(directory, name)
+        blobs = map(_read_file, filenames[ids]) if executor is None else executor.map(_read_file, filenames[ids])
+        offset = 0
+        with open(path + '.tmp', 'wb') as f:
+            for image_id, data in zip(ids, blobs):
+                f.write(HEADER.pack(len(data), zlib.crc32(data), labels[image_id], image_id))
+                f.write(data)
+                shards[image_id], offsets[image_id], lengths[image_id] = shard, offset, len(data)
+                offset += HEADER.size + len(data)
+        os.replace(path + '.tmp', path)
+        manifest['shards'] += [{'file': name, 'nbof_records': len(ids), 'nbof_bytes': offset}]
+        packed += len(ids)
+        if verbose:
+            print('Packed shard {:s}: {:d} pictures, {:.1f} MB ({:d}/{:d})'.format(
+                name, len(ids), offset / 2 ** 20, packed, len(filenames)))
+
+    path_manifest, path_index = _paths(prefix)
+    np.savez(path_index, filenames=filenames, labels=labels, shards=shards, offsets=offsets, lengths=lengths)
+    with open(path_manifest + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path_manifest + '.tmp', path_manifest)
+    return RecordReader(prefix)
+
+
+def decode_jpeg(data):
+    """
+    Decodes the bytes of a picture to a uint8 array.
+    """
+    import skimage.io
+    return skimage.io.imread(io.BytesIO(data))
+
+
+def _decode_batch(blobs, dtype=np.float32):
+    # Decoded pictures of a list of JPEG bytes, in [0,1] unless dtype is np.uint8
+    images = np.stack([decode_jpeg(data) for data in blobs])
+    if dtype == np.uint8:
+        return images
+    return images.astype(dtype) / np.asarray(255.0, dtype=dtype)
+
+
+class RecordReader(object):
+    """
+    Reads the record shards written by write_records.
+
+    Args:
+     - prefix: string. Prefix given to write_records.
+
+    Attributes:
+     - manifest: dictionary, the JSON manifest.
+     - filenames: array of strings, the original file name of each image id.
+     - labels: float array, the class of each image id (as in dogface.py).
+     - shards, offsets, lengths: shard, offset of the record in the shard
+     and length of the JPEG bytes of each image id.
+     - index: dictionary mapping a file name to its image id.
+    """
+
+    def __init__(self, prefix):
+        path_manifest, path_index = _paths(prefix)
+        assert os.path.isfile(path_manifest), '[Error] Record manifest {:s} does not exist.'.format(path_manifest)
+        with open(path_manifest) as f:
+            self.manifest = json.load(f)
+        assert self.manifest['version'] == VERSION and self.manifest['header'] == HEADER.format, \
+            '[Error] Unsupported record format in {:s}.'.format(path_manifest)
+        with np.load(path_index) as index:
+            self.filenames = index['filenames']
+            self.labels = index['labels'].astype(np.float64)
+            self.shards = index['shards']
+            self.offsets = index['offsets']
+            self.lengths = index['lengths']
+        assert len(self.filenames) == self.manifest['nbof_images'], '[Error] Corrupted record index {:s}.'.format(path_index)
+
+        directory = os.path.dirname(prefix)
+        self.paths = [os.path.join(directory, shard['file']) for shard in self.manifest['shards']]
+        self.index = {f: i for i, f in enumerate(self.filenames)}
+        self.fds = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def _record(self, f, image_id):
+        length, crc, label, stored_id = HEADER.unpack(f.read(HEADER.size))
+        data = f.read(length)
+        assert stored_id == image_id and len(data) == length and zlib.crc32(data) == crc, \
+            '[Error] Corrupted record {:d} in {:s}.'.format(image_id, f.name)
+        return data, label
+
+    def stream(self, keep=None, shuffle_buffer=0, seed=None, buffering=2 ** 22):
+        """
+        Streams the records of the shards sequentially, in a random shard
+        order if shuffle_buffer > 0. The records not kept are skipped.
+
+        Args:
+         - keep: boolean mask or array of image ids of the records to read,
+         e.g. keep_train of class_split. All the records if None.
+         - shuffle_buffer: integer. Size of the shuffle buffer, the records
+         are yielded in the shard order if 0.
+         - seed: integer. Seed of the shard order and of the shuffle buffer.
+         - buffering: integer. Size of the read buffer of the shard files.
+        Yields:
+         - (data, label, image_id): the JPEG bytes, the label and the image id.
+        """
+        rng = np.random.RandomState(seed)
+        selected = np.ones(len(self), dtype=bool) if keep is None else np.zeros(len(self), dtype=bool)
+        if keep is not None:
+            selected[keep] = True
+
+        shard_order = np.arange(len(self.paths))
+        if shuffle_buffer > 0:
+            shard_order = rng.permutation(shard_order)
+        buffer = []
+        for shard in shard_order:
+            ids = np.flatnonzero(selected & (self.shards == shard))
+            ids = ids[np.argsort(self.offsets[ids])]
+            with open(self.paths[shard], 'rb', buffering=buffering) as f:
+                position = 0
+                for image_id in ids:
+                    if self.offsets[image_id] != position:
+                        f.seek(self.offsets[image_id])
+                    data, label = self._record(f, image_id)
+                    position = self.offsets[image_id] + HEADER.size + len(data)
+                    record = (data, label, int(image_id))
+                    if shuffle_buffer <= 0:
+                        yield record
+                    elif len(buffer) < shuffle_buffer:
+                        buffer += [record]
+                    else:
+                        i = rng.randint(shuffle_buffer)
+                        yield buffer[i]
+                        buffer[i] = record
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def read(self, image_id):
+        """
+        JPEG bytes of an image id, read at its offset in the shard.
+        Thread-safe: the shards are opened once, under a lock, and read with
+        os.pread.
+        """
+        fds = self.fds
+        if fds is None:
+            with self._lock:
+                if self.fds is None:
+                    self.fds = [os.open(path, os.O_RDONLY) for path in self.paths]
+                fds = self.fds
+        return os.pread(fds[self.shards[image_id]], int(self.lengths[image_id]),
+                        int(self.offsets[image_id]) + HEADER.size)
+
+    def gather(self, filenames, dtype=np.float32, executor=None):
+        """
+        Decodes the pictures of the given file names, like ImageCache.gather,
+        so a RecordReader can be given as cache to the generators.
+        With an executor, the records are read by the caller and decoded by
+        the workers, so only the JPEG bytes are sent to the processes.
+        """
+        blobs = [self.read(self.index[f]) for f in filenames]
+        if executor is None or len(blobs) == 0:
+            return _decode_batch(blobs, dtype)
+        chunks = split_chunks(len(blobs), executor_workers(executor))
+        futures = [executor.submit(_decode_batch, blobs[chunk], dtype) for chunk in chunks]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        with self._lock:
+            if self.fds is not None:
+                for fd in self.fds:
+                    os.close(fd)
+                self.fds = None
+
+    def __getstate__(self):
+        # The file descriptors and the lock are not shared with the loader processes
+        state = dict(self.__dict__)
+        state['fds'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs the DogFaceNet dataset into record shards.')
+    parser.add_argument('--path', default='../DFN_dataset/', help='dataset directory, one directory per class')
+    parser.add_argument('--out', default='../../output/records/dfn', help='prefix of the written files')
+    parser.add_argument('--shards', type=int, default=16, help='number of record files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the shuffling over the shards')
+    parser.add_argument('--workers', type=int, default=8, help='number of threads reading the files')
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.path), '[Error] Provided path for dataset does not exist.'
+    filenames, labels = list_dataset(args.path)
+    assert len(labels) != 0, '[Error] No data provided.'
+    print('Packing {:d} pictures of {:d} classes into {:d} shards...'.format(
+        len(filenames), len(np.unique(labels)), args.shards))
+    records = write_records(filenames, labels, args.out, args.shards, args.seed, make_executor(args.workers, False))
+    print('Done: {:s}.manifest.json'.format(args.out))
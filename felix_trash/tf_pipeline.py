@@ -0,0 +1,184 @@
+"""
+DogFaceNet
+tf.data input pipeline.
+Alternative to the python generators of online_training: the files are
+read and decoded by tf.data, the data augmentation of
+offline_training.datagen (rotation, zoom, channel shift, nearest fill) is
+done with TensorFlow image ops, and the anchor/positive/negative pictures
+are interleaved, batched and prefetched by tf.data.
+It contains:
+ - Soft triplet dataset: random triplets sampled in the graph
+ - Mined triplet dataset: triplets chosen by a python generator of file
+ names (e.g. online_adaptive_hard_triplet_generator)
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from class_index import ClassIndex
+
+SIZE = (224, 224, 3)
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def decode_image(filename, size=SIZE):
+    """
+    Reads and decodes a JPEG file to a float32 image in [0,1].
+    """
+    image = tf.io.decode_jpeg(tf.io.read_file(filename), channels=size[2])
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    return tf.ensure_shape(image, size)
+
+
+def augment_image(image, seed, rotation_range=8, zoom_range=0.1, channel_shift_range=0.1):
+    """
+    Random rotation, zoom and channel shift with nearest fill, as done by
+    the ImageDataGenerator of offline_training.
+
+    Args:
+     - image: float32 tensor of shape (h, w, c).
+     - seed: int tensor of shape (2,), seed of the stateless random ops.
+    """
+    h, w = image.shape[0], image.shape[1]
+    u = tf.random.stateless_uniform([4], seed=seed, minval=-1., maxval=1.)
+    theta = u[0] * rotation_range * np.pi / 180.
+    zx = 1. + u[1] * zoom_range
+    zy = 1. + u[2] * zoom_range
+
+    # Rotation then zoom around the center of the image, in (x, y)
+    # coordinates and mapping the output pixels to the input pixels.
+    c, s = tf.cos(theta), tf.sin(theta)
+    a0, a1 = c * zx, -s * zy
+    b0, b1 = s * zx, c * zy
+    o_x, o_y = (w - 1) / 2., (h - 1) / 2.
+    a2 = o_x - a0 * o_x - a1 * o_y
+    b2 = o_y - b0 * o_x - b1 * o_y
+    transform = tf.stack([a0, a1, a2, b0, b1, b2, 0., 0.])[None]
+
+    image = tf.raw_ops.ImageProjectiveTransformV3(
+        images=image[None],
+        transforms=transform,
+        output_shape=tf.constant([h, w]),
+        fill_value=0.,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST')[0]
+
+    # Channel shift, clipped to the range of the image
+    shift = u[3] * channel_shift_range
+    return tf.clip_by_value(image + shift, tf.reduce_min(image), tf.reduce_max(image))
+
+
+def _load_dataset(dataset, batch_size, use_aug, seed, size, dtype=tf.float32):
+    """
+    Decodes, augments, batches and prefetches a dataset of (filename, label).
+    The pictures are converted to dtype after the augmentation (uint8 pixels
+    or float32 in [0,1]).
+    """
+    def load(i, element):
+        filename, label = element
+        image = decode_image(filename, size)
+        if use_aug:
+            image = augment_image(image, tf.stack([tf.cast(seed, tf.int64) + 1, i]))
+        if dtype == tf.uint8:
+            image = tf.image.convert_image_dtype(image, tf.uint8, saturate=True)
+        return image, label
+
+    return (dataset
+            .enumerate()
+            .map(load, num_parallel_calls=AUTOTUNE)
+            .batch(batch_size, drop_remainder=True)
+            .prefetch(AUTOTUNE))
+
+
+def triplet_dataset(filenames, labels, batch_size=63, use_aug=True, class_index=None, seed=None, size=SIZE,
+                    dtype=tf.float32):
+    """
+    tf.data equivalent of online_training.image_generator: soft triplets.
+    The anchor and the positive come from a random class with at least two
+    pictures, the negative from another random class.
+
+    Args:
+     - filenames: array of strings. List of file names of the pictures.
+     - labels: array of labels.
+     - batch_size: integer. Has to be a multiple of 3.
+     - use_aug: boolean. Use data augmentation?
+     - class_index: ClassIndex of labels, built from labels if None.
+     - seed: integer. Seed of the sampling and of the augmentation.
+     - dtype: dtype of the pictures, tf.float32 or tf.uint8.
+    Returns:
+     - an infinite tf.data.Dataset of (images, labels) batches.
+    """
+    assert batch_size % 3 == 0
+    if class_index is None:
+        class_index = ClassIndex(labels)
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
+    filenames = tf.constant(np.asarray(filenames, dtype=str))
+    labels = tf.constant(np.asarray(labels, dtype=np.float32))
+    order = tf.constant(class_index.order, dtype=tf.int64)
+    offsets = tf.constant(class_index.offsets, dtype=tf.int64)
+    counts = tf.constant(class_index.counts, dtype=tf.int64)
+    multi_classes = tf.constant(class_index.multi_classes, dtype=tf.int64)
+    nbof_classes = len(class_index)
+
+    def random_int(u, maxval):
+        return tf.minimum(tf.cast(u * tf.cast(maxval, tf.float32), tf.int64), maxval - 1)
+
+    def sample_triplet(i):
+        u = tf.random.stateless_uniform([5], seed=tf.stack([tf.cast(seed, tf.int64), i]))
+
+        # Pick a class and chose two pictures from this class
+        class_ap = tf.gather(multi_classes, random_int(u[0], tf.size(multi_classes, out_type=tf.int64)))
+        count_ap = counts[class_ap]
+        rank1 = random_int(u[1], count_ap)
+        rank2 = random_int(u[2], count_ap - 1)
+        rank2 += tf.cast(rank2 >= rank1, tf.int64)
+
+        # Pick a class for the negative picture
+        class_n = random_int(u[3], nbof_classes - 1)
+        class_n += tf.cast(class_n >= class_ap, tf.int64)
+        rank3 = random_int(u[4], counts[class_n])
+
+        idx = tf.gather(order, tf.stack([offsets[class_ap] + rank1, offsets[class_ap] + rank2, offsets[class_n] + rank3]))
+        return tf.gather(filenames, idx), tf.gather(labels, idx)
+
+    dataset = (tf.data.experimental.Counter()
+               .map(sample_triplet, num_parallel_calls=AUTOTUNE)
+               .interleave(lambda f, y: tf.data.Dataset.from_tensor_slices((f, y)), cycle_length=1))
+    return _load_dataset(dataset, batch_size, use_aug, seed, size, dtype)
+
+
+def mined_triplet_dataset(triplet_generator, batch_size=63, use_aug=True, seed=None, size=SIZE, dtype=tf.float32):
+    """
+    tf.data pipeline loading the triplets chosen by a python generator.
+    The generator only yields file names and labels, for example
+    online_training.online_adaptive_hard_triplet_generator, so only the
+    mining runs in python.
+
+    Args:
+     - triplet_generator: callable returning a generator of (filenames, labels)
+     batches of size batch_size.
+     - batch_size: integer. Has to be a multiple of 3.
+     - use_aug: boolean. Use data augmentation?
+     - seed: integer. Seed of the augmentation.
+     - dtype: dtype of the pictures, tf.float32 or tf.uint8.
+    Returns:
+     - a tf.data.Dataset of (images, labels) batches.
+    """
+    assert batch_size % 3 == 0
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
+    def generator():
+        for f_triplet, y_triplet in triplet_generator():
+            yield np.asarray(f_triplet, dtype=str), np.asarray(y_triplet, dtype=np.float32)
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec(shape=(batch_size,), dtype=tf.string),
+                          tf.TensorSpec(shape=(batch_size,), dtype=tf.float32)))
+    dataset = dataset.interleave(lambda f, y: tf.data.Dataset.from_tensor_slices((f, y)), cycle_length=1)
+    return _load_dataset(dataset, batch_size, use_aug, seed, size, dtype)
@@ -0,0 +1,226 @@
+"""
+DogFaceNet
+TFLite export of the embedding model and CPU benchmark.
+A trained dogfacenet is cloned without its training-only pieces (the
+Dropout layers, the mixed precision policy and the optimizer), then
+converted to TFLite:
+ - 'float32': plain conversion, the reference of the TFLite runtime.
+ - 'float16': float16 weights, about half the size.
+ - 'int8': full-integer quantization of the weights and activations,
+ calibrated on a representative sample of the dataset pictures. The
+ input and output stay in float32 (or uint8 pixels for a model built with
+ input_dtype='uint8') unless integer_io is set.
+The benchmark runs the keras model and each TFLite model on the CPU and
+reports the latency, the throughput and the drift of the embeddings
+(cosine distance to the keras embeddings).
+
+Usage:
+    python tflite_export.py --model ../../output/model/2023.11.20.dogfacenet.49.h5 --path ../DFN_dataset/ --out ../../output/tflite/
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from inference_server import load_model, decode_images
+from embedder import TFLiteEmbedder
+from records import RecordReader, list_dataset
+
+SIZE = (224, 224, 3)
+VARIANTS = ('float32', 'float16', 'int8')
+
+
+def inference_model(model):
+    """
+    Clone of a trained dogfacenet for inference: the Dropout layers are
+    replaced by identities and every layer computes in float32.
+    """
+    def clone_layer(layer):
+        config = layer.get_config()
+        config['dtype'] = 'float32'
+        if isinstance(layer, tf.keras.layers.Dropout):
+            return tf.keras.layers.Activation('linear', name=config['name'], dtype='float32')
+        return layer.__class__.from_config(config)
+
+    clone = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+def representative_images(filenames, nbof_images=200, size=SIZE, dtype=np.float32, records=None, seed=0):
+    """
+    Random sample of the dataset pictures, decoded for the model input.
+
+    Args:
+     - filenames: array of strings.
+     - nbof_images: integer. Size of the sample.
+     - records: optional RecordReader holding the pictures of filenames.
+    """
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(len(filenames), min(nbof_images, len(filenames)), replace=False)
+    blobs = []
+    for f in filenames[sample]:
+        if records is not None:
+            blobs += [records.read(records.index[f])]
+        else:
+            with open(f, 'rb') as file:
+                blobs += [file.read()]
+    return decode_images(blobs, size, dtype)
+
+
+def convert(model, variant='float32', calibration=None, integer_io=False):
+    """
+    Converts an inference model to TFLite.
+
+    Args:
+     - model: keras model, see inference_model.
+     - variant: string. One of VARIANTS.
+     - calibration: array of pictures for the int8 calibration.
+     - integer_io: boolean. With int8, the input and output tensors are
+     quantized too (the caller quantizes the pictures).
+    Returns:
+     - the TFLite flatbuffer as bytes.
+    """
+    assert variant in VARIANTS, '[Error] Unknown TFLite variant {:s}.'.format(variant)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        assert calibration is not None and len(calibration) > 0, '[Error] int8 conversion needs calibration pictures.'
+
+        def representative_dataset():
+            for image in calibration:
+                yield [image[None]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        if integer_io:
+            converter.inference_input_type = tf.uint8 if calibration.dtype == np.uint8 else tf.int8
+            converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def _timings(predict, images, batch_size, repeat):
+    # First call outside of the timings: graph tracing or tensor allocation
+    batch = images[:batch_size]
+    outputs = predict(batch)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(batch)
+        times += [time.perf_counter() - start]
+    times = np.array(times) * 1000.
+    return outputs, {'batch_size': len(batch), 'p50_ms': float(np.percentile(times, 50)),
+                     'p95_ms': float(np.percentile(times, 95)),
+                     'images_per_sec': float(len(batch) * 1000. / np.mean(times))}
+
+
+def cosine_drift(reference, embeddings):
+    """
+    Mean and max cosine distances between the rows of two embedding arrays.
+    """
+    reference = reference / np.linalg.norm(reference, axis=-1, keepdims=True)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+    distances = 1. - np.sum(reference * embeddings, axis=-1)
+    return float(np.mean(distances)), float(np.max(distances))
+
+
+def benchmark(model, paths, images, batch_sizes=(1, 32), repeat=20, num_threads=None):
+    """
+    Latency, throughput and embedding drift of the TFLite models against
+    the keras model on the CPU.
+
+    Args:
+     - model: keras inference model.
+     - paths: dictionary of variant: .tflite path.
+     - images: array of pictures, at least max(batch_sizes).
+    Returns:
+     - list of dictionaries, one per model and batch size.
+    """
+    reference = model.predict_on_batch(images)
+    predictors = {'keras': (model.predict_on_batch, None)}
+    for variant, path in paths.items():
+        predictors[variant] = (TFLiteEmbedder(path, num_threads).predict_on_batch, path)
+
+    results = []
+    for name, (predict, path) in predictors.items():
+        embeddings = np.concatenate([predict(images[i:i + 32]) for i in range(0, len(images), 32)])
+        mean_drift, max_drift = cosine_drift(reference, embeddings)
+        for batch_size in batch_sizes:
+            _, result = _timings(predict, images, batch_size, repeat)
+            result.update({'model': name, 'cosine_drift_mean': mean_drift, 'cosine_drift_max': max_drift,
+                           'size_mb': os.path.getsize(path) / 2. ** 20 if path is not None else None})
+            results += [result]
+    return results
+
+
+def export_tflite(model, path, net_name, calibration, variants=VARIANTS, integer_io=False):
+    """
+    Writes path/net_name.variant.tflite for each variant.
+
+    Returns:
+     - dictionary of variant: written path.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    paths = {}
+    for variant in variants:
+        filename = os.path.join(path, '{:s}.{:s}.tflite'.format(net_name, variant))
+        with open(filename, 'wb') as f:
+            f.write(convert(model, variant, calibration, integer_io))
+        paths[variant] = filename
+        print('Exported {:s} ({:.1f} MB)'.format(filename, os.path.getsize(filename) / 2. ** 20))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DogFaceNet TFLite export and CPU benchmark.')
+    parser.add_argument('--model', required=True, help='path to a saved dogfacenet .h5 model')
+    parser.add_argument('--path', default='../DFN_dataset/', help='dataset directory of the calibration pictures')
+    parser.add_argument('--records', default=None, help='prefix of record shards (see records.py), used instead of --path')
+    parser.add_argument('--out', default='../../output/tflite/')
+    parser.add_argument('--variants', nargs='*', default=list(VARIANTS), choices=VARIANTS)
+    parser.add_argument('--nbof-calibration', type=int, default=200)
+    parser.add_argument('--nbof-eval', type=int, default=256, help='number of pictures of the drift evaluation')
+    parser.add_argument('--integer-io', action='store_true', help='int8 input and output tensors')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The benchmark compares CPU runtimes
+    tf.config.set_visible_devices([], 'GPU')
+    records = None
+    if args.records is not None:
+        records = RecordReader(args.records)
+        filenames = records.filenames
+    else:
+        assert os.path.isdir(args.path), '[Error] Provided path for dataset does not exist.'
+        filenames, _ = list_dataset(args.path)
+
+    print('Loading model from {:s} ...'.format(args.model))
+    model = inference_model(load_model(args.model))
+    size = tuple(model.input_shape[1:])
+    dtype = np.uint8 if model.inputs[0].dtype == tf.uint8 else np.float32
+    # Disjoint calibration and evaluation pictures
+    images = representative_images(filenames, args.nbof_calibration + args.nbof_eval, size, dtype, records, args.seed)
+    calibration, evaluation = images[:args.nbof_calibration], images[args.nbof_calibration:]
+
+    net_name = os.path.splitext(os.path.basename(args.model))[0]
+    paths = export_tflite(model, args.out, net_name, calibration, args.variants, args.integer_io)
+    results = benchmark(model, paths, evaluation, batch_sizes=(1, min(32, len(evaluation))), repeat=args.repeat,
+                        num_threads=args.threads)
+    for r in results:
+        print('{:8s} batch={:3d} p50={:8.2f} ms p95={:8.2f} ms {:8.1f} images/sec drift mean={:.5f} max={:.5f}'.format(
+            r['model'], r['batch_size'], r['p50_ms'], r['p95_ms'], r['images_per_sec'], r['cosine_drift_mean'],
+            r['cosine_drift_max']))
+    with open(os.path.join(args.out, net_name + '.benchmark.json'), 'w') as f:
+        json.dump(results, f, indent=2)
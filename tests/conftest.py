@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of felix_trash import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'felix_trash'))
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from bulk_embed import bulk_embed, consolidate, load_chunks, load_embeddings, read_progress
+
+SHAPE = (4, 4, 3)
+
+
+class ArrayCache(object):
+    # Pictures gathered from an array by file name, like an ImageCache; fails after max_calls gathers
+    def __init__(self, images, max_calls=None):
+        self.images = images
+        self.max_calls = max_calls
+        self.calls = 0
+
+    def gather(self, filenames, dtype=np.float32, executor=None):
+        self.calls += 1
+        if self.max_calls is not None and self.calls > self.max_calls:
+            raise RuntimeError('killed')
+        return self.images[[int(f) for f in filenames]].astype(dtype)
+
+
+@pytest.fixture
+def model():
+    inputs = tf.keras.Input(SHAPE)
+    outputs = tf.keras.layers.Dense(8)(tf.keras.layers.Flatten()(inputs))
+    return tf.keras.Model(inputs, outputs)
+
+
+@pytest.fixture
+def images():
+    return np.random.RandomState(0).rand(50, *SHAPE).astype(np.float32)
+
+
+def test_bulk_embed(model, images, tmp_path):
+    path = str(tmp_path)
+    filenames = np.arange(len(images)).astype(str)
+    progress = bulk_embed(model, filenames, path, labels=np.arange(50) // 5, chunk_size=16, batch_size=6,
+                          cache=ArrayCache(images), verbose=False)
+    assert progress['consolidated'] and progress['chunks_done'] == progress['nbof_chunks'] == 4
+    embeddings, ids = load_embeddings(path)
+    assert isinstance(embeddings, np.memmap)
+    assert np.array_equal(ids, np.arange(50))
+    assert np.allclose(embeddings, model.predict_on_batch(images), atol=1e-5)
+    assert np.array_equal(np.load(os.path.join(path, 'filenames.npy')), filenames)
+    assert not [f for f in os.listdir(path) if f.startswith('chunk-')]
+
+
+def test_resume_after_a_killed_job(model, images, tmp_path):
+    path = str(tmp_path)
+    filenames = np.arange(len(images)).astype(str)
+    # 3 batches of 6 pictures per chunk: killed in the third chunk
+    with pytest.raises(RuntimeError):
+        bulk_embed(model, filenames, path, chunk_size=16, batch_size=6, cache=ArrayCache(images, max_calls=7),
+                   prefetch_depth=0, verbose=False)
+    assert read_progress(path)['chunks_done'] == 2
+    embeddings, ids = load_chunks(path)
+    assert [len(e) for e in embeddings] == [16, 16]
+    assert np.array_equal(np.concatenate(ids), np.arange(32))
+    assert not consolidate(path).get('consolidated')
+    with pytest.raises(AssertionError):
+        load_embeddings(path)
+    with pytest.raises(AssertionError):
+        bulk_embed(model, filenames, path, chunk_size=8, cache=ArrayCache(images), verbose=False)
+
+    cache = ArrayCache(images)
+    bulk_embed(model, filenames, path, chunk_size=16, batch_size=6, cache=cache, prefetch_depth=0, verbose=False)
+    assert cache.calls == 3 + 1
+    embeddings, ids = load_embeddings(path)
+    assert np.array_equal(ids, np.arange(50))
+    assert np.allclose(embeddings, model.predict_on_batch(images), atol=1e-5)
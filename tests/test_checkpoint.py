@@ -0,0 +1,104 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from checkpoint import CheckpointManager, _optimizer_variables
+
+
+def make_model():
+    model = tf.keras.Sequential([tf.keras.Input((4,)), tf.keras.layers.Dense(3), tf.keras.layers.Dense(2)])
+    model.compile(optimizer='adam', loss='mse')
+    # Creates the optimizer variables
+    model.train_on_batch(np.ones((8, 4), dtype=np.float32), np.ones((8, 2), dtype=np.float32))
+    return model
+
+
+@pytest.fixture
+def model():
+    return make_model()
+
+
+def optimizer_values(model):
+    return [v.numpy() for v in _optimizer_variables(model.optimizer)]
+
+
+def draws(rngs):
+    return (np.random.rand(), random.random(), tf.random.get_global_generator().state.numpy().tolist()) + \
+        tuple(rng.rand() for rng in rngs.values())
+
+
+def test_round_trip(model, tmp_path):
+    rngs = {'augmenter': np.random.RandomState(0)}
+    manager = CheckpointManager(str(tmp_path / 'ckpt'), 'net', path_history=str(tmp_path / 'history'), rngs=rngs)
+    assert manager.restore(model) is None
+    manager.append_history(loss=1., val_loss=2., acc=.5, val_acc=.25)
+    weights, variables = model.get_weights(), optimizer_values(model)
+    manager.save(0, model, {'crt_loss': 0.3})
+    expected = draws(rngs)
+    manager.close()
+    assert np.load(str(tmp_path / 'history' / 'net.0.npy')).tolist() == [[1.], [2.], [.5], [.25]]
+
+    restored = make_model()
+    restored.set_weights([np.zeros_like(w) for w in weights])
+    rngs = {'augmenter': np.random.RandomState(1)}
+    np.random.seed(1)
+    random.seed(1)
+    manager = CheckpointManager(str(tmp_path / 'ckpt'), 'net', rngs=rngs)
+    state = manager.restore(restored)
+    assert state == {'crt_loss': 0.3, 'epoch': 0}
+    assert manager.history == {'loss': [1.], 'val_loss': [2.], 'acc': [.5], 'val_acc': [.25]}
+    for x, y in zip(restored.get_weights(), weights):
+        assert np.array_equal(x, y)
+    for x, y in zip(optimizer_values(restored), variables):
+        assert np.array_equal(x, y)
+    assert draws(rngs) == expected
+    manager.close()
+
+
+def test_max_to_keep(model, tmp_path):
+    manager = CheckpointManager(str(tmp_path), 'net', max_to_keep=2)
+    for epoch in range(5):
+        manager.save(epoch, model, {'epoch_state': epoch})
+    assert manager.latest() == 4
+    assert manager.epochs() == [3, 4]
+    assert sorted(os.listdir(str(tmp_path))) == ['net.3.ckpt.npz', 'net.4.ckpt.npz']
+    assert manager.restore(model, epoch=3)['epoch_state'] == 3
+    manager.close()
+    with pytest.raises(AssertionError):
+        CheckpointManager(str(tmp_path), 'net', max_to_keep=0)
+
+
+def test_worker_states(model, tmp_path):
+    path = str(tmp_path)
+    managers = [CheckpointManager(path, 'net', max_to_keep=1, worker_index=w) for w in range(2)]
+    expected = {}
+    for epoch in range(2):
+        for w, manager in enumerate(managers):
+            np.random.seed([w, epoch, 7])
+            manager.save(epoch, model, {'crt_loss': epoch}, {'pk_sampler': [epoch, w]})
+            manager.wait()
+            expected[w] = np.random.rand()
+    for manager in managers:
+        manager.close()
+    assert sorted(os.listdir(path)) == ['net.1.ckpt.npz', 'net.1.worker1.npz']
+
+    for w in range(2):
+        manager = CheckpointManager(path, 'net', worker_index=w)
+        state = manager.restore(model)
+        assert state == {'crt_loss': 1, 'pk_sampler': [1, w], 'epoch': 1}
+        assert np.random.rand() == expected[w]
+        manager.close()
+
+    # A worker without its own file is seeded from (worker_index, epoch)
+    manager = CheckpointManager(path, 'net', worker_index=2)
+    seeded = []
+    for _ in range(2):
+        state = manager.restore(model)
+        seeded += [np.random.rand()]
+    assert state == {'crt_loss': 1, 'epoch': 1}
+    assert seeded[0] == seeded[1] != expected[1]
+    manager.close()
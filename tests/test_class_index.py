@@ -0,0 +1,59 @@
+import numpy as np
+
+from class_index import ClassIndex
+
+
+def make_labels(seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.permutation(np.repeat(rng.choice(1000, 30, replace=False), rng.randint(1, 8, 30))).astype(np.float64)
+
+
+def test_offsets_match_the_classes():
+    labels = make_labels()
+    ci = ClassIndex(labels)
+    classes, counts = np.unique(labels, return_counts=True)
+    assert np.array_equal(ci.classes, classes)
+    assert np.array_equal(ci.counts, counts)
+    assert ci.offsets[0] == 0 and ci.offsets[-1] == len(labels)
+    assert np.array_equal(np.diff(ci.offsets), counts)
+    for k, label in enumerate(classes):
+        assert np.array_equal(np.sort(ci.members(k)), np.flatnonzero(labels == label))
+        assert np.array_equal(ci.rank[ci.members(k)], np.arange(counts[k]))
+    assert np.array_equal(ci.labels, labels)
+    assert np.array_equal(ci.multi_classes, np.flatnonzero(counts > 1))
+
+
+def test_gather_and_subset():
+    labels = make_labels(1)
+    ci = ClassIndex(labels)
+    ks = np.array([4, 0, 7])
+    idx, sub = ci.subset(ks)
+    assert np.array_equal(idx, np.concatenate([ci.members(k) for k in ks]))
+    assert np.array_equal(sub.labels, labels[idx])
+    assert len(ci.gather([])) == 0
+
+
+def test_sample_stays_in_the_class():
+    np.random.seed(0)
+    labels = make_labels(2)
+    ci = ClassIndex(labels)
+    ks = np.random.randint(len(ci), size=2000)
+    first = ci.sample(ks)
+    second = ci.sample(ks, exclude=first)
+    assert np.array_equal(labels[first], ci.classes[ks])
+    assert np.array_equal(labels[second], ci.classes[ks])
+    multi = ci.counts[ks] > 1
+    assert np.all(first[multi] != second[multi])
+    assert np.all(first[~multi] == second[~multi])
+    outside = ci.sample_outside(ks)
+    assert np.all(labels[outside] != ci.classes[ks])
+
+
+def test_random_classes_without_replacement():
+    np.random.seed(0)
+    ci = ClassIndex(make_labels(3))
+    for n in (1, 5, 20, len(ci)):
+        chosen = ci.random_classes(n)
+        assert len(chosen) == n and len(np.unique(chosen)) == n
+    chosen = ci.random_classes(len(ci.multi_classes), multi_only=True)
+    assert set(chosen) == set(ci.multi_classes)
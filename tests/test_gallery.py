@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from gallery import GalleryIndex, kmeans
+
+
+def brute_force(queries, embeddings, k):
+    dist = np.sum(np.square(queries[:, None, :] - embeddings[None, :, :]), axis=-1)
+    return np.argsort(dist, axis=-1)[:, :k]
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    embeddings = rng.randn(500, 16).astype(np.float32)
+    labels = rng.randint(50, size=500)
+    queries = rng.randn(20, 16).astype(np.float32)
+    return embeddings, labels, queries
+
+
+def test_exact_search(data):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16, block_size=64)
+    gallery.add(embeddings[:300], labels[:300])
+    gallery.add(embeddings[300:], labels[300:])
+    dist, ids, found = gallery.search(queries, k=5)
+    expected = brute_force(queries, embeddings, 5)
+    assert np.array_equal(ids, expected)
+    assert np.array_equal(found, labels[expected])
+    assert np.all(np.diff(dist, axis=-1) >= 0)
+
+
+def test_remove_and_compact(data):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16)
+    gallery.add(embeddings, labels)
+    removed = np.arange(0, 500, 3)
+    assert gallery.remove(removed) == len(removed)
+    keep = np.setdiff1d(np.arange(500), removed)
+    _, ids, _ = gallery.search(queries, k=5)
+    assert np.array_equal(ids, keep[brute_force(queries, embeddings[keep], 5)])
+    gallery.compact()
+    assert len(gallery) == gallery.size == len(keep)
+    _, ids_compact, _ = gallery.search(queries, k=5)
+    assert np.array_equal(ids, ids_compact)
+
+
+def test_empty_search(data):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16)
+    dist, ids, found = gallery.search(queries, k=3)
+    assert np.all(np.isinf(dist)) and np.all(ids == -1) and np.all(found == -1)
+
+    gallery.add(embeddings[:2], labels[:2])
+    gallery.remove(gallery.ids[:2])
+    gallery.compact()
+    dist, ids, _ = gallery.search(queries, k=3, nprobe=2)
+    assert dist.shape == (20, 3) and np.all(ids == -1)
+    with pytest.raises(AssertionError):
+        gallery.train(nlist=4)
+
+
+def test_fewer_entries_than_k(data):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16)
+    gallery.add(embeddings[:3], labels[:3])
+    dist, ids, _ = gallery.search(queries, k=5)
+    assert np.all(ids[:, 3:] == -1) and np.all(np.isinf(dist[:, 3:]))
+    assert np.array_equal(np.sort(ids[:, :3], axis=-1), np.tile(np.arange(3), (20, 1)))
+
+
+def test_kmeans_with_fewer_points_than_clusters(data):
+    embeddings, labels, queries = data
+    centroids, assign = kmeans(embeddings[:5], 64)
+    assert len(centroids) == 5
+    gallery = GalleryIndex(16)
+    gallery.add(embeddings[:5], labels[:5])
+    gallery.train(nlist=64)
+    _, ids, _ = gallery.search(queries, k=5, nprobe=5)
+    assert np.array_equal(ids, brute_force(queries, embeddings[:5], 5))
+
+
+def test_ivf_with_every_list_is_exact(data):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16)
+    gallery.add(embeddings, labels)
+    gallery.train(nlist=8)
+    _, exact, _ = gallery.search(queries, k=5)
+    _, ivf, _ = gallery.search(queries, k=5, nprobe=8)
+    assert np.array_equal(exact, ivf)
+    # Entries added after training are assigned to their partition
+    gallery.add(queries, np.zeros(len(queries)))
+    _, ids, _ = gallery.search(queries, k=1, nprobe=1)
+    assert np.array_equal(ids[:, 0], 500 + np.arange(20))
+
+
+def test_save_and_load(data, tmp_path):
+    embeddings, labels, queries = data
+    gallery = GalleryIndex(16)
+    gallery.add(embeddings, labels)
+    gallery.train(nlist=8)
+    gallery.save(str(tmp_path))
+    loaded = GalleryIndex.load(str(tmp_path))
+    for nprobe in (None, 3):
+        for x, y in zip(gallery.search(queries, 5, nprobe), loaded.search(queries, 5, nprobe)):
+            assert np.array_equal(x, y)
+    # Memory-mapped arrays are copied at the first change
+    loaded.add(queries[:1], [7])
+    assert len(loaded) == 501 and not isinstance(loaded.embeddings, np.memmap)
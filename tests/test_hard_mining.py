@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from offline_training import hardest_indices, global_hard_triplet_indices
+
+
+def distances(predict, i):
+    return np.array([np.sum(np.square(predict[i] - p)) for p in predict])
+
+
+def brute_force(idx_anchor, predict, labels):
+    # Farthest picture of the class and closest picture outside of it, one anchor at a time
+    best_pos, best_neg = [], []
+    for a in idx_anchor:
+        dist = distances(predict, a)
+        best_pos += [max(dist[j] for j in range(len(labels)) if labels[j] == labels[a])]
+        best_neg += [min(dist[j] for j in range(len(labels)) if labels[j] != labels[a])]
+    return np.array(best_pos), np.array(best_neg)
+
+
+def anchor_distances(idx_anchor, idx, predict):
+    return np.sum(np.square(predict[idx_anchor] - predict[idx]), axis=-1)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    labels = rng.randint(12, size=90).astype(np.float64)
+    predict = rng.randn(90, 8).astype(np.float32)
+    return labels, predict
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 1024])
+def test_hardest_indices(data, block_size):
+    labels, predict = data
+    idx_anchor = np.random.RandomState(1).randint(len(labels), size=40)
+    idx_pos, idx_neg = hardest_indices(idx_anchor, predict, labels, block_size)
+    assert np.all(labels[idx_pos] == labels[idx_anchor])
+    assert np.all(labels[idx_neg] != labels[idx_anchor])
+    best_pos, best_neg = brute_force(idx_anchor, predict, labels)
+    assert np.allclose(anchor_distances(idx_anchor, idx_pos, predict), best_pos, rtol=1e-4, atol=1e-4)
+    assert np.allclose(anchor_distances(idx_anchor, idx_neg, predict), best_neg, rtol=1e-4, atol=1e-4)
+
+    only_neg = hardest_indices(idx_anchor, predict, labels, block_size, use_pos=False)
+    assert only_neg[0] is None and np.array_equal(only_neg[1], idx_neg)
+
+
+def test_global_hard_triplet_indices(data):
+    labels, predict = data
+    triplets = global_hard_triplet_indices(labels, predict, block_size=16).reshape(-1, 3)
+    idx_anchor, idx_pos, idx_neg = triplets.T
+    # Every picture is an anchor, class by class in order of first appearance
+    assert np.array_equal(np.sort(idx_anchor), np.arange(len(labels)))
+    _, first = np.unique(labels, return_index=True)
+    order = labels[np.sort(first)]
+    assert np.array_equal(labels[idx_anchor], np.repeat(order, [np.sum(labels == c) for c in order]))
+    best_pos, best_neg = brute_force(idx_anchor, predict, labels)
+    assert np.all(labels[idx_pos] == labels[idx_anchor]) and np.all(labels[idx_neg] != labels[idx_anchor])
+    assert np.allclose(anchor_distances(idx_anchor, idx_pos, predict), best_pos, rtol=1e-4, atol=1e-4)
+    assert np.allclose(anchor_distances(idx_anchor, idx_neg, predict), best_neg, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import numpy as np
+
+from manifest import Manifest, update_manifest, check_rescans
+from records import list_dataset
+
+
+def add(root, filename, data=b'jpeg'):
+    path = os.path.join(root, filename)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def assert_walked(manifest, root):
+    filenames, labels = list_dataset(root)
+    assert np.array_equal(manifest.filenames, filenames)
+    assert np.array_equal(manifest.labels, labels)
+    assert len(manifest) == len(filenames)
+
+
+def test_check_rescans():
+    check_rescans(workers=2)
+
+
+def test_rescan_lists_only_changed_directories(tmp_path, monkeypatch):
+    root, path = str(tmp_path / 'dataset') + '/', str(tmp_path / 'manifest')
+    for c in range(4):
+        for i in range(3):
+            add(root, 'dog_{:d}/{:d}.jpg'.format(c, i))
+    add(root, 'single/0.jpg')
+    assert_walked(update_manifest(root, path, verbose=False), root)
+
+    scanned = []
+    scandir = os.scandir
+
+    def rescan():
+        # Directories listed by the rescan only, os.walk lists them all
+        del scanned[:]
+        with monkeypatch.context() as m:
+            m.setattr(os, 'scandir', lambda d: scanned.append(os.path.normpath(d)) or scandir(d))
+            manifest = update_manifest(root, path, verbose=False)
+        assert_walked(manifest, root)
+        return sorted(scanned)
+
+    assert rescan() == []
+    add(root, 'dog_2/new.jpg')
+    shutil.rmtree(root + 'dog_0')
+    assert rescan() == sorted([os.path.normpath(root), os.path.normpath(root + 'dog_2')])
+
+
+def test_save_load_and_split(tmp_path):
+    root, path = str(tmp_path / 'dataset') + '/', str(tmp_path / 'manifest')
+    for c in range(10):
+        for i in range(2 + c % 3):
+            add(root, 'dog_{:d}/{:d}.jpg'.format(c, i), b'x' * i)
+    manifest = update_manifest(root, path, verbose=False)
+    loaded = Manifest.load(path)
+    assert loaded.root == root
+    for name in ('dirs', 'dir_parents', 'dir_mtimes', 'dir_counts', 'names', 'sizes', 'mtimes'):
+        assert np.array_equal(getattr(loaded, name), getattr(manifest, name))
+    assert sorted(manifest.sizes.tolist()) == sorted(i for c in range(10) for i in range(2 + c % 3))
+    keep_train, keep_test = loaded.split(0.2, seed=0)
+    assert np.all(keep_train != keep_test)
+    assert len(np.unique(loaded.labels[keep_test])) == 2
+    assert Manifest.load(str(tmp_path / 'missing')) is None
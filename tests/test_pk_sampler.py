@@ -0,0 +1,63 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from class_index import ClassIndex
+from pk_sampler import PKSampler
+
+
+@pytest.fixture
+def class_index():
+    rng = np.random.RandomState(0)
+    labels = np.repeat(np.arange(40), rng.randint(1, 9, 40)).astype(np.float64)
+    return ClassIndex(labels[rng.permutation(len(labels))])
+
+
+def test_every_picture_once_per_epoch(class_index):
+    P, K = 6, 3
+    sampler = PKSampler(class_index, P, K, seed=0)
+    eligible = class_index.gather(sampler.eligible)
+    for epoch in range(3):
+        batches = sampler.epoch_batches(epoch)
+        assert batches.shape == (len(sampler), P * K)
+        assert set(batches.ravel()) == set(eligible)
+        # Blocks of K pictures of the same class
+        blocks = class_index.labels[batches].reshape(len(sampler), P, K)
+        assert np.all(blocks == blocks[:, :, :1])
+    # The leftover groups are in the last batch, completed with other classes
+    assert len(np.unique(blocks[-1, :, 0])) == P
+
+
+def test_balanced_weights(class_index):
+    sampler = PKSampler(class_index, 5, 2, class_weights='balanced', seed=0)
+    assert len(np.unique(sampler.groups)) == 1
+    batches = sampler.epoch_batches(0)
+    assert set(class_index.labels[batches.ravel()]) == set(class_index.classes[sampler.eligible])
+
+
+def test_min_images(class_index):
+    sampler = PKSampler(class_index, 4, 2, min_images=5, seed=0)
+    seen = np.unique(class_index.labels[sampler.epoch_batches(0).ravel()])
+    assert np.all(class_index.counts[np.searchsorted(class_index.classes, seen)] >= 5)
+
+
+def test_epochs_are_replayed_from_the_seed(class_index):
+    a = PKSampler(class_index, 6, 3, seed=1)
+    b = PKSampler(class_index, 6, 3, seed=1)
+    assert np.array_equal(a.epoch_batches(2), b.epoch_batches(2))
+    assert not np.array_equal(a.epoch_batches(0), a.epoch_batches(1))
+    assert not np.array_equal(a.epoch_batches(0), PKSampler(class_index, 6, 3, seed=2).epoch_batches(0))
+
+
+def test_iteration_resumes_from_epoch_and_position(class_index):
+    sampler = PKSampler(class_index, 6, 3, seed=0)
+    n = len(sampler)
+    expected = list(itertools.islice(iter(sampler), n + 3))
+    assert (sampler.epoch, sampler.position) == (1, 3)
+
+    resumed = PKSampler(class_index, 6, 3, seed=0)
+    resumed.epoch, resumed.position = 0, n - 2
+    rest = list(itertools.islice(iter(resumed), 5))
+    for x, y in zip(expected[n - 2:], rest):
+        assert np.array_equal(x, y)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from quantization import QuantizedIndex, ScalarQuantizer, ProductQuantizer, exact_neighbours
+
+CODECS = [lambda: ScalarQuantizer(), lambda: ProductQuantizer(m=4)]
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    embeddings = rng.randn(2000, 16).astype(np.float32)
+    labels = rng.randint(100, size=2000)
+    queries = rng.randn(50, 16).astype(np.float32)
+    return embeddings, labels, queries
+
+
+@pytest.mark.parametrize('make_codec', CODECS)
+def test_empty_search(make_codec, data):
+    embeddings, _, queries = data
+    index = QuantizedIndex(make_codec().train(embeddings))
+    dist, ids, labels = index.search(queries, k=4, rerank=10)
+    assert dist.shape == (50, 4) and np.all(np.isinf(dist))
+    assert np.all(ids == -1) and np.all(labels == -1)
+
+
+@pytest.mark.parametrize('make_codec', CODECS)
+def test_incremental_add(make_codec, data):
+    embeddings, labels, queries = data
+    codec = make_codec().train(embeddings)
+    bulk = QuantizedIndex(codec)
+    bulk.add(embeddings, labels)
+    incremental = QuantizedIndex(codec, block_size=128)
+    for start in range(0, len(embeddings), 300):
+        incremental.add(embeddings[start:start + 300], labels[start:start + 300])
+    assert len(incremental) == len(bulk)
+    assert np.array_equal(incremental.codes[:len(bulk)], bulk.codes[:len(bulk)])
+    assert np.array_equal(incremental.ids[:len(bulk)], np.arange(len(embeddings)))
+    for x, y in zip(bulk.search(queries, 5, rerank=20), incremental.search(queries, 5, rerank=20)):
+        assert np.array_equal(x, y)
+    with pytest.raises(AssertionError):
+        incremental.add(embeddings[:1], labels[:1], keep_exact=False)
+
+
+@pytest.mark.parametrize('make_codec', CODECS)
+def test_rerank_recall(make_codec, data):
+    embeddings, labels, queries = data
+    index = QuantizedIndex(make_codec().train(embeddings))
+    index.add(embeddings, labels)
+    expected = exact_neighbours(queries, embeddings, 1)[:, 0]
+    _, ids, _ = index.search(queries, k=10)
+    assert np.mean(np.any(ids == expected[:, None], axis=-1)) >= 0.8
+    # Re-ranking every entry is an exact search
+    dist, ids, found = index.search(queries, k=5, rerank=len(embeddings))
+    assert np.array_equal(ids, exact_neighbours(queries, embeddings, 5))
+    assert np.array_equal(found, labels[ids])
+    assert np.allclose(dist, np.sum(np.square(embeddings[ids] - queries[:, None]), axis=-1), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('make_codec', CODECS)
+def test_save_and_load(make_codec, data, tmp_path):
+    embeddings, labels, queries = data
+    index = QuantizedIndex(make_codec().train(embeddings))
+    index.add(embeddings, labels)
+    index.save(str(tmp_path))
+    loaded = QuantizedIndex.load(str(tmp_path))
+    for rerank in (0, 20):
+        for x, y in zip(index.search(queries, 5, rerank), loaded.search(queries, 5, rerank)):
+            assert np.array_equal(x, y)
+    loaded.add(queries, np.zeros(len(queries)))
+    assert len(loaded) == len(embeddings) + len(queries)
+    assert not isinstance(loaded.exact, np.memmap)
@@ -0,0 +1,98 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from records import HEADER, RecordReader, write_records, list_dataset, class_split
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = np.random.RandomState(0)
+    root = tmp_path / 'dataset'
+    for c in range(8):
+        for i in range(rng.randint(1, 5)):
+            path = root / 'dog_{:d}'.format(c) / '{:d}.jpg'.format(i)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(rng.bytes(rng.randint(0, 3000)))
+    return str(root)
+
+
+@pytest.fixture
+def records(dataset, tmp_path):
+    filenames, labels = list_dataset(dataset)
+    reader = write_records(filenames, labels, str(tmp_path / 'records' / 'dfn'), nbof_shards=3, verbose=False)
+    yield reader
+    reader.close()
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_list_dataset_skips_single_pictures(dataset):
+    filenames, labels = list_dataset(dataset)
+    assert labels.dtype == np.float64
+    classes, counts = np.unique(labels, return_counts=True)
+    assert np.array_equal(classes, np.arange(len(classes))) and np.all(counts > 1)
+    for filename, label in zip(filenames, labels):
+        assert np.all(labels[np.char.startswith(filenames, os.path.dirname(filename) + '/')] == label)
+
+
+def test_write_and_read(records, dataset, tmp_path):
+    filenames, labels = list_dataset(dataset)
+    reopened = RecordReader(str(tmp_path / 'records' / 'dfn'))
+    for reader in (records, reopened):
+        assert np.array_equal(reader.filenames, filenames)
+        assert np.array_equal(reader.labels, labels) and reader.labels.dtype == np.float64
+        for image_id, filename in enumerate(filenames):
+            assert filename in reader
+            assert reader.read(image_id) == read_file(filename)
+    reopened.close()
+
+
+@pytest.mark.parametrize('shuffle_buffer', [0, 4])
+def test_stream(records, shuffle_buffer):
+    keep_train, keep_test = class_split(records.labels, 0.5, seed=0)
+    for keep in (None, keep_train, np.flatnonzero(keep_test)):
+        expected = np.arange(len(records)) if keep is None else np.arange(len(records))[keep]
+        streamed = list(records.stream(keep, shuffle_buffer=shuffle_buffer, seed=0))
+        assert sorted(image_id for _, _, image_id in streamed) == sorted(expected)
+        for data, label, image_id in streamed:
+            assert data == read_file(records.filenames[image_id])
+            assert label == records.labels[image_id]
+
+
+def test_class_split(records):
+    keep_train, keep_test = class_split(records.labels, 0.5, seed=1)
+    assert np.all(keep_train != keep_test)
+    assert not set(records.labels[keep_train]) & set(records.labels[keep_test])
+    assert len(np.unique(records.labels[keep_test])) == int(0.5 * len(np.unique(records.labels)))
+
+
+def test_corrupted_record(records):
+    image_id = np.flatnonzero(records.lengths > 0)[0]
+    with open(records.paths[records.shards[image_id]], 'r+b') as f:
+        f.seek(records.offsets[image_id] + HEADER.size)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xff]))
+    with pytest.raises(AssertionError):
+        list(records.stream())
+
+
+def test_concurrent_reads_and_pickle(records):
+    ids = np.tile(np.arange(len(records)), 20)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        blobs = list(executor.map(records.read, ids))
+    assert len(records.fds) == len(records.paths)
+    assert all(blob == read_file(records.filenames[i]) for blob, i in zip(blobs, ids))
+
+    copy = pickle.loads(pickle.dumps(records))
+    assert copy.fds is None
+    assert copy.read(0) == records.read(0)
+    copy.close()
+    assert copy.fds is None
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from class_index import ClassIndex
+from online_training import triplet_indices_batch
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    labels = np.repeat(np.arange(15), rng.randint(1, 6, 15)).astype(np.float64)
+    labels = labels[rng.permutation(len(labels))]
+    predict = rng.randn(len(labels), 8).astype(np.float32)
+    return labels, predict
+
+
+def distances(predict, i):
+    return np.array([np.sum(np.square(predict[i] - p)) for p in predict])
+
+
+@pytest.mark.parametrize('use_pos,use_neg', [(True, True), (True, False), (False, True), (False, False)])
+def test_triplets_against_brute_force(data, use_pos, use_neg):
+    labels, predict = data
+    np.random.seed(0)
+    triplets = triplet_indices_batch(labels, predict, 3 * 50, use_neg=use_neg, use_pos=use_pos, block_size=8,
+                                     class_index=ClassIndex(labels))
+    assert triplets.shape == (150,)
+    for a, p, n in triplets.reshape(-1, 3):
+        same = labels == labels[a]
+        assert labels[p] == labels[a] and labels[n] != labels[a]
+        # A single picture class is its own positive, otherwise the positive is another picture
+        assert (p == a) == (np.sum(same) == 1)
+        dist = distances(predict, a)
+        if use_pos:
+            assert np.isclose(dist[p], np.max(dist[same]), rtol=1e-4, atol=1e-4)
+        if use_neg:
+            assert np.isclose(dist[n], np.min(dist[~same]), rtol=1e-4, atol=1e-4)
+
+
+def test_seeded_selection(data):
+    labels, predict = data
+    np.random.seed(3)
+    first = triplet_indices_batch(labels, predict, 63, use_neg=False, use_pos=False)
+    np.random.seed(3)
+    assert np.array_equal(first, triplet_indices_batch(labels, predict, 63, use_neg=False, use_pos=False))
+    with pytest.raises(AssertionError):
+        triplet_indices_batch(labels, predict, 64)